@@ -0,0 +1,106 @@
+"""
+Benchmark suite of the music analysis on deterministic synthetic audio: a click track, tone bursts and a noise bed mixed
+together, generated offline so that it runs on a CPU-only machine without audio files or network access.
+Times every stage of notedetection and the whole process_audio call, and reports wall time, peak memory and throughput
+in seconds of audio analysed per second.
+
+Run from the repository root:
+    python -m benchmarks.bench_analysis
+    python -m benchmarks.bench_analysis --durations 30 60 --repeat 1
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import librosa
+import numpy as np
+import soundfile
+
+from benchmarks.synthetic import click_track, noise_bed, tone_bursts
+from game.utils import notedetection
+
+
+def synthetic_song(duration, sr=22050):
+    """
+    Click track at 120 BPM, tone bursts and a noise bed mixed together
+    """
+    return click_track(duration, sr=sr) + tone_bursts(duration, sr=sr) + noise_bed(duration, sr=sr)
+
+
+def measure(function, *args, repeat=3, **kwargs):
+    """
+    Best wall time over several runs, and the peak traced memory of one more run, as tracing slows numpy down
+    :return: result of the function, wall time in seconds, peak memory in bytes
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        copies = [np.copy(arg) if isinstance(arg, np.ndarray) else arg for arg in args]
+        start = time.perf_counter()
+        result = function(*copies, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    function(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def benchmark_stages(duration, sr=22050, repeat=3):
+    """
+    Benchmark every stage of the analysis on a synthetic song
+    :param duration: song length in seconds
+    :param sr: sampling rate
+    :param repeat: number of timed runs per stage, the best one is reported
+    :return: list of (stage name, wall time, peak memory)
+    """
+    x = synthetic_song(duration, sr=sr)
+    results = []
+
+    _, elapsed, peak = measure(notedetection.vocal_separation, x, sr, repeat=repeat)
+    results.append(("vocal_separation", elapsed, peak))
+
+    _, elapsed, peak = measure(notedetection.onset_detection, x, sr, repeat=repeat)
+    results.append(("onset_detection", elapsed, peak))
+
+    # inputs of the later stages, computed as in onset_detection
+    y = np.abs(librosa.stft(x, n_fft=1024, hop_length=512, center=False))
+    onset_frames = librosa.onset.onset_detect(y=x, sr=sr)
+    onset_samples = librosa.frames_to_samples(onset_frames)
+    onset_durations, elapsed, peak = measure(notedetection.onset_length_detection, x, y, onset_samples, sr=sr,
+                                             repeat=repeat)
+    results.append(("onset_length_detection", elapsed, peak))
+
+    onset_times = librosa.frames_to_time(onset_frames, sr=sr)
+    tempo = 120
+    _, elapsed, peak = measure(notedetection.merge_close_onset, onset_times, onset_durations, tempo, repeat=repeat)
+    results.append(("merge_close_onset", elapsed, peak))
+
+    _, elapsed, peak = measure(notedetection.onset_roundings, onset_times, onset_durations, tempo, repeat=repeat)
+    results.append(("onset_roundings", elapsed, peak))
+
+    # end to end, including decoding, from a lossless file
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "song.wav")
+        soundfile.write(filename, x, sr)
+        _, elapsed, peak = measure(notedetection.process_audio, filename, repeat=repeat)
+    results.append(("process_audio", elapsed, peak))
+    return results
+
+
+def main(durations=(30, 120, 300), repeat=3):
+    print(f"{'song (s)':>8} {'stage':>24} {'wall (s)':>9} {'peak MB':>8} {'audio s/s':>10}")
+    for duration in durations:
+        for stage, elapsed, peak in benchmark_stages(duration, repeat=repeat):
+            print(f"{duration:>8g} {stage:>24} {elapsed:>9.4f} {peak / 1e6:>8.1f} {duration / elapsed:>10.1f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the music analysis on synthetic audio")
+    parser.add_argument("--durations", type=float, nargs="+", default=[30, 120, 300],
+                        help="Lengths of the synthetic songs in seconds")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed runs per stage, the best one is reported")
+    arguments = parser.parse_args()
+    main(arguments.durations, arguments.repeat)
@@ -0,0 +1,161 @@
+"""
+Benchmark of the download manager (game/utils/downloads.py) against a local HTTP server that stands in for YouTube, so
+no network access is needed. The server supports range requests, adds a latency to every request and limits the
+bandwidth of every connection, and can cut the first transfer of every file halfway to exercise resumption.
+Reports the time to download a batch of songs one at a time and several at a time, checks the downloaded files, and
+shows the structured error of a link that does not exist.
+
+Run from the repository root:
+    python -m benchmarks.bench_downloads
+    python -m benchmarks.bench_downloads --songs 16 --workers 8 --faults
+"""
+import argparse
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from game.utils.downloads import DownloadManager
+
+
+class StandInServer(ThreadingHTTPServer):
+    """
+    HTTP server of in-memory files
+    """
+    daemon_threads = True
+
+    def __init__(self, files, latency=0.1, bandwidth=4 * 1024 ** 2, faults=False):
+        """
+        :param files: dictionary of file names and contents
+        :param latency: seconds before every response
+        :param bandwidth: bytes per second of every connection
+        :param faults: cut the first transfer of every file at half of it
+        """
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.files = files
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.faults = faults
+        self.cut_files = set()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+        time.sleep(server.latency)
+        content = server.files.get(self.path.lstrip("/"))
+        if content is None:
+            self.send_error(404)
+            return
+        first, last = 0, len(content) - 1
+        match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match is not None:
+            first = int(match.group(1))
+            last = min(int(match.group(2)), last) if match.group(2) else last
+            if first >= len(content):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {first}-{last}/{len(content)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(last - first + 1))
+        self.end_headers()
+
+        # the transfer of the range with the middle of the file is cut halfway the first time
+        with server.lock:
+            cut = server.faults and first <= len(content) // 2 <= last and self.path not in server.cut_files
+            if cut:
+                server.cut_files.add(self.path)
+        end = first + (last - first + 1) // 2 if cut else last + 1
+        chunk_size = 64 * 1024
+        for start in range(first, end, chunk_size):
+            self.wfile.write(content[start:min(start + chunk_size, end)])
+            time.sleep(min(chunk_size, end - start) / server.bandwidth)
+        if cut:
+            self.close_connection = True  # the client sees an incomplete response
+
+    def log_message(self, format, *args):
+        pass
+
+
+def run(server, links, download_dir, workers):
+    """
+    Download every link with a manager whose resolver points to the stand-in server
+    :return: seconds, dictionary of links and downloaded paths, list of DownloadErrors
+    """
+    def resolver(url):
+        name = url.rsplit("=", 1)[1]
+        size = len(server.files[name]) if name in server.files else None
+        return server.url + name, ".webm", size
+
+    manager = DownloadManager(download_dir, resolver=resolver, max_workers=workers, retry_delay=0.1,
+                              range_size=1024 ** 2)
+    start = time.perf_counter()
+    paths = {}
+    errors = []
+    for url, path, error in manager.download_many(links):
+        if error is None:
+            paths[url] = path
+        else:
+            errors.append(error)
+    return time.perf_counter() - start, paths, errors
+
+
+def main(n_songs=8, song_size=4 * 1024 ** 2, workers=4, latency=0.1, bandwidth=4 * 1024 ** 2, faults=False):
+    rng = np.random.default_rng(0)
+    files = {f"song{index:07d}": rng.bytes(song_size) for index in range(n_songs)}
+    links = [f"https://www.youtube.com/watch?v={name}" for name in files]
+    print(f"{n_songs} songs of {song_size / 1024 ** 2:.1f} MB, {latency * 1000:.0f} ms latency, "
+          f"{bandwidth / 1024 ** 2:.1f} MB/s per connection{', first transfers cut halfway' if faults else ''}")
+
+    for n_workers in [1, workers]:
+        server = StandInServer(files, latency=latency, bandwidth=bandwidth, faults=faults)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        with tempfile.TemporaryDirectory() as download_dir:
+            seconds, paths, errors = run(server, links, download_dir, n_workers)
+            intact = all(open(paths[link], "rb").read() == files[link.rsplit("=", 1)[1]] for link in paths)
+            print(f"{n_workers} at a time: {seconds:.2f} s, {len(paths)} downloaded, {len(errors)} failed, "
+                  f"{server.requests} requests, files intact: {intact}")
+            # everything is cached now
+            start = time.perf_counter()
+            run(server, links, download_dir, n_workers)
+            print(f"  again from the cache: {time.perf_counter() - start:.3f} s")
+        server.shutdown()
+
+    server = StandInServer(files, latency=0, bandwidth=bandwidth)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    with tempfile.TemporaryDirectory() as download_dir:
+        _, _, errors = run(server, ["https://www.youtube.com/watch?v=missing0000"], download_dir, 1)
+        print(f"missing song: {errors[0].as_dict()}")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the download manager against a local HTTP server")
+    parser.add_argument("--songs", type=int, default=8,
+                        help="Number of songs to download")
+    parser.add_argument("--size", type=float, default=4,
+                        help="Size of every song in MB")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of songs downloaded at the same time")
+    parser.add_argument("--latency", type=float, default=0.1,
+                        help="Seconds before every response of the server")
+    parser.add_argument("--bandwidth", type=float, default=4,
+                        help="MB per second of every connection to the server")
+    parser.add_argument("--faults", action="store_true",
+                        help="Cut the first transfer of every song halfway")
+    arguments = parser.parse_args()
+    main(n_songs=arguments.songs, song_size=int(arguments.size * 1024 ** 2), workers=arguments.workers,
+         latency=arguments.latency, bandwidth=arguments.bandwidth * 1024 ** 2, faults=arguments.faults)
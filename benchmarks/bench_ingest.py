@@ -0,0 +1,83 @@
+"""
+Benchmark of the ingest of a downloaded song (game/utils/ingest.py) against the previous path, which transcoded the
+download to MP3 with ffmpeg and decoded the MP3 again for the analysis.
+Downloads are simulated with a stand-in downloader that copies a local file, so no network access is needed.
+
+Run from the repository root (needs the ffmpeg binary):
+    python -m benchmarks.bench_ingest --file song.m4a
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import ffmpeg
+import librosa
+import numpy as np
+import soundfile
+
+from benchmarks.bench_analysis import synthetic_song
+from game.utils import notedetection
+from game.utils.ingest import ingest_download, write_analysis_pcm
+
+
+def copying_downloader(filename):
+    """
+    Stand-in for youtubeDL.download_youtube_stream that "downloads" a local file by copying it
+    """
+    return lambda url, output_path: shutil.copy(filename, output_path)
+
+
+def legacy_ingest(downloaded_path, work_dir, sr=22050):
+    """
+    Transcode the download to MP3, then decode the MP3 for the analysis
+    """
+    mp3_path = os.path.join(work_dir, "legacy.mp3")
+    ffmpeg.input(downloaded_path).output(mp3_path).run(quiet=True)
+    x, _ = librosa.load(mp3_path, sr=sr)
+    return mp3_path, x
+
+
+def direct_ingest(filename, work_dir, sr=22050):
+    """
+    Decode the download once through a pipe into the played WAV file and the analysis input
+    """
+    audio_path = os.path.join(work_dir, "direct.wav")
+    pcm_path = os.path.join(work_dir, "direct.pcm")
+    decoded = ingest_download("stand-in", audio_path, downloader=copying_downloader(filename))
+    write_analysis_pcm(pcm_path, *decoded, sr)
+    x, _ = notedetection.load_audio(audio_path, sr=sr, pcm_path=pcm_path)
+    return audio_path, x
+
+
+def main(filename):
+    with tempfile.TemporaryDirectory() as work_dir:
+        downloaded_path = shutil.copy(filename, os.path.join(work_dir, "download" + os.path.splitext(filename)[1]))
+        start = time.perf_counter()
+        legacy_path, legacy_x = legacy_ingest(downloaded_path, work_dir)
+        legacy_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        direct_path, direct_x = direct_ingest(filename, work_dir)
+        direct_time = time.perf_counter() - start
+
+        print(f"{'path':<8} {'time (s)':>9} {'played file (MB)':>17} {'analysed samples':>17}")
+        for name, duration, path, x in [("legacy", legacy_time, legacy_path, legacy_x),
+                                        ("direct", direct_time, direct_path, direct_x)]:
+            print(f"{name:<8} {duration:>9.2f} {os.path.getsize(path) / 1024 ** 2:>17.1f} {len(x):>17}")
+        print(f"speedup {legacy_time / direct_time:.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the ingest of a downloaded song")
+    parser.add_argument("--file", type=str, default=None,
+                        help="Audio file standing in for the download (default: a synthetic song as FLAC)")
+    arguments = parser.parse_args()
+    if arguments.file is not None:
+        main(arguments.file)
+    else:
+        with tempfile.TemporaryDirectory() as song_dir:
+            song_path = os.path.join(song_dir, "synthetic.flac")
+            soundfile.write(song_path, synthetic_song(120).astype(np.float32), 22050)
+            main(song_path)
@@ -0,0 +1,98 @@
+"""
+Benchmark of the live onset detector (game/utils/live.py), fed offline with the blocks of a synthetic song or of an
+audio file, either as fast as possible or at the pace of real time.
+Reports the processing time of every block against its real-time budget, the time from an onset until it is reported,
+and how well the onsets agree with the analysis of the whole signal at once (librosa onset detection on the same
+onset strength as notedetection).
+
+Run from the repository root:
+    python -m benchmarks.bench_live
+    python -m benchmarks.bench_live --file song.mp3 --block-size 256 --real-time
+"""
+import argparse
+import time
+
+import librosa
+import numpy as np
+
+from benchmarks.bench_analysis import synthetic_song
+from benchmarks.metrics import onset_f_measure
+from game.utils import notedetection
+from game.utils.features import FeatureStore
+from game.utils.live import LiveOnsetDetector
+
+
+def feed(x, sr, block_size=512, real_time=False):
+    """
+    Push a signal block by block into a live onset detector
+    :param x: audio signal
+    :param sr: sampling rate
+    :param block_size: number of samples per block
+    :param real_time: wait for every block to be due, as if it came from an audio callback
+    :return: the detector, onset times, detection delays in seconds
+    """
+    detector = LiveOnsetDetector(sr)
+    onset_times = []
+    delays = []
+    start = time.perf_counter()
+    for block_start in range(0, len(x), block_size):
+        if real_time:
+            time.sleep(max(block_start / sr - (time.perf_counter() - start), 0))
+        onsets = detector.push(x[block_start:block_start + block_size])
+        onset_times.extend(onsets)
+        delays.extend(detector.n_samples / sr - onsets)
+    onset_times.extend(detector.finish())
+    return detector, np.array(onset_times), np.array(delays)
+
+
+def offline_onsets(x, sr):
+    """
+    Onsets and durations of the whole signal, as the background branch of notedetection.onset_detection finds them
+    before noise removal, merging and rounding
+    """
+    features = FeatureStore(x, sr)
+    onset_frames = librosa.onset.onset_detect(onset_envelope=features.onset_envelope(), sr=sr)
+    y = features.magnitude(n_fft=1024, hop_length=512, center=False)
+    onset_durations = notedetection.onset_length_detection(x, y, librosa.frames_to_samples(onset_frames), sr=sr)
+    return librosa.frames_to_time(onset_frames, sr=sr), onset_durations
+
+
+def main(x, sr, block_size=512, real_time=False):
+    detector, onset_times, delays = feed(x, sr, block_size=block_size, real_time=real_time)
+    latencies = np.array(detector.block_latencies) * 1000
+    budget = block_size / sr * 1000
+    print(f"{len(x) / sr:.1f} s of audio in blocks of {block_size} samples ({budget:.1f} ms each)")
+    print(f"processing per block (ms): median {np.median(latencies):.3f}, 95% {np.percentile(latencies, 95):.3f}, "
+          f"99% {np.percentile(latencies, 99):.3f}, max {latencies.max():.3f}; "
+          f"{np.sum(latencies > budget)} blocks over budget")
+    if len(delays):
+        print(f"onset reported after (ms): median {np.median(delays) * 1000:.1f}, max {delays.max() * 1000:.1f} "
+              f"(detector latency {detector.latency * 1000:.1f} plus block size)")
+
+    reference_times, reference_durations = offline_onsets(x, sr)
+    precision, recall, f_measure = onset_f_measure(reference_times, onset_times, tolerance=0.001)
+    print(f"onsets: {len(onset_times)} live, {len(reference_times)} offline; within 1 ms: precision {precision:.3f}, "
+          f"recall {recall:.3f}, F-measure {f_measure:.3f}")
+    note_times, note_durations = detector.pop_notes()
+    _, live_index, reference_index = np.intersect1d(np.round(note_times, 6), np.round(reference_times, 6),
+                                                    return_indices=True)
+    same_duration = np.isclose(note_durations[live_index], reference_durations[reference_index])
+    print(f"durations identical for {np.mean(same_duration) * 100:.1f}% of the common onsets")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the live onset detector")
+    parser.add_argument("--file", type=str, default=None,
+                        help="Audio file to feed (default: a synthetic song)")
+    parser.add_argument("--duration", type=float, default=60,
+                        help="Length of the synthetic song in seconds")
+    parser.add_argument("--block-size", type=int, default=512,
+                        help="Number of samples per pushed block")
+    parser.add_argument("--real-time", action="store_true",
+                        help="Feed the blocks at the pace of real time rather than as fast as possible")
+    arguments = parser.parse_args()
+    if arguments.file is not None:
+        signal, sampling_rate = librosa.load(arguments.file, sr=22050)
+    else:
+        signal, sampling_rate = synthetic_song(arguments.duration).astype(np.float32), 22050
+    main(signal, sampling_rate, block_size=arguments.block_size, real_time=arguments.real_time)
@@ -0,0 +1,65 @@
+"""
+Micro-benchmark of notedetection.merge_close_onset against the previous implementation, which deleted merged onsets
+from the arrays one at a time.
+
+Run from the repository root:
+    python -m benchmarks.bench_merge_close_onset
+"""
+import time
+
+import numpy as np
+
+from game.utils.notedetection import merge_close_onset
+
+
+def legacy_merge_close_onset(onset_times, onset_durations, tempo, precision=0.125):
+    i = 0
+    length = len(onset_times)
+    while i < length - 1:
+        if abs(onset_times[i + 1] - onset_times[i]) <= precision:
+            onset_durations[i] = max(onset_times[i] + onset_durations[i], onset_times[i + 1] + onset_durations[i + 1]) - \
+                                 onset_times[i]
+            onset_times = np.delete(onset_times, i + 1)
+            onset_durations = np.delete(onset_durations, i + 1)
+            length -= 1
+        else:
+            i += 1
+    return onset_times, onset_durations
+
+
+def dense_onsets(n, seed=0):
+    """
+    Onsets about as dense as a fast song, so that roughly a third of them are close enough to be merged
+    """
+    rng = np.random.default_rng(seed)
+    onset_times = np.cumsum(rng.exponential(0.2, size=n))
+    onset_durations = rng.uniform(0.05, 0.5, size=n)
+    return onset_times, onset_durations
+
+
+def best_time(function, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        copies = [np.copy(arg) if isinstance(arg, np.ndarray) else arg for arg in args]
+        start = time.perf_counter()
+        function(*copies)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    tempo = 120
+    print(f"{'onsets':>8} {'legacy (s)':>12} {'vectorized (s)':>15} {'speedup':>9}  identical")
+    for n in [1000, 3000, 10000, 30000, 100000]:
+        onset_times, onset_durations = dense_onsets(n)
+        expected = legacy_merge_close_onset(onset_times.copy(), onset_durations.copy(), tempo)
+        result = merge_close_onset(onset_times, onset_durations, tempo)
+        identical = all(np.array_equal(a, b) for a, b in zip(expected, result))
+
+        legacy = best_time(legacy_merge_close_onset, onset_times, onset_durations, tempo, repeat=1)
+        vectorized = best_time(merge_close_onset, onset_times, onset_durations, tempo)
+        print(f"{n:>8} {legacy:>12.4f} {vectorized:>15.5f} {legacy / vectorized:>8.0f}x  {identical}")
+
+
+if __name__ == '__main__':
+    main()
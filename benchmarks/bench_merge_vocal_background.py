@@ -0,0 +1,79 @@
+"""
+Micro-benchmark of notedetection.merge_vocal_background against the previous implementation, which merged the two
+streams one onset at a time with two pointers.
+
+Run from the repository root:
+    python -m benchmarks.bench_merge_vocal_background
+"""
+import time
+
+import numpy as np
+
+from game.utils.notedetection import merge_vocal_background
+
+
+def legacy_merge_vocal_background(vocal_onset, vocal_duration, background_onset, background_duration):
+    merge_onset = []
+    merge_duration = []
+    merge_label = []
+    l1 = vocal_onset.shape[0]
+    l2 = background_onset.shape[0]
+    i = j = 0
+    while i < l1 and j < l2:
+        if vocal_onset[i] <= background_onset[j]:
+            merge_onset.append(vocal_onset[i])
+            merge_duration.append(vocal_duration[i])
+            merge_label.append(1)
+            i += 1
+        else:
+            merge_onset.append(background_onset[j])
+            merge_duration.append(background_duration[j])
+            merge_label.append(0)
+            j += 1
+    while i < l1:
+        merge_onset.append(vocal_onset[i])
+        merge_duration.append(vocal_duration[i])
+        merge_label.append(1)
+        i += 1
+    while j < l2:
+        merge_onset.append(background_onset[j])
+        merge_duration.append(background_duration[j])
+        merge_label.append(0)
+        j += 1
+    return merge_onset, merge_duration, merge_label
+
+
+def rounded_onsets(n, seed=0):
+    """
+    Onsets rounded to a 1/8 beat grid at 120 BPM as after onset_roundings, so that both streams share many times
+    """
+    rng = np.random.default_rng(seed)
+    onset_times = np.cumsum(rng.integers(1, 8, size=n)) * 0.0625
+    onset_durations = rng.uniform(0.05, 0.5, size=n)
+    return onset_times, onset_durations
+
+
+def best_time(function, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print(f"{'onsets':>8} {'legacy (s)':>12} {'vectorized (s)':>15} {'speedup':>9}  identical")
+    for n in [1000, 3000, 10000, 30000, 100000]:
+        streams = (*rounded_onsets(n, seed=0), *rounded_onsets(n, seed=1))
+        expected = legacy_merge_vocal_background(*streams)
+        result = merge_vocal_background(*streams)
+        identical = all(np.array_equal(a, b) for a, b in zip(expected, result))
+
+        legacy = best_time(legacy_merge_vocal_background, *streams, repeat=1)
+        vectorized = best_time(merge_vocal_background, *streams)
+        print(f"{2 * n:>8} {legacy:>12.4f} {vectorized:>15.5f} {legacy / vectorized:>8.0f}x  {identical}")
+
+
+if __name__ == '__main__':
+    main()
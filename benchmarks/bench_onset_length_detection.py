@@ -0,0 +1,94 @@
+"""
+Benchmark of notedetection.onset_length_detection against the previous implementation, which advanced every onset one
+frame per iteration and compared full spectra for all onsets, including the ones that had already ended.
+
+Run from the repository root:
+    python -m benchmarks.bench_onset_length_detection
+"""
+import time
+
+import librosa
+import numpy as np
+from scipy.special import rel_entr
+
+from benchmarks.synthetic import dense_track
+from game.utils.notedetection import onset_length_detection
+
+
+def legacy_onset_length_detection(x, y, onset_samples, fft_length=1024, fft_hop_length=512, sr=22050, tolerance=6,
+                                  use_max_freq_peak=False, use_max_freq_amp=False, use_mean_square=False):
+    residual_size = fft_length - fft_hop_length
+    filtered_onset_samples = onset_samples
+    filtered_onset_samples[onset_samples < fft_length] = fft_length - residual_size
+    onset_frame_indices = (filtered_onset_samples - fft_length) // residual_size + 1
+
+    onset_frame = y[:, onset_frame_indices]
+    length_sum = np.ones((onset_samples.shape[0]))
+    valid_mask = np.ones((onset_samples.shape[0])).astype(bool)
+    old_peaks = np.argmax(onset_frame, axis=0)
+    old_amplitude = np.max(onset_frame, axis=0)
+    number_of_frames = y.shape[1]
+
+    temp_indices = onset_frame_indices + 1
+    satisfaction = temp_indices < number_of_frames
+    valid_mask = np.logical_and(valid_mask, satisfaction)
+    temp_indices[~satisfaction] = number_of_frames - 1
+
+    old_frame = onset_frame
+    while valid_mask.sum() > 0:
+        new_onset_frame = y[:, temp_indices]
+        new_peaks = np.argmax(new_onset_frame, axis=0)
+        new_amplitude = np.max(new_onset_frame, axis=0)
+        diff = sum(rel_entr(old_frame, new_onset_frame))
+        satisfaction = np.ones((onset_samples.shape[0]))
+        satisfaction = np.logical_and(satisfaction, diff >= -2)
+        if use_mean_square:
+            diff = np.mean((old_frame - new_onset_frame) ** 2, axis=0)
+            satisfaction = np.logical_and(satisfaction, diff < 1.0)
+        if use_max_freq_peak:
+            satisfaction = np.logical_and(satisfaction, np.abs(new_peaks - old_peaks) <= tolerance)
+        if use_max_freq_amp:
+            satisfaction = np.logical_and(satisfaction, new_amplitude >= old_amplitude / 2)
+        valid_mask = np.logical_and(valid_mask, satisfaction)
+        length_sum += valid_mask
+
+        old_peaks = new_peaks
+        old_frame = new_onset_frame
+        temp_indices += 1
+        satisfaction = temp_indices < number_of_frames
+        valid_mask = np.logical_and(valid_mask, satisfaction)
+        temp_indices[~satisfaction] = number_of_frames - 1
+
+    return length_sum * residual_size / sr
+
+
+def best_time(function, *args, repeat=3, **kwargs):
+    best = float("inf")
+    for _ in range(repeat):
+        copies = [np.copy(arg) for arg in args]
+        start = time.perf_counter()
+        function(*copies, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    sr = 22050
+    print(f"{'track (s)':>9} {'onsets':>7} {'options':>22} {'legacy (s)':>11} {'new (s)':>8} {'speedup':>8}  identical")
+    for duration in [60, 240]:
+        x = dense_track(duration, sr=sr)
+        y = np.abs(librosa.stft(x, n_fft=1024, hop_length=512, center=False))
+        onset_frames = librosa.onset.onset_detect(y=x, sr=sr)
+        onset_samples = librosa.frames_to_samples(onset_frames)
+        for options in [{}, {"use_mean_square": True}, {"use_max_freq_peak": True}, {"use_max_freq_amp": True}]:
+            expected = legacy_onset_length_detection(x, y, onset_samples.copy(), sr=sr, **options)
+            result = onset_length_detection(x, y, onset_samples.copy(), sr=sr, **options)
+            legacy = best_time(legacy_onset_length_detection, x, y, onset_samples, sr=sr, repeat=1, **options)
+            new = best_time(onset_length_detection, x, y, onset_samples, sr=sr, **options)
+            name = ",".join(options) or "default"
+            print(f"{duration:>9} {len(onset_samples):>7} {name:>22} {legacy:>11.3f} {new:>8.3f} "
+                  f"{legacy / new:>7.0f}x  {np.array_equal(expected, result)}")
+
+
+if __name__ == '__main__':
+    main()
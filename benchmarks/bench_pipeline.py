@@ -0,0 +1,87 @@
+"""
+Benchmark of the pipelined ingest (ingest.DecodePipeline), where the streaming analysis (streaming.StreamingOnsetAnalyzer)
+takes the audio block by block while ffmpeg is still decoding the rest of the file, against decoding the whole file
+first and analysing it afterwards. A local file stands in for the downloaded source.
+Reports the decode and analysis times of both, and how much of them overlapped in the pipeline.
+
+Run from the repository root (needs the ffmpeg binary):
+    python -m benchmarks.bench_pipeline --file long_song.mp3
+    python -m benchmarks.bench_pipeline --duration 600 --queue-size 4
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import soundfile
+
+from benchmarks.bench_analysis import synthetic_song
+from game.utils.ingest import DecodePipeline
+from game.utils.streaming import StreamingOnsetAnalyzer
+
+
+def sequential(filename, sr=22050, tempo=None):
+    """
+    Decode the whole file, then analyse it
+    """
+    start = time.perf_counter()
+    blocks = list(DecodePipeline(filename, sr=sr, queue_size=0))  # an unbounded queue, nothing waits on the analysis
+    decode = time.perf_counter() - start
+    analyzer = StreamingOnsetAnalyzer(sr)
+    for block in blocks:
+        analyzer.push(block)
+    music_data = analyzer.finish(tempo=tempo)
+    total = time.perf_counter() - start
+    return music_data, {"decode": decode, "analysis": total - decode, "overlap": 0.0, "total": total}
+
+
+def pipelined(filename, sr=22050, tempo=None, queue_size=16):
+    """
+    Analyse the blocks while the rest of the file is decoded
+    """
+    start = time.perf_counter()
+    pipeline = DecodePipeline(filename, sr=sr, queue_size=queue_size)
+    analyzer = StreamingOnsetAnalyzer(sr)
+    for block in pipeline:
+        analyzer.push(block)
+    music_data = analyzer.finish(tempo=tempo)
+    total = time.perf_counter() - start
+    timings = pipeline.timings
+    # the analysis of the last blocks in finish comes after the pipeline has ended
+    timings["analysis"] += total - timings["total"]
+    timings["total"] = total
+    return music_data, timings
+
+
+def main(filename, queue_size=16, tempo=None):
+    sequential_data, sequential_timings = sequential(filename, tempo=tempo)
+    pipelined_data, pipelined_timings = pipelined(filename, tempo=tempo, queue_size=queue_size)
+    print(f"{'path':<11} {'decode (s)':>11} {'analysis (s)':>13} {'overlap (s)':>12} {'total (s)':>10}")
+    for name, timings in [("sequential", sequential_timings), ("pipelined", pipelined_timings)]:
+        print(f"{name:<11} {timings['decode']:>11.2f} {timings['analysis']:>13.2f} {timings['overlap']:>12.2f} "
+              f"{timings['total']:>10.2f}")
+    print(f"{pipelined_timings['overlap'] / pipelined_timings['decode'] * 100:.0f}% of decoding overlapped the "
+          f"analysis, total time {sequential_timings['total'] / pipelined_timings['total']:.2f}x faster")
+    identical = all(np.array_equal(a, b) for a, b in zip(sequential_data, pipelined_data))
+    print(f"onsets: {len(pipelined_data[0])}, identical to the sequential analysis: {identical}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the pipelined ingest")
+    parser.add_argument("--file", type=str, default=None,
+                        help="Audio file standing in for the downloaded source (default: a synthetic song as FLAC)")
+    parser.add_argument("--duration", type=float, default=300,
+                        help="Length of the synthetic song in seconds")
+    parser.add_argument("--queue-size", type=int, default=16,
+                        help="Number of decoded one second blocks that may wait for the analysis")
+    parser.add_argument("--tempo", type=int, default=None,
+                        help="Song tempo, estimated if not given")
+    arguments = parser.parse_args()
+    if arguments.file is not None:
+        main(arguments.file, queue_size=arguments.queue_size, tempo=arguments.tempo)
+    else:
+        with tempfile.TemporaryDirectory() as song_dir:
+            song_path = os.path.join(song_dir, "synthetic.flac")
+            soundfile.write(song_path, synthetic_song(arguments.duration).astype(np.float32), 22050)
+            main(song_path, queue_size=arguments.queue_size, tempo=arguments.tempo)
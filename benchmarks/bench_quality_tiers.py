@@ -0,0 +1,46 @@
+"""
+Benchmark of the analysis quality tiers of notedetection.process_audio (notedetection.QUALITY_TIERS).
+Analyses synthetic songs of tone bursts with known start times over a click track and a noise bed, and reports the
+analysis time of every tier with its onset accuracy against the tone starts and its agreement with the accurate tier.
+
+Run from the repository root:
+    python -m benchmarks.bench_quality_tiers
+"""
+import os
+import tempfile
+import time
+
+import soundfile
+
+from benchmarks.metrics import onset_f_measure
+from benchmarks.synthetic import click_track, noise_bed, tone_bursts
+from game.utils import notedetection
+
+
+def main(durations=(60, 180), tiers=("fast", "balanced", "accurate")):
+    sr = 22050
+    print(f"{'song (s)':>8} {'tier':>9} {'time (s)':>9} {'speedup':>8} {'onsets':>7} {'F (tones)':>10} "
+          f"{'F (accurate)':>13}")
+    for duration in durations:
+        y, tone_times, _ = tone_bursts(duration, sr=sr, return_notes=True)
+        y = y + 0.5 * click_track(duration, sr=sr) + noise_bed(duration, sr=sr)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "song.wav")
+            soundfile.write(filename, y, sr)
+            results = {}
+            for tier in tiers:
+                start = time.perf_counter()
+                onset_times, *_ = notedetection.process_audio(filename, quality=tier)
+                results[tier] = (onset_times, time.perf_counter() - start)
+
+        accurate_times, accurate_time = results.get("accurate", (None, None))
+        for tier in tiers:
+            onset_times, elapsed = results[tier]
+            speedup = f"{accurate_time / elapsed:.1f}x" if accurate_time else "-"
+            agreement = f"{onset_f_measure(accurate_times, onset_times)[2]:.3f}" if accurate_times is not None else "-"
+            print(f"{duration:>8} {tier:>9} {elapsed:>9.2f} {speedup:>8} {len(onset_times):>7} "
+                  f"{onset_f_measure(tone_times, onset_times)[2]:>10.3f} {agreement:>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Benchmark of the start up time of the game: the wall time from launching a new Python process to the first rendered
+menu frame. The game runs with the SDL dummy video and audio drivers, so that it needs no display or sound card.
+Also lists the analysis and download modules that were imported before the menu appeared; they are imported lazily when
+a song is loaded, so there should be none.
+
+Run from the repository root:
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --repeat 10 --max-seconds 2
+The exit status is 1 when the median start up time exceeds --max-seconds or a heavy module is imported at start up, so
+that it can guard against regressions.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# modules that take seconds to import and are only needed to download and analyse songs
+HEAVY_MODULES = ("librosa", "scipy", "numba", "sklearn", "pytube", "ffmpeg")
+# printed by the game process once the first menu frame is rendered
+FRAME_MARKER = "FIRST MENU FRAME"
+
+
+def first_menu_frame():
+    """
+    Start the game as main.py does, render the first menu frame and report it on stdout, in the child process
+    """
+    import main  # command line parsing, as the game is started through main.py
+    from game.game import Game
+
+    analysis_options = {"progressive": None, "profile": None, "profile_memory": False, "quality": "accurate",
+                        "dual_stream": False}
+    settings = "https://www.youtube.com/watch?v=-LwBbLa_Vhc", 777, None, 5, 10, True, analysis_options
+    game = Game(settings)
+    game.menu_scene.render()
+    heavy_modules = [name for name in HEAVY_MODULES if name in sys.modules]
+    print(FRAME_MARKER, json.dumps(heavy_modules), flush=True)
+    game.close()
+
+
+def measure_startup():
+    """
+    Launch the game in a new process and wait for its first menu frame
+    :return: time to the first menu frame in seconds, heavy modules imported by then
+    """
+    environment = dict(os.environ, SDL_VIDEODRIVER="dummy", SDL_AUDIODRIVER="dummy", PYGAME_HIDE_SUPPORT_PROMPT="1")
+    command = [sys.executable, "-c", "from benchmarks.bench_startup import first_menu_frame; first_menu_frame()"]
+    start = time.perf_counter()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True, env=environment)
+    elapsed, heavy_modules = None, None
+    for line in process.stdout:
+        if line.startswith(FRAME_MARKER):
+            elapsed = time.perf_counter() - start
+            heavy_modules = json.loads(line[len(FRAME_MARKER):])
+    if process.wait() != 0 or elapsed is None:
+        raise RuntimeError(f"the game exited with status {process.returncode} before rendering the menu")
+    return elapsed, heavy_modules
+
+
+def main(repeat=5, max_seconds=None):
+    """
+    :param repeat: number of game launches
+    :param max_seconds: largest acceptable median start up time, not checked if None
+    :return: True if the start up time and imports are acceptable
+    """
+    times = []
+    heavy_modules = []
+    for _ in range(repeat):
+        elapsed, heavy_modules = measure_startup()
+        times.append(elapsed)
+    median = statistics.median(times)
+    print(f"time to first menu frame: median {median:.3f} s, best {min(times):.3f} s, worst {max(times):.3f} s "
+          f"over {repeat} launches")
+    print("heavy modules imported at start up:", ", ".join(heavy_modules) if heavy_modules else "none")
+
+    passed = not heavy_modules
+    if max_seconds is not None and median > max_seconds:
+        print(f"start up is slower than {max_seconds:g} s")
+        passed = False
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the time to the first menu frame of the game")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of game launches")
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="Fail if the median time to the first menu frame exceeds this")
+    arguments = parser.parse_args()
+    sys.exit(0 if main(arguments.repeat, arguments.max_seconds) else 1)
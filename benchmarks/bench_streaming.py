@@ -0,0 +1,154 @@
+"""
+Accuracy check of the block by block analysis (streaming.StreamingOnsetAnalyzer) against the in-memory analysis
+(notedetection.onset_detection) with the balanced tier settings, which it reproduces. Fails (exit status 1) unless
+every block size finds the same number of onsets as the in-memory analysis, with every onset within 2 ms of the
+in-memory one. Also reports how far both are from the accurate tier, whose separation searches the whole song.
+
+The progressive analysis (streaming.progressive_onset_detection, --progressive in the game) hands out segments before
+the rest of the song is analysed, so their rounding grid is aligned with the onsets analysed so far rather than with
+the whole song. It is compared with the in-memory analysis at the same tempo, and fails unless it finds the same onsets
+with the same durations, each less than one rounding step (an eighth of a beat) from the in-memory one.
+
+Run from the repository root:
+    python -m benchmarks.bench_streaming
+    python -m benchmarks.bench_streaming --duration 300 --blocks 5 15 30 --dual-stream
+    python -m benchmarks.bench_streaming --file long_song.mp3
+    python -m benchmarks.bench_streaming --duration 120 --blocks 30 --progressive 10 30 --no-accurate
+"""
+import argparse
+import sys
+import time
+
+import librosa
+import numpy as np
+
+from benchmarks.bench_analysis import synthetic_song
+from benchmarks.metrics import match_onsets, onset_f_measure
+from game.utils import notedetection
+from game.utils.streaming import StreamingOnsetAnalyzer, progressive_onset_detection
+
+TOLERANCE = 0.002  # largest allowed difference of an onset time in seconds
+
+
+def in_memory(x, sr, quality="balanced", dual_stream=False, tempo=None):
+    settings = dict(notedetection.QUALITY_TIERS[quality])
+    del settings["sr"]
+    start = time.perf_counter()
+    music_data = notedetection.onset_detection(x, sr, tempo=tempo, dual_stream=dual_stream, **settings)
+    return music_data, time.perf_counter() - start
+
+
+def streamed(x, sr, block_duration, dual_stream=False):
+    start = time.perf_counter()
+    analyzer = StreamingOnsetAnalyzer(sr, block_duration=block_duration, dual_stream=dual_stream)
+    for block_start in range(0, len(x), sr):
+        analyzer.push(x[block_start:block_start + sr])
+    music_data = analyzer.finish()
+    return music_data, time.perf_counter() - start
+
+
+def progressive(x, sr, segment_duration):
+    start = time.perf_counter()
+    parts = list(progressive_onset_detection(None, segment_duration=segment_duration,
+                                             blocks=(x[i:i + sr] for i in range(0, len(x), sr))))
+    music_data = tuple(np.concatenate([part[index] for part, _ in parts]) for index in range(3)) + (parts[0][0][3],)
+    return music_data, time.perf_counter() - start
+
+
+def progressive_difference(reference, music_data):
+    """
+    :return: largest time difference and largest duration difference in seconds of the onsets, which are compared one
+    by one, and share of the onsets within TOLERANCE of the reference, None if the numbers of onsets differ
+    """
+    if len(music_data[0]) != len(reference[0]):
+        return None, None, None
+    time_differences = np.abs(reference[0] - music_data[0])
+    duration_difference = np.max(np.abs(reference[1] - music_data[1]), initial=0)
+    return np.max(time_differences, initial=0), duration_difference, np.mean(time_differences <= TOLERANCE)
+
+
+def difference(reference, music_data):
+    """
+    :return: number of onsets, share of the reference onsets matched within TOLERANCE, largest time difference of the
+    matched onsets and largest duration difference of the matched onsets in seconds
+    """
+    reference_indices, indices = match_onsets(reference[0], music_data[0], tolerance=TOLERANCE)
+    matched = len(reference_indices) / max(len(reference[0]), 1)
+    if len(indices) == 0:
+        return len(music_data[0]), matched, None, None
+    time_difference = np.max(np.abs(reference[0][reference_indices] - music_data[0][indices]))
+    duration_difference = np.max(np.abs(reference[1][reference_indices] - music_data[1][indices]))
+    return len(music_data[0]), matched, time_difference, duration_difference
+
+
+def main(x, sr, block_durations=(5.0, 15.0, 30.0), dual_stream=False, accurate=True, progressive_durations=(15.0, 30.0)):
+    reference, seconds = in_memory(x, sr, dual_stream=dual_stream)
+    print(f"{'analysis':<18} {'onsets':>7} {'within 2 ms':>12} {'max dt (ms)':>12} {'max ddur (ms)':>14} {'time (s)':>9}")
+    print(f"{'in memory':<18} {len(reference[0]):>7} {'':>12} {'':>12} {'':>14} {seconds:>9.2f}")
+    failures = []
+    for block_duration in block_durations:
+        music_data, seconds = streamed(x, sr, block_duration, dual_stream=dual_stream)
+        n_onsets, matched, time_difference, duration_difference = difference(reference, music_data)
+        print(f"{f'{block_duration:g} s blocks':<18} {n_onsets:>7} {matched * 100:>11.1f}% "
+              f"{'-' if time_difference is None else f'{time_difference * 1000:.2f}':>12} "
+              f"{'-' if duration_difference is None else f'{duration_difference * 1000:.2f}':>14} {seconds:>9.2f}")
+        if n_onsets != len(reference[0]) or matched < 1:
+            failures.append(f"{block_duration:g} s blocks: {n_onsets} onsets, {matched * 100:.1f}% within 2 ms")
+        if dual_stream:
+            reference_indices, indices = match_onsets(reference[0], music_data[0], tolerance=TOLERANCE)
+            if not np.array_equal(reference[4][reference_indices], music_data[4][indices]):
+                failures.append(f"{block_duration:g} s blocks: vocal and background labels differ")
+    for segment_duration in progressive_durations:
+        music_data, seconds = progressive(x, sr, segment_duration)
+        tempo = np.ravel(music_data[3])[0]
+        step = 60 / tempo * 0.125
+        # the tempo of a progressive map is estimated from the first segment, the rounding is compared at that tempo
+        same_tempo = in_memory(x, sr, tempo=music_data[3])[0]
+        time_difference, duration_difference, matched = progressive_difference(same_tempo, music_data)
+        print(f"{f'{segment_duration:g} s progressive':<18} {len(music_data[0]):>7} "
+              f"{'-' if matched is None else f'{matched * 100:.1f}%':>12} "
+              f"{'-' if time_difference is None else f'{time_difference * 1000:.2f}':>12} "
+              f"{'-' if duration_difference is None else f'{duration_difference * 1000:.2f}':>14} {seconds:>9.2f}")
+        print(f"{'':<18} tempo {tempo:g} (whole song: {np.ravel(reference[3])[0]:g}), rounding step "
+              f"{step * 1000:.1f} ms")
+        if time_difference is None or time_difference >= step or duration_difference > TOLERANCE:
+            failures.append(f"{segment_duration:g} s progressive: {len(music_data[0])} onsets against "
+                            f"{len(same_tempo[0])}, not all within one rounding step with the same durations")
+    if accurate:
+        accurate_data, seconds = in_memory(x, sr, quality="accurate", dual_stream=dual_stream)
+        # the rounding grids of the tiers may have different phases, so onsets are compared within 50 ms
+        _, _, f_measure = onset_f_measure(accurate_data[0], reference[0])
+        print(f"accurate tier: {len(accurate_data[0])} onsets in {seconds:.2f} s, F-measure of the balanced tier "
+              f"against it {f_measure:.3f} (50 ms)")
+
+    for failure in failures:
+        print("FAILED", failure)
+    if not failures:
+        print("The block by block analysis is within 2 ms of the in-memory analysis with the balanced tier, "
+              "the progressive analysis within one rounding step")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare the block by block analysis with the in-memory analysis")
+    parser.add_argument("--file", type=str, default=None,
+                        help="Audio file to analyse (default: a synthetic click, tone and noise track)")
+    parser.add_argument("--duration", type=float, default=60,
+                        help="Length of the synthetic track in seconds")
+    parser.add_argument("--blocks", type=float, nargs="+", default=[5, 15, 30],
+                        help="Block durations in seconds, blocks shorter than half the separation window of the "
+                             "balanced tier check the start and end of the song")
+    parser.add_argument("--progressive", type=float, nargs="*", default=[15, 30],
+                        help="Segment durations of the progressive analysis in seconds, none to skip it")
+    parser.add_argument("--dual-stream", action="store_true",
+                        help="Also compare the background onsets")
+    parser.add_argument("--no-accurate", action="store_true",
+                        help="Do not analyse the song with the accurate tier")
+    arguments = parser.parse_args()
+    sr = notedetection.QUALITY_TIERS["balanced"]["sr"]
+    if arguments.file is not None:
+        x, _ = librosa.load(arguments.file, sr=sr)
+    else:
+        x = synthetic_song(arguments.duration, sr=sr).astype(np.float32)
+    sys.exit(main(x, sr, block_durations=arguments.blocks, dual_stream=arguments.dual_stream,
+                  accurate=not arguments.no_accurate, progressive_durations=arguments.progressive))
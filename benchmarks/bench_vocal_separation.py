@@ -0,0 +1,66 @@
+"""
+Benchmark of the exact and windowed nearest neighbour search in the vocal separation.
+Reports runtime and peak memory against the song length, and the quality of the windowed vocal mask as its
+signal to noise ratio against the exact mask and of the vocals against the melody of the synthetic track.
+
+Run from the repository root:
+    python -m benchmarks.bench_vocal_separation
+"""
+import time
+import tracemalloc
+
+import librosa
+import numpy as np
+
+from benchmarks.synthetic import repeating_track
+from game.utils.notedetection import separation_masks
+
+
+def measure(S_full, sr, window):
+    """
+    Runtime and peak traced memory of the separation masks, measured in separate runs as tracing slows numpy down
+    """
+    start = time.perf_counter()
+    mask_v, _ = separation_masks(S_full, sr, window=window)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    separation_masks(S_full, sr, window=window)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return mask_v, elapsed, peak
+
+
+def snr(reference, estimate):
+    """
+    Signal to noise ratio in dB of an estimate against a reference
+    """
+    return 10 * np.log10(np.sum(reference ** 2) / max(np.sum((reference - estimate) ** 2), 1e-12))
+
+
+def main(durations=(60, 120, 240, 480), windows=(30, 60), max_exact_duration=240):
+    """
+    The mask SNR compares the windowed vocal mask with the exact one. As the exact search picks an arbitrary subset of
+    the equally similar frames of a repeating background, it is complemented by the vocal SNR, which compares the
+    masked spectrogram of each search with the spectrogram of the melody that the synthetic track was made with.
+    """
+    sr = 22050
+    print(f"{'song (s)':>8} {'window (s)':>10} {'time (s)':>9} {'peak MB':>8} {'mask SNR (dB)':>14} "
+          f"{'vocal SNR (dB)':>15}")
+    for duration in durations:
+        y, melody = repeating_track(duration, sr=sr, return_melody=True)
+        S_full = np.abs(librosa.stft(y))
+        S_melody = np.abs(librosa.stft(melody))
+        exact = None
+        if duration <= max_exact_duration:
+            exact, elapsed, peak = measure(S_full, sr, None)
+            print(f"{duration:>8} {'exact':>10} {elapsed:>9.2f} {peak / 1e6:>8.0f} {'-':>14} "
+                  f"{snr(S_melody, exact * S_full):>15.1f}")
+        for window in windows:
+            mask_v, elapsed, peak = measure(S_full, sr, window)
+            mask_snr = f"{snr(exact, mask_v):.1f}" if exact is not None else "-"
+            print(f"{duration:>8} {window:>10} {elapsed:>9.2f} {peak / 1e6:>8.0f} {mask_snr:>14} "
+                  f"{snr(S_melody, mask_v * S_full):>15.1f}")
+
+
+if __name__ == '__main__':
+    main()
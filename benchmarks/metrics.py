@@ -0,0 +1,73 @@
+"""
+Accuracy measures of the analysis output against a reference.
+"""
+import numpy as np
+
+
+def match_onsets(reference_times, estimated_times, tolerance=0.05):
+    """
+    Pair estimated onsets with reference onsets within the tolerance, in time order, so that every onset is in at most
+    one pair
+    :param reference_times: reference onset times in seconds
+    :param estimated_times: estimated onset times in seconds
+    :param tolerance: largest allowed time difference in seconds
+    :return: indices of the paired reference onsets and of the estimated onsets they are paired with
+    """
+    reference_order = np.argsort(reference_times, kind="stable")
+    estimated_order = np.argsort(estimated_times, kind="stable")
+    reference_times = np.asarray(reference_times)[reference_order]
+    estimated_times = np.asarray(estimated_times)[estimated_order]
+    reference_indices, estimated_indices = [], []
+    i = j = 0
+    while i < len(reference_times) and j < len(estimated_times):
+        difference = estimated_times[j] - reference_times[i]
+        if abs(difference) <= tolerance:
+            reference_indices.append(reference_order[i])
+            estimated_indices.append(estimated_order[j])
+            i += 1
+            j += 1
+        elif difference < 0:
+            j += 1
+        else:
+            i += 1
+    return np.array(reference_indices, dtype=int), np.array(estimated_indices, dtype=int)
+
+
+def onset_f_measure(reference_times, estimated_times, tolerance=0.05):
+    """
+    Precision, recall and F-measure of estimated onsets, where an estimated onset is correct if it lies within the
+    tolerance of a reference onset that no other estimated onset has been matched to
+    :param reference_times: reference onset times in seconds
+    :param estimated_times: estimated onset times in seconds
+    :param tolerance: largest allowed time difference in seconds
+    :return: precision, recall, F-measure
+    """
+    matches = len(match_onsets(reference_times, estimated_times, tolerance=tolerance)[0])
+    precision = matches / len(estimated_times) if len(estimated_times) else 0.0
+    recall = matches / len(reference_times) if len(reference_times) else 0.0
+    f_measure = 2 * precision * recall / (precision + recall) if matches else 0.0
+    return precision, recall, f_measure
+
+
+def timing_errors(reference_times, estimated_times, reference_durations=None, estimated_durations=None,
+                  tolerance=0.05):
+    """
+    Mean absolute onset time error and duration error of the estimated onsets paired with reference onsets, see
+    match_onsets
+    :param reference_times: reference onset times in seconds
+    :param estimated_times: estimated onset times in seconds
+    :param reference_durations: reference onset durations in seconds, None if unknown
+    :param estimated_durations: estimated onset durations in seconds
+    :param tolerance: largest allowed time difference in seconds
+    :return: onset time error and duration error in seconds, None if there are no pairs or durations
+    """
+    reference_indices, estimated_indices = match_onsets(reference_times, estimated_times, tolerance=tolerance)
+    if len(reference_indices) == 0:
+        return None, None
+    time_error = float(np.mean(np.abs(np.asarray(estimated_times)[estimated_indices] -
+                                      np.asarray(reference_times)[reference_indices])))
+    if reference_durations is None or estimated_durations is None:
+        return time_error, None
+    duration_error = float(np.mean(np.abs(np.asarray(estimated_durations)[estimated_indices] -
+                                          np.asarray(reference_durations)[reference_indices])))
+    return time_error, duration_error
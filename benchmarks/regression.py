@@ -0,0 +1,243 @@
+"""
+Accuracy and speed regression harness of the song analysis (notedetection.process_audio).
+Analyses a corpus of synthetic songs with known note starts and lengths, and of annotated audio files if given, and
+measures the onset F-measure, onset time error and duration error against the ground truth together with the
+analysis time. The results are compared with a stored baseline: the run fails (exit status 1) if the accuracy of any
+song is worse than the baseline by more than the tolerances, so that a change made for speed is only accepted if it
+keeps the maps the same. Analysis times are reported against the baseline, and only fail the run with --max-slowdown.
+The baseline is kept per quality tier and per length of the synthetic songs (--duration), as both change the measures.
+Every tier must also reach an F-measure of MIN_F_MEASURE on every synthetic song, whose notes any working analysis
+finds, so that a broken tier fails the run and is never stored as a baseline.
+
+Annotated audio files are given with --annotations, a directory of audio files each with an annotation file of the same
+name and the extension .onsets or .txt, that has one onset per line: its time in seconds, optionally followed by its
+duration in seconds.
+
+Run from the repository root:
+    python -m benchmarks.regression
+    python -m benchmarks.regression --quality fast --annotations annotated_songs
+    python -m benchmarks.regression --update-baseline
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import soundfile
+
+from benchmarks.metrics import onset_f_measure, timing_errors
+from benchmarks.synthetic import click_track, noise_bed, tone_bursts
+from game.utils import notedetection
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "regression_baseline.json")
+BASELINE_VERSION = 2
+# largest allowed change for the worse of every accuracy measure against the baseline
+TOLERANCES = {"f_measure": 0.01, "time_error_ms": 2.0, "duration_error_ms": 10.0}
+MATCH_TOLERANCE = 0.05  # onsets within 50 ms of a ground truth onset are correct
+# smallest F-measure of any tier on every synthetic song, the lowest measured is 0.6 (tones over clicks and noise)
+MIN_F_MEASURE = 0.5
+AUDIO_EXTENSIONS = (".wav", ".flac", ".ogg", ".mp3")
+
+
+def synthetic_corpus(duration=60.0, sr=22050):
+    """
+    Synthetic songs with their ground truth
+    :param duration: length of every song in seconds
+    :param sr: sampling rate
+    :return: dictionary of song names and tuples of audio signal, sampling rate, onset times, onset durations (None if
+    unknown) and tempo (None to estimate it)
+    """
+    tones, tone_times, tone_durations = tone_bursts(duration, sr=sr, return_notes=True)
+    corpus = {
+        # isolated notes of known lengths
+        "tones": (tones, sr, tone_times, tone_durations, None),
+        # the same notes over a repeating accompaniment and noise, which vocal separation removes
+        "tones_clicks_noise": (tones + 0.5 * click_track(duration, sr=sr) + noise_bed(duration, sr=sr), sr,
+                               tone_times, tone_durations, None),
+    }
+    # clicks on every beat at a given tempo, which lie on the rounding grid
+    clicks, click_times = click_track(duration, sr=sr, bpm=120, return_onsets=True)
+    corpus["clicks"] = (clicks, sr, click_times, None, 120)
+    return corpus
+
+
+def annotated_corpus(directory):
+    """
+    Annotated audio files, see the description of this module
+    :param directory: directory of the audio and annotation files
+    :return: dictionary of song names and tuples of audio path, onset times and onset durations (None if not annotated)
+    """
+    corpus = {}
+    for file_name in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(file_name)
+        if extension.lower() not in AUDIO_EXTENSIONS:
+            continue
+        for annotation_extension in (".onsets", ".txt"):
+            annotation_path = os.path.join(directory, name + annotation_extension)
+            if os.path.exists(annotation_path):
+                annotations = np.loadtxt(annotation_path, ndmin=2)
+                durations = annotations[:, 1] if annotations.shape[1] > 1 else None
+                corpus[f"file:{name}"] = (os.path.join(directory, file_name), annotations[:, 0], durations)
+                break
+    return corpus
+
+
+def evaluate(filename, reference_times, reference_durations, tempo=None, quality="accurate"):
+    """
+    Analyse a song and measure its accuracy against the ground truth
+    :return: dictionary of the measures
+    """
+    start = time.perf_counter()
+    onset_times, onset_durations, *_ = notedetection.process_audio(filename, tempo=tempo, quality=quality)
+    seconds = time.perf_counter() - start
+    precision, recall, f_measure = onset_f_measure(reference_times, onset_times, tolerance=MATCH_TOLERANCE)
+    time_error, duration_error = timing_errors(reference_times, onset_times, reference_durations, onset_durations,
+                                               tolerance=MATCH_TOLERANCE)
+    return {"onsets": len(onset_times), "references": len(reference_times), "precision": precision, "recall": recall,
+            "f_measure": f_measure,
+            "time_error_ms": None if time_error is None else time_error * 1000,
+            "duration_error_ms": None if duration_error is None else duration_error * 1000,
+            "seconds": seconds}
+
+
+def run_corpus(quality="accurate", annotations=None, duration=60.0):
+    """
+    Analyse every song of the corpus
+    :param quality: analysis quality tier
+    :param annotations: directory of annotated audio files, None for the synthetic songs only
+    :param duration: length of the synthetic songs in seconds
+    :return: dictionary of song names and their measures
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for name, (y, sr, reference_times, reference_durations, tempo) in synthetic_corpus(duration).items():
+            filename = os.path.join(directory, name + ".wav")
+            soundfile.write(filename, y, sr)
+            results[name] = evaluate(filename, reference_times, reference_durations, tempo=tempo, quality=quality)
+    if annotations is not None:
+        for name, (filename, reference_times, reference_durations) in annotated_corpus(annotations).items():
+            results[name] = evaluate(filename, reference_times, reference_durations, quality=quality)
+    return results
+
+
+def compare(results, baseline, max_slowdown=None):
+    """
+    Compare the measures of every song with the baseline
+    :param results: measures from run_corpus
+    :param baseline: measures of the baseline, of the same quality tier and song length
+    :param max_slowdown: largest allowed ratio of the analysis time to the baseline time, None not to check it
+    :return: list of regressions
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for measure, tolerance in TOLERANCES.items():
+            value, expected = result[measure], baseline[name][measure]
+            if value is None or expected is None:
+                continue
+            # a higher F-measure is better, lower errors are better
+            change = expected - value if measure == "f_measure" else value - expected
+            if change > tolerance:
+                regressions.append(f"{name}: {measure} {value:.3f} against {expected:.3f} in the baseline")
+        slowdown = result["seconds"] / baseline[name]["seconds"]
+        if max_slowdown is not None and slowdown > max_slowdown:
+            regressions.append(f"{name}: {slowdown:.2f}x slower than the baseline")
+    return regressions
+
+
+def below_minimum(results):
+    """
+    Synthetic songs whose F-measure is below MIN_F_MEASURE
+    :param results: measures from run_corpus
+    :return: list of failures
+    """
+    return [f"{name}: f_measure {result['f_measure']:.3f} below the minimum of {MIN_F_MEASURE}"
+            for name, result in results.items()
+            if not name.startswith("file:") and result["f_measure"] < MIN_F_MEASURE]
+
+
+def format_value(value, digits):
+    return "-" if value is None else f"{value:.{digits}f}"
+
+
+def print_results(results, baseline):
+    print(f"{'song':<22} {'onsets':>7} {'F':>6} {'(base)':>7} {'time err':>9} {'(base)':>7} {'dur err':>8} "
+          f"{'(base)':>7} {'time (s)':>9} {'speedup':>8}")
+    for name, result in results.items():
+        base = baseline.get(name, {})
+        speedup = f"{base['seconds'] / result['seconds']:.2f}x" if base else "new"
+        print(f"{name:<22} {result['onsets']:>7} {result['f_measure']:>6.3f} "
+              f"{format_value(base.get('f_measure'), 3):>7} "
+              f"{format_value(result['time_error_ms'], 1):>9} {format_value(base.get('time_error_ms'), 1):>7} "
+              f"{format_value(result['duration_error_ms'], 1):>8} {format_value(base.get('duration_error_ms'), 1):>7} "
+              f"{result['seconds']:>9.2f} {speedup:>8}")
+    print("errors in ms, onsets within 50 ms of the ground truth are correct")
+
+
+def read_baseline(path):
+    try:
+        with open(path, "r") as file:
+            baseline = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    return baseline if baseline.get("version") == BASELINE_VERSION else {}
+
+
+def main(quality="accurate", annotations=None, baseline_path=BASELINE_PATH, update_baseline=False, max_slowdown=None,
+         duration=60.0):
+    baseline_file = read_baseline(baseline_path)
+    # the baselines of a tier are keyed by the length of the synthetic songs in seconds
+    duration_key = f"{duration:g}"
+    description = f"{quality} tier with {duration_key} second songs"
+    baseline = baseline_file.get("tiers", {}).get(quality, {}).get(duration_key, {})
+    results = run_corpus(quality=quality, annotations=annotations, duration=duration)
+    print_results(results, baseline)
+    failures = below_minimum(results)
+
+    if update_baseline:
+        if failures:
+            for failure in failures:
+                print("FAILED", failure)
+            print(f"The baseline of the {description} is not updated")
+            return 1
+        tiers = baseline_file.get("tiers", {})
+        tiers.setdefault(quality, {})[duration_key] = {**baseline, **results}
+        with open(baseline_path, "w") as file:
+            json.dump({"version": BASELINE_VERSION, "tiers": tiers}, file, indent=2, sort_keys=True)
+        print(f"Baseline of the {description} updated in {baseline_path}")
+        return 0
+    if not baseline:
+        for failure in failures:
+            print("FAILED", failure)
+        print(f"No baseline of the {description} in {baseline_path}, run with --update-baseline to store one")
+        return 1 if failures else 0
+    regressions = failures + compare(results, baseline, max_slowdown=max_slowdown)
+    for regression in regressions:
+        print("REGRESSION", regression)
+    if not regressions:
+        print("No accuracy regressions against the baseline")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Accuracy and speed regression harness of the song analysis")
+    parser.add_argument("--quality", type=str, choices=list(notedetection.QUALITY_TIERS), default="accurate",
+                        help="Analysis quality tier")
+    parser.add_argument("--annotations", type=str, default=None,
+                        help="Directory of annotated audio files to add to the synthetic songs")
+    parser.add_argument("--baseline", type=str, default=BASELINE_PATH,
+                        help="Baseline file")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="Store the results as the new baseline instead of comparing with it")
+    parser.add_argument("--max-slowdown", type=float, default=None,
+                        help="Also fail if a song is analysed this many times slower than in the baseline")
+    parser.add_argument("--duration", type=float, default=60,
+                        help="Length of the synthetic songs in seconds")
+    arguments = parser.parse_args()
+    sys.exit(main(quality=arguments.quality, annotations=arguments.annotations, baseline_path=arguments.baseline,
+                  update_baseline=arguments.update_baseline, max_slowdown=arguments.max_slowdown,
+                  duration=arguments.duration))
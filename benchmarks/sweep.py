@@ -0,0 +1,230 @@
+"""
+Hyperparameter sweep of the onset detection pipeline (notedetection.onset_detection). Evaluates every configuration of
+a grid of its constants on the songs of the regression harness (benchmarks/regression.py):
+    margin_v: margin of the vocal separation mask (separation_masks), margin_i only shapes the background stem, which
+    is not mapped (the background branch analyses the mix)
+    amplitude_ratio: noise threshold of remove_noisy_onset
+    divergence_threshold: end of an onset in onset_length_detection
+    precision: grid of merge_close_onset and onset_roundings
+    phase_steps: candidate phase shifts of onset_roundings
+and prints the accuracy against the analysis time of every configuration, the default one marked with *.
+
+The stages are the functions of the vocal branch of notedetection.onset_detection (separate_stems, pick_onsets,
+onset_length_detection, remove_noisy_onset, merge_close_onset, onset_roundings). Each is computed once per distinct
+value of the parameters it depends on and reused by every configuration that shares them: the separated vocals and
+their onsets once per song and margin, durations once per divergence threshold, and so on down to merging and
+rounding, which are the only stages computed for every configuration. Every song and margin is a task of a process
+pool. The time of a configuration is the sum of the
+times of its stages, i.e. that of analysing the songs with it from scratch, without the background branch that is not
+mapped.
+
+Run from the repository root:
+    python -m benchmarks.sweep
+    python -m benchmarks.sweep --margin-v 10 20 28 --workers 4 --output sweep.json
+"""
+import argparse
+import itertools
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import soundfile
+
+from benchmarks.metrics import onset_f_measure, timing_errors
+from benchmarks.regression import MATCH_TOLERANCE, annotated_corpus, format_value, synthetic_corpus
+from game.utils import notedetection
+from game.utils.features import FeatureStore
+
+# the defaults are the values used by the game
+PARAMETERS = ["margin_v", "amplitude_ratio", "divergence_threshold", "precision", "phase_steps"]
+DEFAULTS = {"margin_v": 20, "amplitude_ratio": 12, "divergence_threshold": -2, "precision": 0.125, "phase_steps": 60}
+
+
+def score(reference_times, reference_durations, onset_times, onset_durations):
+    """
+    Accuracy of the onsets of one configuration against the ground truth
+    :return: F-measure, onset time error and duration error in ms (None if there is nothing to compare)
+    """
+    _, _, f_measure = onset_f_measure(reference_times, onset_times, tolerance=MATCH_TOLERANCE)
+    time_error, duration_error = timing_errors(reference_times, onset_times, reference_durations, onset_durations,
+                                               tolerance=MATCH_TOLERANCE)
+    return (float(f_measure), None if time_error is None else float(time_error) * 1000,
+            None if duration_error is None else float(duration_error) * 1000)
+
+
+def sweep_song(name, filename, reference_times, reference_durations, tempo, margin_v, grid, quality="accurate"):
+    """
+    Evaluate every configuration of the grid with the given margin on one song
+    :param name: name of the song
+    :param filename: audio file of the song
+    :param reference_times: ground truth onset times
+    :param reference_durations: ground truth onset durations, None if unknown
+    :param tempo: song tempo, estimated if None
+    :param margin_v: margin of the vocal mask of the separation
+    :param grid: dictionary of the other parameters and their values
+    :param quality: quality tier of the separation and stft settings
+    :return: list of dictionaries with the configuration, the song, its accuracy and its time
+    """
+    settings = dict(notedetection.QUALITY_TIERS[quality])
+    sr = settings.pop("sr")
+    stft_settings = {"fft_length": settings.pop("fft_length"), "fft_hop_length": settings.pop("fft_hop_length"),
+                     "n_fft": settings["n_fft"], "hop_length": settings["hop_length"]}
+    x, fs = notedetection.load_audio(filename, sr=sr)
+
+    # separation, onset picking and tempo depend on the margin only, as in raw_onset_detection
+    start = time.perf_counter()
+    mix_features = FeatureStore(x, fs)
+    x_vocals, _ = notedetection.separate_stems(x, fs, features=mix_features, margin_v=margin_v, **settings)
+    if tempo is None:
+        tempo = notedetection.estimate_tempo(mix_features.onset_envelope(n_fft=settings["n_fft"],
+                                                                         hop_length=settings["hop_length"]),
+                                             fs, hop_length=settings["hop_length"])
+    onset_times, onset_samples, y = notedetection.pick_onsets(FeatureStore(x_vocals, fs), fs, **stft_settings)
+    # remove_noisy_onset computes the same amplitudes for every ratio
+    amplitudes = notedetection.onset_amplitudes(onset_times, x_vocals, fs)
+    separation_seconds = time.perf_counter() - start
+
+    rows = []
+    for divergence_threshold in grid["divergence_threshold"]:
+        start = time.perf_counter()
+        onset_durations = notedetection.onset_length_detection(x_vocals, y, onset_samples,
+                                                               fft_length=stft_settings["fft_length"],
+                                                               fft_hop_length=stft_settings["fft_hop_length"], sr=fs,
+                                                               divergence_threshold=divergence_threshold)
+        duration_seconds = time.perf_counter() - start
+
+        for amplitude_ratio in grid["amplitude_ratio"]:
+            start = time.perf_counter()
+            kept_times, kept_durations = notedetection.remove_noisy_onset(onset_times, onset_durations, None, fs,
+                                                                          onset_amplitude=amplitudes,
+                                                                          amplitude_ratio=amplitude_ratio)
+            noise_seconds = time.perf_counter() - start
+
+            for precision, phase_steps in itertools.product(grid["precision"], grid["phase_steps"]):
+                start = time.perf_counter()
+                times, durations = notedetection.merge_close_onset(kept_times, kept_durations, tempo,
+                                                                   precision=precision)
+                times, durations = notedetection.onset_roundings(times, durations, tempo, precision=precision,
+                                                                 phase_steps=phase_steps)
+                rounding_seconds = time.perf_counter() - start
+
+                f_measure, time_error, duration_error = score(reference_times, reference_durations, times, durations)
+                rows.append({"margin_v": margin_v, "amplitude_ratio": amplitude_ratio,
+                             "divergence_threshold": divergence_threshold, "precision": precision,
+                             "phase_steps": phase_steps, "song": name, "onsets": len(times),
+                             "f_measure": f_measure, "time_error_ms": time_error,
+                             "duration_error_ms": duration_error,
+                             "seconds": separation_seconds + duration_seconds + noise_seconds + rounding_seconds})
+    return rows
+
+
+def run_sweep(grid, corpus, quality="accurate", workers=None):
+    """
+    Evaluate every configuration of the grid on every song of the corpus
+    :param grid: dictionary of every name in PARAMETERS and its values
+    :param corpus: dictionary of song names and tuples of audio path, onset times, onset durations and tempo
+    :param quality: quality tier of the separation and stft settings
+    :param workers: number of processes (default: one per CPU)
+    :return: list of rows of sweep_song, seconds taken by the sweep
+    """
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(sweep_song, name, *song, margin_v, grid, quality)
+                   for name, song in corpus.items() for margin_v in grid["margin_v"]]
+        rows = [row for future in futures for row in future.result()]
+    return rows, time.perf_counter() - start
+
+
+def summarize(rows):
+    """
+    Average the measures of every configuration over the songs
+    :param rows: rows of run_sweep
+    :return: list of dictionaries with the configuration, mean accuracy and total time, best F-measure first
+    """
+    configurations = {}
+    for row in rows:
+        configurations.setdefault(tuple(row[parameter] for parameter in PARAMETERS), []).append(row)
+    summary = []
+    for configuration, song_rows in configurations.items():
+        entry = dict(zip(PARAMETERS, configuration))
+        entry["f_measure"] = float(np.mean([row["f_measure"] for row in song_rows]))
+        for measure in ["time_error_ms", "duration_error_ms"]:
+            values = [row[measure] for row in song_rows if row[measure] is not None]
+            entry[measure] = float(np.mean(values)) if values else None
+        entry["seconds"] = sum(row["seconds"] for row in song_rows)
+        summary.append(entry)
+    summary.sort(key=lambda entry: (-entry["f_measure"], entry["seconds"]))
+    return summary
+
+
+def print_summary(summary, top=None):
+    print(f"  {'margin':>6} {'ratio':>6} {'diverg':>7} {'precision':>9} {'phases':>6} {'F':>6} {'time err':>9} "
+          f"{'dur err':>8} {'time (s)':>9}")
+    for entry in summary[:top]:
+        is_default = all(entry[parameter] == DEFAULTS[parameter] for parameter in PARAMETERS)
+        print(f"{'*' if is_default else ' '} {entry['margin_v']:>6} "
+              f"{entry['amplitude_ratio']:>6g} {entry['divergence_threshold']:>7g} {entry['precision']:>9g} "
+              f"{entry['phase_steps']:>6} {entry['f_measure']:>6.3f} {format_value(entry['time_error_ms'], 1):>9} "
+              f"{format_value(entry['duration_error_ms'], 1):>8} {entry['seconds']:>9.2f}")
+    print("mean over the songs, errors in ms, time of analysing every song with the configuration from scratch")
+
+
+def main(grid, quality="accurate", annotations=None, duration=30.0, workers=None, top=None, output=None):
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = {}
+        # the songs are analysed from files like in the regression harness, so that the default configuration
+        # reproduces its measures
+        for name, (y, sr, reference_times, reference_durations, tempo) in synthetic_corpus(duration).items():
+            filename = os.path.join(directory, name + ".wav")
+            soundfile.write(filename, y, sr)
+            corpus[name] = (filename, reference_times, reference_durations, tempo)
+        if annotations is not None:
+            for name, (filename, reference_times, reference_durations) in annotated_corpus(annotations).items():
+                corpus[name] = (filename, reference_times, reference_durations, None)
+
+        n_configurations = int(np.prod([len(values) for values in grid.values()]))
+        print(f"{n_configurations} configurations on {len(corpus)} songs, {quality} tier")
+        rows, seconds = run_sweep(grid, corpus, quality=quality, workers=workers)
+
+    summary = summarize(rows)
+    print_summary(summary, top=top)
+    analysis_seconds = sum(entry["seconds"] for entry in summary)
+    print(f"swept in {seconds:.1f} s, {analysis_seconds:.1f} s of analyses from scratch "
+          f"({analysis_seconds / seconds:.1f}x from reusing the stages and the processes)")
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump({"grid": grid, "quality": quality, "configurations": summary, "songs": rows}, file, indent=2)
+        print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep of the onset detection pipeline")
+    parser.add_argument("--margin-v", type=int, nargs="+", default=[20],
+                        help="Margins of the vocal separation mask")
+    parser.add_argument("--amplitude-ratio", type=float, nargs="+", default=[8, 12, 16],
+                        help="Noise thresholds, onsets quieter than the mean amplitude divided by this are removed")
+    parser.add_argument("--divergence-threshold", type=float, nargs="+", default=[-3, -2, -1],
+                        help="Divergences between frames below which an onset ends")
+    parser.add_argument("--precision", type=float, nargs="+", default=[0.0625, 0.125, 0.25],
+                        help="Merging and rounding precisions")
+    parser.add_argument("--phase-steps", type=int, nargs="+", default=[30, 60],
+                        help="Numbers of candidate phase shifts of the rounding grid")
+    parser.add_argument("--quality", type=str, choices=list(notedetection.QUALITY_TIERS), default="accurate",
+                        help="Quality tier of the separation and stft settings")
+    parser.add_argument("--annotations", type=str, default=None,
+                        help="Directory of annotated audio files to add to the synthetic songs, see regression.py")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="Length of the synthetic songs in seconds")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Number of processes (default: one per CPU)")
+    parser.add_argument("--top", type=int, default=None,
+                        help="Only print this many of the best configurations")
+    parser.add_argument("--output", type=str, default=None,
+                        help="JSON file to write the measures of every configuration and song to")
+    arguments = parser.parse_args()
+    main({parameter: getattr(arguments, parameter) for parameter in PARAMETERS}, quality=arguments.quality,
+         annotations=arguments.annotations, duration=arguments.duration, workers=arguments.workers, top=arguments.top,
+         output=arguments.output)
@@ -0,0 +1,129 @@
+"""
+Deterministic synthetic audio for benchmarks, generated offline so that no audio files or network access are needed.
+"""
+import numpy as np
+
+
+def dense_track(duration=180.0, sr=22050, onsets_per_second=8, seed=0):
+    """
+    A dense track of percussive clicks and sustained tones of random lengths over a quiet noise bed
+    :param duration: length in seconds
+    :param sr: sampling rate
+    :param onsets_per_second: average number of note onsets per second
+    :param seed: seed for the random number generator
+    :return: audio signal
+    """
+    rng = np.random.default_rng(seed)
+    y = 0.01 * rng.standard_normal(int(duration * sr))
+    onset_times = np.sort(rng.uniform(0, duration - 1, size=int(duration * onsets_per_second)))
+    for onset_time in onset_times:
+        start = int(onset_time * sr)
+        click_length = int(0.03 * sr)
+        y[start:start + click_length] += 0.4 * np.exp(-np.arange(click_length) / 200) * rng.standard_normal(click_length)
+        tone_length = int(rng.uniform(0.05, 1.0) * sr)
+        tone = 0.2 * np.sin(2 * np.pi * rng.uniform(150, 1500) * np.arange(tone_length) / sr)
+        y[start:start + tone_length] += tone[:len(y) - start]
+    return y.astype(np.float32)
+
+
+def repeating_track(duration=180.0, sr=22050, bpm=120, seed=0, return_melody=False):
+    """
+    A two bar accompaniment loop repeated for the whole track, with a non-repeating melody of random tones on top,
+    as a stand-in for a song with a vocal line
+    :param duration: length in seconds
+    :param sr: sampling rate
+    :param bpm: tempo of the loop
+    :param seed: seed for the random number generator
+    :param return_melody: also return the melody on its own
+    :return: audio signal, and the melody if return_melody
+    """
+    rng = np.random.default_rng(seed)
+    beat_length = int(60 / bpm * sr)
+    loop = 0.005 * rng.standard_normal(8 * beat_length)
+    for beat in range(8):
+        start = beat * beat_length
+        loop[start:start + 600] += 0.5 * np.exp(-np.arange(600) / 100) * rng.standard_normal(600)
+        chord = sum(np.sin(2 * np.pi * frequency * np.arange(beat_length) / sr)
+                    for frequency in rng.choice([110, 165, 220, 277, 330], size=2, replace=False))
+        loop[start:start + beat_length] += 0.05 * chord
+
+    length = int(duration * sr)
+    y = np.tile(loop, length // len(loop) + 1)[:length]
+    melody = np.zeros(length)
+    time = 0.0
+    while time < duration - 1:
+        note_length = rng.uniform(0.2, 0.8)
+        start, end = int(time * sr), int((time + note_length) * sr)
+        frequency = rng.uniform(300, 900)
+        melody[start:end] += 0.15 * np.sin(2 * np.pi * frequency * np.arange(end - start) / sr) * np.hanning(end - start)
+        time += note_length + rng.uniform(0.1, 0.6)
+    y = (y + melody).astype(np.float32)
+    if return_melody:
+        return y, melody.astype(np.float32)
+    return y
+
+
+def click_track(duration=180.0, sr=22050, bpm=120, return_onsets=False):
+    """
+    Short noise clicks on every beat
+    :param duration: length in seconds
+    :param sr: sampling rate
+    :param bpm: tempo of the clicks
+    :param return_onsets: also return the click times
+    :return: audio signal, and the click times in seconds if return_onsets
+    """
+    rng = np.random.default_rng(0)
+    y = np.zeros(int(duration * sr))
+    click_length = int(0.02 * sr)
+    click = 0.5 * np.exp(-np.arange(click_length) / (0.003 * sr)) * rng.standard_normal(click_length)
+    onset_times = np.arange(0, duration - 0.1, 60 / bpm)
+    for onset_time in onset_times:
+        start = int(onset_time * sr)
+        y[start:start + click_length] += click[:len(y) - start]
+    if return_onsets:
+        return y.astype(np.float32), onset_times
+    return y.astype(np.float32)
+
+
+def tone_bursts(duration=180.0, sr=22050, seed=0, return_notes=False):
+    """
+    Sine tones of random pitch and known duration, separated by silence
+    :param duration: length in seconds
+    :param sr: sampling rate
+    :param seed: seed for the random number generator
+    :param return_notes: also return the start times and durations of the tones
+    :return: audio signal, and the tone start times and durations in seconds if return_notes
+    """
+    rng = np.random.default_rng(seed)
+    y = np.zeros(int(duration * sr))
+    onset_times, onset_durations = [], []
+    time = 0.1
+    while time < duration - 1:
+        tone_duration = rng.choice([0.125, 0.25, 0.5, 1.0])
+        start, end = int(time * sr), int((time + tone_duration) * sr)
+        # short fades avoid clicks at the tone edges
+        envelope = np.minimum(1, np.minimum(np.arange(end - start), np.arange(end - start)[::-1]) / (0.005 * sr))
+        y[start:end] += 0.3 * np.sin(2 * np.pi * rng.uniform(200, 1200) * np.arange(end - start) / sr) * envelope
+        onset_times.append(time)
+        onset_durations.append(tone_duration)
+        time += tone_duration + rng.uniform(0.1, 0.5)
+    if return_notes:
+        return y.astype(np.float32), np.array(onset_times), np.array(onset_durations)
+    return y.astype(np.float32)
+
+
+def noise_bed(duration=180.0, sr=22050, level=0.02, seed=0):
+    """
+    Pink background noise, made by shaping the spectrum of white noise
+    :param duration: length in seconds
+    :param sr: sampling rate
+    :param level: standard deviation of the noise
+    :param seed: seed for the random number generator
+    :return: audio signal
+    """
+    rng = np.random.default_rng(seed)
+    white = rng.standard_normal(int(duration * sr))
+    spectrum = np.fft.rfft(white)
+    spectrum[1:] /= np.sqrt(np.arange(1, len(spectrum)))
+    noise = np.fft.irfft(spectrum, n=len(white))
+    return (level * noise / np.std(noise)).astype(np.float32)
@@ -0,0 +1,226 @@
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from game.pattern_manager import PatternManager
+from game.utils import notedetection
+from game.utils.analysis_cache import AnalysisCache
+from game.utils.fingerprint import FingerprintIndex, fingerprint_file, shift_music_data, song_duration
+from game.utils.downloads import DownloadManager
+from game.utils.ingest import ingest_file, write_analysis_pcm
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".ogg", ".flac", ".m4a", ".aac", ".opus")
+
+
+def collect_sources(inputs):
+    """
+    Expand the command line inputs into the list of songs to analyse
+    :param inputs: directories (searched recursively for audio files), audio files and YouTube links
+    :return: list of audio file paths and links
+    """
+    sources = []
+    for item in inputs:
+        if item.startswith(("http://", "https://")):
+            sources.append(item)
+        elif os.path.isdir(item):
+            for directory, _, file_names in sorted(os.walk(item)):
+                sources.extend(os.path.join(directory, file_name) for file_name in sorted(file_names)
+                               if file_name.lower().endswith(AUDIO_EXTENSIONS))
+        else:
+            sources.append(item)  # missing files are reported as failures
+    return sources
+
+
+def analyze_song(audio_path, downloaded_path, cache_dir, tempo, quality, dual_stream, seed, difficulty,
+                 approach_rate):
+    """
+    Decode (for downloaded links) and analyse one song, then generate its map, in a worker process
+    Nothing is written to the cache here, so that only the parent process ever writes to the cache index
+    If the fingerprint of the song matches a song analysed before from another source, its analysis is reused
+    :param audio_path: path of the audio file to analyse, where downloaded links are decoded to
+    :param downloaded_path: file downloaded for a link whose audio file does not exist yet, None otherwise
+    :param cache_dir: directory of the analysis cache
+    :param tempo: song tempo, estimated if None
+    :param quality: analysis quality tier
+    :param dual_stream: map the background onsets as well as the vocal ones
+    :param seed: map generation seed
+    :param difficulty: map difficulty
+    :param approach_rate: circle approach rate
+    :return: dictionary with the audio digest, decoded audio path, fingerprint and length of the song, musical data,
+    number of map objects and stage timings
+    """
+    timings = {}
+    start = time.perf_counter()
+    decoded = None
+    if not os.path.exists(audio_path):
+        decoded = ingest_file(downloaded_path, audio_path)
+        timings["download"] = time.perf_counter() - start  # the parent adds the time of the transfer
+
+    start = time.perf_counter()
+    cache = AnalysisCache(cache_dir)
+    digest = cache.audio_digest(audio_path)
+    # decoded audio is written next to the cache entries, and registered in the cache by the parent process
+    analysis_sr = notedetection.QUALITY_TIERS[quality]["sr"]
+    pcm_path = cache.pcm_path(digest, analysis_sr)
+    # the song has just been decoded, it is not read again for its fingerprint nor for the analysis
+    decoded_signal = None
+    if decoded is not None and not os.path.exists(pcm_path):
+        decoded_signal = write_analysis_pcm(pcm_path, *decoded, analysis_sr), analysis_sr
+    del decoded
+    hashes, frames = fingerprint_file(audio_path, pcm_path=pcm_path, decoded=decoded_signal)
+    del decoded_signal
+    duration = song_duration(audio_path, pcm_path=pcm_path)
+    match = FingerprintIndex(cache.fingerprint_dir).match(hashes, frames, duration, exclude=digest)
+    music_data = None
+    if match is not None:
+        copy_digest, offset = match
+        copy_music_data = cache.peek(cache.key(copy_digest, **notedetection.analysis_parameters(
+            tempo, quality=quality, dual_stream=dual_stream)))
+        if copy_music_data is not None:
+            music_data = shift_music_data(copy_music_data, offset, duration)
+    timings["fingerprint"] = time.perf_counter() - start
+
+    if music_data is None:
+        start = time.perf_counter()
+        # songs are already analysed in parallel by the worker processes, so their branches are not
+        music_data = notedetection.process_audio(audio_path, tempo=tempo, quality=quality, pcm_path=pcm_path,
+                                                 workers=1, dual_stream=dual_stream)
+        timings["analysis"] = time.perf_counter() - start
+
+    # same screen size and frame rate as the game
+    start = time.perf_counter()
+    pattern_manager = PatternManager(1200, 675, 60, seed, difficulty=difficulty, approach_rate=approach_rate,
+                                     tempo=tempo)
+    pattern_manager.generate_map(music_data)
+    timings["map"] = time.perf_counter() - start
+
+    return {"digest": digest, "pcm_path": pcm_path, "fingerprint": (hashes, frames, duration),
+            "music_data": music_data, "objects": len(pattern_manager.patterns), "timings": timings}
+
+
+def analyze_library(inputs, cache_dir=os.path.join("game", "data", "cache"), workers=None, download_workers=4,
+                    tempo=None, quality="accurate", dual_stream=False, seed=777, difficulty=5, approach_rate=10,
+                    resolver=None):
+    """
+    Analyse many songs in a process pool and store their musical data in the analysis cache, so that the game loads
+    them without analysing them again. Songs that are already cached are skipped, and a failing song does not stop the
+    others. Files with the same audio content are analysed once. Links are downloaded in threads of the parent process,
+    and every song is analysed as soon as it has been downloaded.
+    :param inputs: directories, audio files and YouTube links
+    :param cache_dir: directory of the analysis cache
+    :param workers: number of worker processes (default: number of CPUs)
+    :param download_workers: number of links downloaded at the same time
+    :param tempo: song tempo for all songs, estimated per song if None
+    :param quality: analysis quality tier, see notedetection.QUALITY_TIERS
+    :param dual_stream: map the background onsets as well as the vocal ones
+    :param seed: map generation seed
+    :param difficulty: map difficulty
+    :param approach_rate: circle approach rate
+    :param resolver: turns links into files to download, see downloads.DownloadManager (default: YouTube)
+    :return: list of per-song results with source, status, timings and error message
+    """
+    cache = AnalysisCache(cache_dir)
+    fingerprints = FingerprintIndex(cache.fingerprint_dir)
+    downloads = []
+    download_durations = {}
+    sources = list(dict.fromkeys(collect_sources(inputs)))  # analyse duplicates once
+    results = {}
+    jobs = {}
+    # copies of the same audio content are analysed once, the others take the result of the first one
+    first_sources = {}
+    duplicates = {}
+    total_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for source in sources:
+            is_link = source.startswith(("http://", "https://"))
+            audio_path = cache.audio_path(source) if is_link else source
+            if not is_link and not os.path.isfile(audio_path):
+                results[source] = {"status": "failed", "error": "file not found"}
+                continue
+            if not os.path.exists(audio_path):
+                downloads.append(source)
+                continue
+            digest = cache.audio_digest(audio_path)
+            if digest in first_sources:
+                duplicates[source] = first_sources[digest]
+                continue
+            first_sources[digest] = source
+            cache_key = cache.key(digest,
+                                  **notedetection.analysis_parameters(tempo, quality=quality, dual_stream=dual_stream))
+            if cache.load(cache_key) is not None:
+                results[source] = {"status": "cached"}
+                continue
+            future = executor.submit(analyze_song, audio_path, None, cache.cache_dir, tempo, quality,
+                                     dual_stream, seed, difficulty, approach_rate)
+            jobs[future] = (source, audio_path, is_link)
+
+        # downloaded files are kept in the cache, so that an interrupted batch resumes where it stopped
+        manager = DownloadManager(cache.download_dir, resolver=resolver, max_workers=download_workers) \
+            if downloads else None
+        for source, downloaded_path, error in manager.download_many(downloads) if downloads else []:
+            if error is not None:
+                attempts = f"{error.attempts} attempt{'s' if error.attempts > 1 else ''}"
+                results[source] = {"status": "failed",
+                                   "error": f"download {error.reason} after {attempts}: {error.message}"}
+                continue
+            cache.touch(downloaded_path)
+            download_durations[source] = manager.durations[source]
+            future = executor.submit(analyze_song, cache.audio_path(source), downloaded_path, cache.cache_dir, tempo,
+                                     quality, dual_stream, seed, difficulty, approach_rate)
+            jobs[future] = (source, cache.audio_path(source), True)
+
+        for future in as_completed(jobs):
+            source, audio_path, is_link = jobs[future]
+            try:
+                result = future.result()
+            except Exception as error:
+                traceback.print_exception(type(error), error, error.__traceback__)
+                results[source] = {"status": "failed", "error": f"{type(error).__name__}: {error}".rstrip(": ")}
+                continue
+            if is_link:
+                cache.touch(audio_path)
+            if os.path.exists(result["pcm_path"]):
+                cache.touch(result["pcm_path"])
+            cache_key = cache.key(result["digest"], **notedetection.analysis_parameters(tempo, quality=quality,
+                                                                                        dual_stream=dual_stream))
+            cache.store(cache_key, result["music_data"], audio_digest=result["digest"])
+            fingerprints.add(result["digest"], *result["fingerprint"])
+            if source in download_durations:
+                result["timings"]["download"] = result["timings"].get("download", 0) + download_durations[source]
+            results[source] = {"status": "analysed", "notes": len(result["music_data"][0]),
+                               "objects": result["objects"], "timings": result["timings"]}
+            print(f"Analysed {source} in {sum(result['timings'].values()):.1f} s")
+
+    for source, first_source in duplicates.items():
+        if results[first_source]["status"] == "failed":
+            results[source] = {"status": "failed", "error": f"same audio as {first_source}, which failed"}
+        else:
+            results[source] = {"status": "cached"}
+
+    summary = [{"source": source, **results[source]} for source in sources]
+    print_summary(summary, time.perf_counter() - total_start)
+    print("Analysis cache:", cache.stats())
+    return summary
+
+
+def print_summary(summary, total_time):
+    """
+    Print the status and timings of every song
+    :param summary: per-song results from analyze_library
+    :param total_time: wall time of the whole batch in seconds
+    """
+    stages = ("download", "fingerprint", "analysis", "map")
+    print(f"{'status':<9} {'notes':>6} {'objects':>8} {'download':>9} {'fingerprint':>12} {'analysis':>9} {'map':>6}  "
+          f"source")
+    for result in summary:
+        timings = result.get("timings", {})
+        columns = [f"{timings[stage]:.1f}" if stage in timings else "-" for stage in stages]
+        print(f"{result['status']:<9} {result.get('notes', '-'):>6} {result.get('objects', '-'):>8} "
+              f"{columns[0]:>9} {columns[1]:>12} {columns[2]:>9} {columns[3]:>6}  {result['source']}")
+        if "error" in result:
+            print(f"{'':<9} {result['error']}")
+    counts = {status: sum(result["status"] == status for result in summary)
+              for status in ("analysed", "cached", "failed")}
+    print(f"{len(summary)} songs in {total_time:.1f} s: {counts['analysed']} analysed, {counts['cached']} cached, "
+          f"{counts['failed']} failed")
@@ -3,11 +3,12 @@ import numpy as np
 import random
 from game.pattern_manager import PatternManager
 from pygame import mixer
-from game.utils import notedetection
-from game.utils.youtubeDL import download_youtube_audio
+from game.utils.analysis_cache import AnalysisCache, StageCache
+from game.utils.profiling import Profiler
 from game.utils.input_manager import InputManager
 from game.utils.menu_items import Button, Label
 import os
+import contextlib
 from dataclasses import dataclass
 import threading
 
@@ -32,9 +33,9 @@ class Game:
 
     def __init__(self, settings):
         self.settings = settings
-        (youtube_link, seed, given_tempo,
+        (source, seed, given_tempo,
          self.difficulty, self.approach_rate,
-         use_game_background) = settings
+         use_game_background, analysis_options) = settings
         self.screen_width, self.screen_height = 1200, 675
         self.data = GameData(
             seed=seed,
@@ -150,6 +151,9 @@ class Game:
         self.current_scene = self.end_scene
 
     def load(self):
+        # Stop the background analysis of the previous game, if it is still running
+        if self.game_scene is not None:
+            self.game_scene.stop_analysis.set()
         # Once the settings are finalized, initialize the other scenes accordingly
         self.game_scene = GameScene(self.window, self.data, self.cursor_images, self.settings)
         self.pause_scene = PauseScene(self.window, self.cursor_images)
@@ -179,9 +183,9 @@ class GameScene:
     def __init__(self, window, data, cursor_images, settings):
         self.screen_width, self.screen_height = window.get_size()
         self.settings = settings
-        (youtube_link, seed, given_tempo,
+        (source, seed, given_tempo,
          difficulty, approach_rate,
-         use_game_background) = settings
+         use_game_background, analysis_options) = settings
         self.window = window
         self.clock = None
         self.steps = 0
@@ -215,6 +219,15 @@ class GameScene:
         self.game_started = False
         self.paused = False
 
+        # progressive analysis, where the song is analysed and mapped segment by segment while it is being played
+        self.progressive_segments = None
+        self.progressive_music_data = []
+        self.stop_analysis = threading.Event()
+        self.min_lead_margin = None
+        self.cache = None
+        self.cache_key = None
+        self.audio_digest = None
+
         self.input_manager = InputManager()
 
         self.pattern_manager = PatternManager(self.screen_width, self.screen_height, self.fps, self.seed,
@@ -238,62 +251,91 @@ class GameScene:
 
         win = pygame.Surface((self.screen_width, self.screen_height))
         win.fill((0, 0, 0))
-        self.pattern_manager.generate_map(self.music_data)
+        if self.progressive_segments is not None:
+            # only map the first segment before the game starts, the rest is mapped while playing
+            music_data, mapped_until = next(self.progressive_segments)
+            self.progressive_music_data.append(music_data)
+            self.pattern_manager.generate_map(music_data)
+            self.pattern_manager.mapped_until = mapped_until * self.fps
+        else:
+            self.pattern_manager.generate_map(self.music_data)
         self.pattern_manager.hot_load_caches()
         self.pattern_manager.prerender_patterns(win)
+        if self.progressive_segments is not None:
+            threading.Thread(target=self.run_progressive_analysis, daemon=True).start()
+
+    def run_progressive_analysis(self):
+        """
+        Analyse and map the rest of the song segment by segment in the background while it is being played, then store
+        the musical data of the whole song in the cache
+        """
+        win = pygame.Surface((self.screen_width, self.screen_height))
+        for music_data, mapped_until in self.progressive_segments:
+            if self.stop_analysis.is_set():
+                return
+            self.pattern_manager.extend_map(music_data, win, mapped_until)
+            self.progressive_music_data.append(music_data)
+            print(f"Progressive analysis: mapped up to {mapped_until:.1f} s, "
+                  f"playing at {self.steps / self.fps:.1f} s")
+        self.pattern_manager.mapped_until = None
+        if self.min_lead_margin is not None:
+            print(f"Progressive analysis finished, minimum lead margin {self.min_lead_margin:.1f} s")
+
+        onset_times, onset_durations, onset_bars, tempos = zip(*self.progressive_music_data)
+        self.music_data = (np.concatenate(onset_times), np.concatenate(onset_durations), np.concatenate(onset_bars),
+                           tempos[0])
+        if self.cache_key is not None:
+            self.cache.store(self.cache_key, self.music_data, audio_digest=self.audio_digest)
+
+    def update_lead_margin(self):
+        """
+        Track the lead margin of progressive analysis: the time left until objects that have not been mapped yet
+        would have to appear on screen. The game starves, showing no objects where there should be some, when it is
+        negative.
+        """
+        mapped_until = self.pattern_manager.mapped_until
+        if mapped_until is None:
+            return
+        lead_margin = (mapped_until - self.pattern_manager.lifetime - self.steps) / self.fps
+        if lead_margin < 0 and (self.min_lead_margin is None or self.min_lead_margin >= 0):
+            print(f"Progressive analysis is behind the game by {-lead_margin:.1f} s")
+        if self.min_lead_margin is None or lead_margin < self.min_lead_margin:
+            self.min_lead_margin = lead_margin
 
     def load_assets(self, keep_files=True):
         """
         Loads files for the audio and computed musical information
-        :param keep_files: Saves the files to the disk when finished
-        False if load from existing files
+        Downloaded audio and extracted musical data are kept in a persistent cache, so that songs that have been played
+        before are neither downloaded nor analysed again
+        :param keep_files: Keeps the downloaded audio and extracted musical data in the cache when finished, local
+        files are never removed
         """
-        (youtube_link, seed, given_tempo,
+        (source, seed, given_tempo,
          difficulty, approach_rate,
-         use_game_background) = self.settings
-
-        file_path = os.path.join("game", "data", "audio")
-        file_name = "audio.mp3"
-        self.audio_file_full_path = os.path.join(file_path, file_name)
-        onset_times_file = os.path.join("game", "data", "onset_times.npy")
-        onset_durations_file = os.path.join("game", "data", "onset_durations.npy")
-        onset_bars_file = os.path.join("game", "data", "onset_bars.npy")
-        tempo_file = os.path.join("game", "data", "tempo.npy")
-        yt_file = os.path.join("game", "data", "yt_link.txt")
-
-        yt_link = ""
-        try:
-            with open(yt_file, "r") as file:
-                yt_link = file.read().strip()
-        except FileNotFoundError:
-            pass
-        # Check if previous youtube link is the same as the current one, if not, redownload all the files
-        use_new_files = yt_link != youtube_link
-
-        if use_new_files:
-            # Remove all the existing files
-            if os.path.exists(self.audio_file_full_path):
-                os.remove(self.audio_file_full_path)
-
-            if os.path.exists(onset_times_file):
-                os.remove(onset_times_file)
-
-            if os.path.exists(onset_durations_file):
-                os.remove(onset_durations_file)
-
-            if os.path.exists(onset_bars_file):
-                os.remove(onset_bars_file)
-
-            if os.path.exists(tempo_file):
-                os.remove(tempo_file)
-
-        # Download audio from YouTube if there is no audio at the specified path
-        is_from_youtube = not os.path.exists(self.audio_file_full_path)
-        if is_from_youtube:
-            youtube_url = youtube_link
-            download_youtube_audio(youtube_url, file_path, file_name)
+         use_game_background, analysis_options) = self.settings
+        # The analysis and download modules pull in librosa, scipy, numba and pytube, which take seconds to import.
+        # They are imported here, in the loading thread, so that the menu appears without waiting for them.
+        from game.utils import notedetection
+        from game.utils.fingerprint import (FINGERPRINT_DURATION, FingerprintIndex, fingerprint_file, shift_music_data,
+                                            song_duration)
+        from game.utils.ingest import DecodePipeline, analysis_signal, ingest_download, ingest_local, write_analysis_pcm
+        from game.utils.streaming import progressive_onset_detection
+
+        cache = AnalysisCache(os.path.join("game", "data", "cache"))
+        # Download audio from YouTube if it has not been downloaded before, songs are decoded once into a WAV file
+        # that is both played and analysed. Local files are played as they are if pygame can play them.
+        decoded = None
+        if source.startswith(("http://", "https://")):
+            self.audio_file_full_path = cache.audio_path(source)
+            if not os.path.exists(self.audio_file_full_path):
+                decoded = ingest_download(source, self.audio_file_full_path)
+            else:
+                print("File already exists. Skipping download.")
         else:
-            print("File already exists. Skipping download.")
+            self.audio_file_full_path, decoded = ingest_local(source, cache)
+        is_cached_audio = os.path.dirname(self.audio_file_full_path) == cache.audio_dir
+        if is_cached_audio:
+            cache.touch(self.audio_file_full_path)
 
         # Set game background if desired
         if self.background is None and use_game_background:
@@ -326,44 +368,83 @@ class GameScene:
             # Scale the background image to game screen size
             self.background = pygame.transform.smoothscale(background, (self.screen_width, self.screen_height))
 
-        # Check for the existence of extracted and process musical data
-        if os.path.exists(onset_times_file) and os.path.exists(onset_durations_file) and os.path.exists(
-                onset_bars_file) and os.path.exists(tempo_file):
-            onset_times = np.load(onset_times_file)
-            onset_durations = np.load(onset_durations_file)
-            onset_bars = np.load(onset_bars_file)
-            tempo = np.load(tempo_file)
-            self.music_data = onset_times, onset_durations, onset_bars, int(tempo[0])
-        else:
-            self.music_data = notedetection.process_audio(self.audio_file_full_path, tempo=given_tempo)
-            onset_times, onset_durations, onset_bars, tempo = self.music_data
-            tempo = np.array([tempo])
+        # Look up previously extracted musical data of the same audio content and analysis parameters
+        audio_digest = cache.audio_digest(self.audio_file_full_path)
+        parameters = notedetection.analysis_parameters(given_tempo, progressive=analysis_options["progressive"],
+                                                       quality=analysis_options["quality"],
+                                                       dual_stream=analysis_options["dual_stream"])
+        cache_key = cache.key(audio_digest, **parameters)
+        self.music_data = cache.load(cache_key)
+        # the decoded audio is kept, so that analysing the song again with other parameters skips decoding
+        analysis_sr = notedetection.QUALITY_TIERS[analysis_options["quality"]]["sr"]
+        pcm_path = cache.pcm_path(audio_digest, analysis_sr)
+        # the song has just been decoded, so it is not read again for its fingerprint nor for the analysis
+        decoded_signal = None
+        if decoded is not None and keep_files and not os.path.exists(pcm_path):
+            decoded_signal = write_analysis_pcm(pcm_path, *decoded, analysis_sr), analysis_sr
+            cache.touch(pcm_path)
+        elif decoded is not None:
+            samples, sr = decoded
+            decoded_signal = analysis_signal(samples[:int(FINGERPRINT_DURATION * sr)], sr, analysis_sr), analysis_sr
+        del decoded
+
+        fingerprints = FingerprintIndex(cache.fingerprint_dir)
+        if self.music_data is None or audio_digest not in fingerprints:
+            hashes, frames = fingerprint_file(self.audio_file_full_path, pcm_path=pcm_path, decoded=decoded_signal)
+            duration = song_duration(self.audio_file_full_path, pcm_path=pcm_path)
+            match = fingerprints.match(hashes, frames, duration, exclude=audio_digest)
+            if self.music_data is None and match is not None:
+                # the same song has been analysed before from another source, e.g. a re-upload or a local copy
+                copy_digest, offset = match
+                copy_music_data = cache.load(cache.key(copy_digest, **parameters))
+                if copy_music_data is not None:
+                    print(f"Reusing the analysis of a copy of this song, shifted by {offset:+.2f} s")
+                    self.music_data = shift_music_data(copy_music_data, offset, duration)
+                    if keep_files:
+                        cache.store(cache_key, self.music_data, audio_digest=audio_digest)
+            if keep_files:
+                fingerprints.add(audio_digest, hashes, frames, duration)
+        del decoded_signal
+
+        if self.music_data is None and analysis_options["progressive"] is not None:
+            # analysed while playing, see run_expensive_operations
+            # the song is decoded by ffmpeg while the segments decoded so far are analysed
+            self.progressive_segments = progressive_onset_detection(
+                self.audio_file_full_path, tempo=given_tempo, segment_duration=analysis_options["progressive"],
+                blocks=DecodePipeline(self.audio_file_full_path))
+            if keep_files:
+                self.cache, self.cache_key, self.audio_digest = cache, cache_key, audio_digest
+        elif self.music_data is None:
+            quality = analysis_options["quality"]
+            # the results of the stages that do not depend on the tempo, so that playing the song again
+            # with another tempo skips the vocal separation
+            stage_cache = StageCache(cache, audio_digest) if keep_files else None
+            # record the time spent in every stage of the analysis if desired
+            profiler = Profiler(trace_memory=analysis_options["profile_memory"]) \
+                if analysis_options["profile"] is not None else contextlib.nullcontext()
+            with profiler:
+                self.music_data = notedetection.process_audio(self.audio_file_full_path, tempo=given_tempo,
+                                                              quality=quality, pcm_path=pcm_path,
+                                                              stage_cache=stage_cache,
+                                                              dual_stream=analysis_options["dual_stream"])
+            if analysis_options["profile"] is not None:
+                print(profiler.format_report())
+                profiler.dump(analysis_options["profile"])
+            if os.path.exists(pcm_path):
+                if keep_files:
+                    cache.touch(pcm_path)
+                else:
+                    cache.remove(pcm_path)
+            if keep_files:
+                cache.store(cache_key, self.music_data, audio_digest=audio_digest)
+        print("Analysis cache:", cache.stats())
 
         # Load music from downloaded audio file
         mixer.music.load(self.audio_file_full_path)
         mixer.music.set_volume(0.8)
 
-        if keep_files:
-            np.save(onset_times_file, onset_times)
-            np.save(onset_durations_file, onset_durations)
-            np.save(onset_bars_file, onset_bars)
-            np.save(tempo_file, tempo)
-            try:
-                with open(yt_file, "w") as file:
-                    file.write(youtube_link)
-            except FileNotFoundError:
-                pass
-        else:
-            os.remove(self.audio_file_full_path)
-
-            if os.path.exists(onset_times_file):
-                os.remove(onset_times_file)
-
-            if os.path.exists(onset_durations_file):
-                os.remove(onset_durations_file)
-
-            if os.path.exists(onset_bars_file):
-                os.remove(onset_bars_file)
+        if not keep_files and is_cached_audio and self.progressive_segments is None:
+            cache.remove(self.audio_file_full_path)
 
     def run(self):
         """
@@ -408,6 +489,7 @@ class GameScene:
         if self.game_started:
             self.input_manager.update()
             self.steps += 1
+            self.update_lead_margin()
             score = self.data.score
 
             # Obtain the score at this step and update the status of patterns
@@ -438,7 +520,7 @@ class GameScene:
         self.sync_game_and_music()
 
         win = pygame.Surface((self.screen_width, self.screen_height))
-        *_, use_game_background = self.settings
+        *_, use_game_background, _ = self.settings
         if use_game_background:
             win.blit(self.background, (0, 0))  # Use loaded game background
         else:
@@ -1,4 +1,5 @@
 import random
+import threading
 
 from game.utils.patterns import *
 from itertools import groupby
@@ -21,8 +22,15 @@ class PatternManager:
         self.patterns = []
         self.pattern_queue = None
         self.queue_length = 12
+        # guards the pattern lists when later parts of the map are added while the game is running, see extend_map
+        self.lock = threading.Lock()
+        # time (in frames) up to which the song has been mapped, None once the whole song is mapped
+        self.mapped_until = None
         self.difficulty = difficulty
         self.approach_rate = approach_rate
+        # random generators of the map, seeded in generate_patterns
+        self.random = None
+        self.np_random = None
 
         # difficulty dependent variables such as circle size and approach rate
         self.radius = 80 - (difficulty - 1) * 5
@@ -38,38 +46,74 @@ class PatternManager:
     def generate_map(self, music_data):
         '''
         Generate objects/patterns and store in self.pattern_queue
-        :param music_data: contains the timings, durations and bar numbers of the onsets
+        :param music_data: contains the timings, durations and bar numbers of the onsets, and optionally their labels
+        (1 for vocal, 0 for background onsets) for dual stream maps
         :return: nothing
         '''
-        onset_times, onset_durations, onset_bars, predicted_tempo = music_data
+        onset_times, onset_durations, onset_bars, predicted_tempo, *onset_labels = music_data
         if self.tempo is None:
             self.tempo = predicted_tempo
             self.beat_duration = 60 / self.tempo
         onset_time_frames = [int(i * self.fps) for i in onset_times]
         onset_duration_frames = [int(i * self.fps) for i in onset_durations]
-        self.generate_patterns(onset_time_frames, onset_duration_frames, onset_bars)
+        self.generate_patterns(onset_time_frames, onset_duration_frames, onset_bars, *onset_labels)
         self.pattern_queue = self.patterns[:self.queue_length]
         return
 
-    def generate_patterns(self, onset_time_frames, onset_duration_frames, onset_bars):
+    def extend_map(self, music_data, win, mapped_until=None):
+        '''
+        Append the objects of a later part of the song to the map, while the earlier part may already be played
+        :param music_data: contains the timings, durations and bar numbers of the new onsets, all later than the
+        onsets of the map so far, and optionally their labels
+        :param win: Pygame surface to prerender the new patterns on
+        :param mapped_until: time (in seconds) up to which the song has been mapped, None if the map is complete
+        :return: nothing
+        '''
+        onset_times, onset_durations, onset_bars, _, *onset_labels = music_data
+        onset_time_frames = [int(i * self.fps) for i in onset_times]
+        onset_duration_frames = [int(i * self.fps) for i in onset_durations]
+        # generate the patterns apart from the played ones, so that they are only played once prerendered, and without
+        # the lock, which the render thread takes on every frame
+        new_patterns = []
+        self.generate_patterns(onset_time_frames, onset_duration_frames, onset_bars, *onset_labels,
+                               patterns=new_patterns)
+        for pattern in new_patterns:
+            pattern.prerender(win)
+        with self.lock:
+            self.patterns.extend(new_patterns)
+            # top up the queue, in case all the patterns mapped so far are already in it
+            self.pattern_queue = self.patterns[:self.queue_length]
+            self.mapped_until = mapped_until * self.fps if mapped_until is not None else None
+
+    def generate_patterns(self, onset_time_frames, onset_duration_frames, onset_bars, onset_labels=None,
+                          patterns=None):
         '''
         Determines the objects' locations on the screen according to their bar number and onset timings
         :param onset_time_frames: list of onset timings in frame number
         :param onset_duration_frames: list of  onset durations in frames
         :param onset_bars: list of bar numbers of all the onsets
+        :param onset_labels: list of onset labels, 1 for vocal and 0 for background onsets (default: all vocal)
+        :param patterns: list the new patterns are appended to (default: the map, self.patterns)
         :return: nothing
         '''
+        if patterns is None:
+            patterns = self.patterns
         # make the seed dependent on the input audio in some way
         seed_add = sum(onset_duration_frames)
-        random.seed(self.seed + seed_add)
-        np.random.seed(self.seed + seed_add)
+        # generators of this map, so that parts of the map generated in the background neither use nor reseed the
+        # global ones, and draw the same numbers as the global generators seeded with the same seed
+        self.random = random.Random(self.seed + seed_add)
+        self.np_random = np.random.RandomState(self.seed + seed_add)
+        if onset_labels is None:
+            onset_labels = [1] * len(onset_time_frames)
 
         # preprocess the lists, so they are zipped according to their bar numbers
-        zipped_data = [(time, duration, bar) for time, duration, bar
-                       in zip(onset_time_frames, onset_duration_frames, onset_bars)]
+        zipped_data = [(time, duration, bar, label) for time, duration, bar, label
+                       in zip(onset_time_frames, onset_duration_frames, onset_bars, onset_labels)]
         grouped_data = [list(group) for key, group in groupby(zipped_data, key=lambda x: x[2])]
         onset_time_frames = [[item[0] for item in group] for group in grouped_data]
         onset_duration_frames = [[item[1] for item in group] for group in grouped_data]
+        onset_labels = [[item[3] for item in group] for group in grouped_data]
 
         # distances for each circle of a pattern and for each pattern depends on the difficulty
         circle_distance = 20 + 50 * self.difficulty
@@ -79,7 +123,7 @@ class PatternManager:
         bottom_right_corner = np.array([self.x_range[1], self.y_range[0]])
         top_right_corner = np.array([self.x_range[1], self.y_range[1]])
         min_circle_distance = np.linalg.norm(top_right_corner - bottom_left_corner) / 2 - 50
-        for onset_times, onset_durations in zip(onset_time_frames, onset_duration_frames):
+        for onset_times, onset_durations, labels in zip(onset_time_frames, onset_duration_frames, onset_labels):
             # compute the position of first circle of the current pattern/bar
             circle_position = None
 
@@ -93,7 +137,7 @@ class PatternManager:
                 while circle_position is None or np.linalg.norm(
                         circle_position - self.last_circle_position) != min_circle_distance:
                     # Generate a random angle in radians, repeat until a suitable direction is found
-                    angle = np.random.uniform(0, 2 * np.pi)
+                    angle = self.np_random.uniform(0, 2 * np.pi)
 
                     # Calculate the coordinates for the circle_position
                     delta_x = min_circle_distance * np.cos(angle)
@@ -110,7 +154,7 @@ class PatternManager:
                 while circle_position is None or np.linalg.norm(
                         circle_position - self.last_circle_position) != pattern_distance:
                     # Generate a random angle in radians
-                    angle = np.random.uniform(0, 2 * np.pi)
+                    angle = self.np_random.uniform(0, 2 * np.pi)
 
                     # Calculate the coordinates for the circle_position
                     delta_x = pattern_distance * np.cos(angle)
@@ -123,7 +167,7 @@ class PatternManager:
                         circle_position = np.array([x_coord, y_coord])
                         self.last_circle_position = circle_position
                         break
-            for onset_time, onset_duration in zip(onset_times, onset_durations):
+            for onset_time, onset_duration, onset_label in zip(onset_times, onset_durations, labels):
                 max_possible_distance = max(np.linalg.norm(bottom_right_corner - self.last_circle_position),
                                             np.linalg.norm(top_right_corner - self.last_circle_position),
                                             np.linalg.norm(bottom_left_corner - self.last_circle_position),
@@ -131,7 +175,7 @@ class PatternManager:
                 if max_possible_distance < circle_distance:
                     while np.linalg.norm(circle_position - self.last_circle_position) != min_circle_distance:
                         # Generate a random angle in radians
-                        angle = np.random.uniform(0, 2 * np.pi)
+                        angle = self.np_random.uniform(0, 2 * np.pi)
 
                         # Calculate the coordinates for the circle_position
                         delta_x = min_circle_distance * np.cos(angle)
@@ -143,14 +187,14 @@ class PatternManager:
                         if np.linalg.norm(
                                 np.array([x_coord, y_coord]) - self.last_circle_position) == min_circle_distance:
                             circle_position = np.array([x_coord, y_coord])
-                            self.generate_object(onset_time, onset_duration, circle_position)
+                            self.generate_object(onset_time, onset_duration, circle_position, onset_label, patterns)
                             self.last_circle_position = circle_position
                             break
                 else:
                     while circle_position is None or np.linalg.norm(
                             circle_position - self.last_circle_position) != circle_distance:
                         # Generate a random angle in radians
-                        angle = np.random.uniform(0, 2 * np.pi)
+                        angle = self.np_random.uniform(0, 2 * np.pi)
 
                         # Calculate the coordinates for the circle_position
                         delta_x = circle_distance * np.cos(angle)
@@ -161,18 +205,22 @@ class PatternManager:
                         # Check if the Euclidean distance is within the desired range
                         if np.linalg.norm(np.array([x_coord, y_coord]) - self.last_circle_position) == circle_distance:
                             circle_position = np.array([x_coord, y_coord])
-                            self.generate_object(onset_time, onset_duration, circle_position)
+                            self.generate_object(onset_time, onset_duration, circle_position, onset_label, patterns)
                             self.last_circle_position = circle_position
                             break
 
-    def generate_object(self, onset_time, onset_duration, circle_position):
+    def generate_object(self, onset_time, onset_duration, circle_position, onset_label=1, patterns=None):
         '''
         Determine object type according to the onset duration and add to the pattern queue
         :param onset_time: onset timing for one note
         :param onset_duration: onset duration for one note
         :param circle_position: the note's circle position on the screen from generate_patterns
+        :param onset_label: 1 for vocal, 0 for background onsets
+        :param patterns: list the pattern is appended to (default: the map, self.patterns)
         :return: nothing
         '''
+        if patterns is None:
+            patterns = self.patterns
         # a little buffering in case detected onsets are too close to each other
         if onset_time - self.last_onset_time < 10:
             return
@@ -185,48 +233,54 @@ class PatternManager:
             ending_t = t + self.beat_duration * self.fps
         else:
             # choose slider object if the onset duration is long enough
-            pattern_type = random.choice(["Line", "CubicBezier", "Arc"])
+            pattern_type = self.random.choice(["Line", "CubicBezier", "Arc"])
             t = onset_time
             starting_t = t
             ending_t = t + onset_duration / 16
             length = 100 / (self.beat_duration * self.fps) * onset_duration / 8
 
         # randomize circle color
-        color = (random.randint(150, 255), random.randint(150, 255), random.randint(150, 255))
+        color = (self.random.randint(150, 255), self.random.randint(150, 255), self.random.randint(150, 255))
+        if onset_label == 0:
+            # background notes are tinted blue, so that the two streams can be told apart
+            color = (color[0] // 2, color[1] // 2 + 64, 255)
 
         # add the pattern object to the pattern queue according to the previously determined object type
         if pattern_type == "TapPattern":
             position = circle_position
             tap = TapPattern(position, self.radius, self.stroke_width, color, t, self.lifetime, self.approach_rate)
-            self.add_pattern(tap)
+            patterns.append(tap)
         elif pattern_type == "Line":
             position1 = circle_position
-            position2 = np.array([random.uniform(0, self.screen_width), random.uniform(0, self.screen_height)])
+            position2 = self.random_position()
             line = Line(self.radius, self.stroke_width, position1, position2, color, starting_t, ending_t,
                         self.lifetime, self.approach_rate, length=length)
-            self.add_pattern(line)
+            patterns.append(line)
             self.last_onset_time = ending_t
         elif pattern_type == "CubicBezier":
             position1 = circle_position
-            position2 = np.array([random.uniform(0, self.screen_width), random.uniform(0, self.screen_height)])
-            position3 = np.array([random.uniform(0, self.screen_width), random.uniform(0, self.screen_height)])
-            position4 = np.array([random.uniform(0, self.screen_width), random.uniform(0, self.screen_height)])
+            position2 = self.random_position()
+            position3 = self.random_position()
+            position4 = self.random_position()
             curve = CubicBezier(self.radius, self.stroke_width, position1, position2, position3, position4, color,
                                 starting_t, ending_t, self.lifetime, self.approach_rate, length=length)
-            self.add_pattern(curve)
+            patterns.append(curve)
             self.last_onset_time = ending_t
         else:
             position1 = circle_position
-            position2 = np.array([random.uniform(0, self.screen_width), random.uniform(0, self.screen_height)])
+            position2 = self.random_position()
             # curve radius must be longer than half the distance between position 1 and position 2
             dist = np.linalg.norm(position1 - position2)
-            curve_radius = random.uniform(dist / 1.7, dist / 1.05)
-            curve_radius *= random.choice([-1, 1])  # negative curve radius inverts the curve direction
+            curve_radius = self.random.uniform(dist / 1.7, dist / 1.05)
+            curve_radius *= self.random.choice([-1, 1])  # negative curve radius inverts the curve direction
             curve = Arc(self.radius, self.stroke_width, position1, position2, curve_radius, color, starting_t,
                         ending_t, self.lifetime, self.approach_rate, length=length)
-            self.add_pattern(curve)
+            patterns.append(curve)
             self.last_onset_time = ending_t
 
+    def random_position(self):
+        return np.array([self.random.uniform(0, self.screen_width), self.random.uniform(0, self.screen_height)])
+
     def add_pattern(self, pattern):
         self.patterns.append(pattern)
 
@@ -263,19 +317,21 @@ class PatternManager:
         :return: If no patterns have been missed (not clicked and zero marks)
         """
         flag = True
-        for pattern in self.pattern_queue:
-            isPastLifetime = pattern.render(win, t)
-            if isPastLifetime:
-                # Check if the pattern was missed
-                pattern = self.pattern_queue[0]
-                isHit = pattern.pressed
-                flag = isHit and pattern.score > 0
-
-                # Update queue and pattern list
-                self.patterns = self.patterns[1:]
-                self.pattern_queue = self.pattern_queue[1:]
-                if self.queue_length < len(self.patterns):  # If not, all patterns have already been loaded to the queue
-                    self.pattern_queue.append(self.patterns[self.queue_length])
+        with self.lock:
+            for pattern in self.pattern_queue:
+                isPastLifetime = pattern.render(win, t)
+                if isPastLifetime:
+                    # Check if the pattern was missed
+                    pattern = self.pattern_queue[0]
+                    isHit = pattern.pressed
+                    flag = isHit and pattern.score > 0
+
+                    # Update queue and pattern list
+                    self.patterns = self.patterns[1:]
+                    self.pattern_queue = self.pattern_queue[1:]
+                    # If not, all patterns have already been loaded to the queue
+                    if self.queue_length < len(self.patterns):
+                        self.pattern_queue.append(self.patterns[self.queue_length])
         return flag
 
     def hot_load_caches(self):
@@ -0,0 +1,317 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+from game.utils.downloads import video_id
+
+
+def write_archive(archive_path, **arrays):
+    """
+    Write a numpy archive atomically, so that a crash never leaves a half written archive behind. The archive is
+    written to a temporary file of its own first, as other processes may be writing the same archive at the same time.
+    :param archive_path: path of the archive
+    :param arrays: arrays to store, by name
+    """
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp.npz", dir=os.path.dirname(archive_path))
+    try:
+        with os.fdopen(fd, "wb") as file:
+            np.savez(file, **arrays)
+        os.replace(temp_path, archive_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class AnalysisCache:
+    """
+    Persistent cache for downloaded audio and the musical data extracted from it.
+    Audio files are stored per source (e.g. YouTube link), while analysis results are content-addressed: they are keyed
+    by a hash of the audio data together with every parameter that influences the analysis output. The decoded audio
+    is kept as well, keyed by the audio hash and sampling rate, so that analysing a song again does not decode it again,
+    and so are the intermediate results of the analysis stages, see StageCache.
+    Each analysis entry is a single versioned archive. Files are evicted in least-recently-used order once the cache
+    grows past its size or entry limits, and the fingerprints of a song are removed from the fingerprint index together
+    with its last analysis entry, as they only serve to find its analyses.
+    """
+    ARCHIVE_VERSION = 1
+    INDEX_VERSION = 1
+
+    def __init__(self, cache_dir, max_bytes=1024 ** 3, max_entries=256):
+        """
+        :param cache_dir: directory for the cache, created if it does not exist
+        :param max_bytes: maximum total size of all cached files
+        :param max_entries: maximum number of cached files
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.audio_dir = os.path.join(cache_dir, "audio")
+        self.analysis_dir = os.path.join(cache_dir, "analysis")
+        self.pcm_dir = os.path.join(cache_dir, "pcm")
+        self.stage_dir = os.path.join(cache_dir, "stages")
+        self.fingerprint_dir = os.path.join(cache_dir, "fingerprints")  # see fingerprint.FingerprintIndex
+        self.download_dir = os.path.join(cache_dir, "downloads")  # see downloads.DownloadManager
+        self.index_file = os.path.join(cache_dir, "index.json")
+        os.makedirs(self.audio_dir, exist_ok=True)
+        os.makedirs(self.analysis_dir, exist_ok=True)
+        os.makedirs(self.pcm_dir, exist_ok=True)
+        os.makedirs(self.stage_dir, exist_ok=True)
+
+        # hit and miss counters of this session, the cumulative counters are kept in the index
+        self.hits = 0
+        self.misses = 0
+        self.index = self._read_index()
+
+    def audio_path(self, source):
+        """
+        Path at which the audio downloaded from a source is kept, as a WAV file (see ingest.py). Every form of link to
+        the same YouTube video shares it.
+        :param source: YouTube link or any other string identifying where the audio comes from
+        :return: path of the audio file (may not exist yet)
+        """
+        name = hashlib.sha1((video_id(source) or source).encode("utf-8")).hexdigest()
+        return os.path.join(self.audio_dir, name + ".wav")
+
+    def pcm_path(self, audio_digest, sr):
+        """
+        Path at which the decoded audio is kept, see pcm.py
+        :param audio_digest: content hash of the audio, from audio_digest
+        :param sr: sampling rate the audio is decoded at
+        :return: path of the PCM file (may not exist yet)
+        """
+        return os.path.join(self.pcm_dir, f"{audio_digest[:40]}_{sr}.pcm")
+
+    @staticmethod
+    def audio_digest(file_path, chunk_size=1024 ** 2):
+        """
+        Hash of the content of an audio file
+        :param file_path: path to the audio file
+        :param chunk_size: number of bytes read at a time
+        :return: hex digest of the file content
+        """
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(audio_digest, **params):
+        """
+        Cache key of an analysis result
+        :param audio_digest: content hash of the analysed audio, from audio_digest
+        :param params: every parameter that changes the analysis output, including the analysis code version
+        :return: cache key
+        """
+        description = json.dumps({"audio": audio_digest, **params}, sort_keys=True, default=str)
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()[:40]
+
+    def load(self, key):
+        """
+        Load cached musical data
+        :param key: cache key from AnalysisCache.key
+        :return: onset times, durations, bars and tempo, and onset labels for dual stream results, or None if not
+        cached
+        """
+        music_data = self.peek(key)
+        if music_data is None:
+            self.misses += 1
+            self._count("misses")
+            self._write_index()
+            return None
+        self.hits += 1
+        self._count("hits")
+        self.touch(self._analysis_path(key))
+        return music_data
+
+    def peek(self, key):
+        """
+        Load cached musical data without counting the lookup or marking the entry as used, so that it can be called
+        from processes that must not write to the cache index
+        :param key: cache key from AnalysisCache.key
+        :return: onset times, durations, bars and tempo, and onset labels for dual stream results, or None if not
+        cached
+        """
+        archive_path = self._analysis_path(key)
+        if not os.path.exists(archive_path):
+            return None
+        try:
+            with np.load(archive_path) as archive:
+                if int(archive["version"]) != self.ARCHIVE_VERSION:
+                    return None
+                music_data = (archive["onset_times"], archive["onset_durations"], archive["onset_bars"],
+                              float(archive["tempo"][0]))
+                if "onset_labels" in archive.files:
+                    music_data += (archive["onset_labels"],)
+                return music_data
+        except (OSError, KeyError, ValueError):
+            return None  # corrupted archive, treat as a miss and let it be overwritten
+
+    def store(self, key, music_data, audio_digest=None):
+        """
+        Store musical data in the cache, evicting old entries if the cache is full
+        :param key: cache key from AnalysisCache.key
+        :param music_data: onset times, durations, bars and tempo, and onset labels for dual stream results
+        :param audio_digest: content hash of the analysed audio, whose fingerprints are removed once none of its
+        analysis entries is left
+        """
+        onset_times, onset_durations, onset_bars, tempo, *onset_labels = music_data
+        labels = {"onset_labels": onset_labels[0]} if onset_labels else {}
+        archive_path = self._analysis_path(key)
+        write_archive(archive_path, version=self.ARCHIVE_VERSION, onset_times=onset_times,
+                      onset_durations=onset_durations, onset_bars=onset_bars, tempo=np.atleast_1d(tempo).astype(float),
+                      **labels)
+        self.touch(archive_path, audio_digest=audio_digest)
+
+    def touch(self, file_path, audio_digest=None):
+        """
+        Register a file in the cache, or mark it as most recently used, then evict old files if needed
+        :param file_path: path of a file inside the cache directory
+        :param audio_digest: content hash of the audio of an analysis entry, see store
+        """
+        name = os.path.relpath(file_path, self.cache_dir)
+        entry = {"size": os.path.getsize(file_path), "last_access": time.time()}
+        audio_digest = audio_digest or self.index["entries"].get(name, {}).get("digest")
+        if audio_digest is not None:
+            entry["digest"] = audio_digest
+        self.index["entries"][name] = entry
+        self._evict(keep=name)
+        self._write_index()
+
+    def remove(self, file_path):
+        """
+        Remove a file from the cache
+        :param file_path: path of a file inside the cache directory
+        """
+        entry = self.index["entries"].pop(os.path.relpath(file_path, self.cache_dir), None)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+        self._forget_fingerprints([entry])
+        self._write_index()
+
+    def stats(self):
+        """
+        :return: dictionary with the hit and miss counts of this session and in total, and the cache usage
+        """
+        total = self.index["stats"]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "total_hits": total["hits"],
+            "total_misses": total["misses"],
+            "entries": len(self.index["entries"]),
+            "bytes": sum(entry["size"] for entry in self.index["entries"].values()),
+        }
+
+    def _analysis_path(self, key):
+        return os.path.join(self.analysis_dir, key + ".npz")
+
+    def _count(self, counter):
+        self.index["stats"][counter] += 1
+
+    def _evict(self, keep=None):
+        """
+        Remove least recently used files until the cache is within its limits
+        :param keep: name of a file that must not be evicted (the one currently in use)
+        """
+        entries = self.index["entries"]
+        # drop entries whose files have been removed by hand
+        dropped = [entries.pop(name) for name in list(entries)
+                   if not os.path.exists(os.path.join(self.cache_dir, name))]
+
+        total_bytes = sum(entry["size"] for entry in entries.values())
+        for name in sorted(entries, key=lambda n: entries[n]["last_access"]):
+            if total_bytes <= self.max_bytes and len(entries) <= self.max_entries:
+                break
+            if name == keep:
+                continue
+            dropped.append(entries.pop(name))
+            total_bytes -= dropped[-1]["size"]
+            os.remove(os.path.join(self.cache_dir, name))
+        self._forget_fingerprints(dropped)
+
+    def _forget_fingerprints(self, dropped):
+        """
+        Remove the fingerprints of the songs that have no analysis entry left from the fingerprint index
+        :param dropped: index entries that have just been removed (None for files that were not in the index)
+        """
+        digests = {entry["digest"] for entry in dropped if entry is not None and "digest" in entry}
+        digests -= {entry.get("digest") for entry in self.index["entries"].values()}
+        if digests and os.path.isdir(self.fingerprint_dir):
+            # the fingerprint module pulls in librosa and scipy, it is only imported when there is something to remove
+            from game.utils.fingerprint import FingerprintIndex
+            FingerprintIndex(self.fingerprint_dir).remove(digests)
+
+    def _read_index(self):
+        try:
+            with open(self.index_file, "r") as file:
+                index = json.load(file)
+            if index.get("version") == self.INDEX_VERSION:
+                return index
+        except (FileNotFoundError, ValueError):
+            pass
+        return {"version": self.INDEX_VERSION, "entries": {}, "stats": {"hits": 0, "misses": 0}}
+
+    def _write_index(self):
+        temp_file = self.index_file + ".tmp"
+        with open(temp_file, "w") as file:
+            json.dump(self.index, file)
+        os.replace(temp_file, self.index_file)
+
+
+class StageCache:
+    """
+    Intermediate results of the analysis of one song (raw onsets and durations, and the tempo), kept in an
+    AnalysisCache. Each result is keyed by the audio hash together with the parameters of the stage that produced it,
+    so that analysing the song again with another tempo or rounding only reruns the stages that depend on them.
+    The separated audio is not kept: it is as large as the decoded song, and would push the small analysis entries out
+    of the cache, while the raw onsets that depend on the same parameters are always found first.
+    """
+
+    def __init__(self, cache, audio_digest):
+        """
+        :param cache: AnalysisCache the results are kept in
+        :param audio_digest: content hash of the analysed audio, from AnalysisCache.audio_digest
+        """
+        self.cache = cache
+        self.audio_digest = audio_digest
+
+    def load(self, stage, **params):
+        """
+        Load the cached result of a stage
+        :param stage: name of the stage
+        :param params: every parameter the result of the stage depends on, including the analysis code version
+        :return: dictionary of arrays, or None if not cached
+        """
+        archive_path = self._path(stage, params)
+        if not os.path.exists(archive_path):
+            return None
+        try:
+            with np.load(archive_path) as archive:
+                if int(archive["version"]) != AnalysisCache.ARCHIVE_VERSION:
+                    return None
+                arrays = {name: archive[name] for name in archive.files if name != "version"}
+        except (OSError, KeyError, ValueError):
+            return None  # corrupted archive, treat as a miss and let it be overwritten
+        self.cache.touch(archive_path)
+        return arrays
+
+    def store(self, stage, arrays, **params):
+        """
+        Store the result of a stage, evicting old entries if the cache is full
+        :param stage: name of the stage
+        :param arrays: dictionary of arrays
+        :param params: every parameter the result of the stage depends on, including the analysis code version
+        """
+        archive_path = self._path(stage, params)
+        write_archive(archive_path, version=AnalysisCache.ARCHIVE_VERSION, **arrays)
+        self.cache.touch(archive_path)
+
+    def _path(self, stage, params):
+        key = AnalysisCache.key(self.audio_digest, stage=stage, **params)
+        return os.path.join(self.cache.stage_dir, f"{stage}_{key}.npz")
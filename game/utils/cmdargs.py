@@ -1,27 +1,81 @@
 import argparse
 
+
+def add_map_arguments(parser, defaults=True):
+    """
+    Add the options of how songs are analysed and mapped, which the game and the analyze command share
+    :param parser: parser to add the options to
+    :param defaults: set the default values, False for the analyze command, so that the options given before it are
+    not overwritten by its defaults
+    """
+    def default(value):
+        return value if defaults else argparse.SUPPRESS
+
+    parser.add_argument('-s', "--seed", type=int,
+                        help="Seed for random number generator",
+                        default=default(None))
+    parser.add_argument('-t', "--tempo", type=int,
+                        help="Specify song BPM",
+                        default=default(None))
+    parser.add_argument('-d', "--difficulty", type=float,
+                        help="Difficulty",
+                        default=default(None))
+    parser.add_argument('-a', "--ar", type=float,
+                        help="Circle approach rate",
+                        default=default(None))
+    parser.add_argument('-q', "--quality", type=str, choices=["fast", "balanced", "accurate"],
+                        help="Song analysis quality, faster tiers place notes less accurately (default: accurate)",
+                        default=default("accurate"))
+    parser.add_argument("--dual-stream", action="store_true",
+                        help="Map the background onsets as well as the vocal ones, background notes are tinted blue\n"
+                             "(not used with --progressive)",
+                        default=default(False))
+
+
 parser = argparse.ArgumentParser(
     formatter_class=argparse.RawTextHelpFormatter,
     description="Pygame rhythm game app with automatic map generation."
 )
-parser.add_argument('-s', "--seed", type=int,
-                    help="Seed for random number generator",
-                    default=None)
-parser.add_argument('-t', "--tempo", type=int,
-                    help="Specify song BPM",
+add_map_arguments(parser)
+parser.add_argument('-y', "--youtube", type=str,
+                    help="YouTube link for the music video",
                     default=None)
-parser.add_argument('-d', "--difficulty", type=float,
-                    help="Difficulty",
+parser.add_argument('-f', "--file", type=str,
+                    help="Local audio file to play instead of a YouTube link, in any format FFmpeg reads",
                     default=None)
-parser.add_argument('-a', "--ar", type=float,
-                    help="Circle approach rate",
+parser.add_argument("--progressive", type=float, nargs='?', const=30.0,
+                    help="Start playing once the first seconds of the song are analysed (default: 30 seconds),\n"
+                         "and analyse the rest while playing. The map has the notes of the balanced quality tier,\n"
+                         "but their rounding grid is aligned with the first segments only, so notes can be up to\n"
+                         "an eighth of a beat off the map of the whole song (see benchmarks/bench_streaming.py)",
                     default=None)
-parser.add_argument('-y', "--youtube", type=str,
-                    help="YouTube link for the music video",
+parser.add_argument("--profile", type=str,
+                    help="Write the time spent in every stage of the song analysis to this JSON file",
                     default=None)
+parser.add_argument("--profile-memory", action="store_true",
+                    help="With --profile, also record the allocation peak of every stage (slows the analysis down)",
+                    default=False)
+
+subparsers = parser.add_subparsers(dest="command")
+analyze_parser = subparsers.add_parser(
+    "analyze",
+    formatter_class=argparse.RawTextHelpFormatter,
+    help="Analyse songs without opening the game and store their maps in the cache"
+)
+analyze_parser.add_argument("sources", nargs="+",
+                            help="Music folders, audio files or YouTube links")
+analyze_parser.add_argument('-w', "--workers", type=int,
+                            help="Number of worker processes (default: number of CPUs)",
+                            default=None)
+analyze_parser.add_argument("--downloads", type=int,
+                            help="Number of YouTube links downloaded at the same time (default: 4)",
+                            default=4)
+add_map_arguments(analyze_parser, defaults=False)
 
 parser.epilog = """Example usage:
   python main.py -d 6 -a 10 --tempo 246 -y "https://www.youtube.com/watch?v=-LwBbLa_Vhc"
+  python main.py -d 5 --file song.m4a
+  python main.py analyze ~/Music "https://www.youtube.com/watch?v=-LwBbLa_Vhc" -w 4 -q fast
 """
 
 args = parser.parse_args()
@@ -0,0 +1,223 @@
+import hashlib
+import http.client
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+YOUTUBE_VIDEO_ID = re.compile(r"(?:youtube\.com/(?:watch\?(?:.*&)?v=|embed/|shorts/|live/)|youtu\.be/)([\w-]{11})")
+
+
+def video_id(url):
+    """
+    YouTube video ID of a link, which is the same for every form of link to a video
+    :param url: link to a video
+    :return: the 11 character video ID, or None if it is not a YouTube link
+    """
+    match = YOUTUBE_VIDEO_ID.search(url)
+    return match.group(1) if match is not None else None
+
+
+class DownloadError(Exception):
+    """
+    Failed download, with a reason that callers can report and act on:
+    "unavailable" if the link cannot be resolved to a file (removed or private video, no audio stream), "http" if the
+    server refused the transfer, "network" if the connection failed or was cut, and "io" if the file could not be
+    written.
+    """
+
+    def __init__(self, source, reason, message, retryable=False):
+        """
+        :param source: link that failed to download
+        :param reason: one of "unavailable", "http", "network" and "io"
+        :param message: description of the failure
+        :param retryable: whether trying again may succeed
+        """
+        super().__init__(f"{reason}: {message}")
+        self.source = source
+        self.reason = reason
+        self.message = message
+        self.retryable = retryable
+        self.attempts = 1
+
+    def as_dict(self):
+        """
+        :return: dictionary with the source, reason, message and number of attempts
+        """
+        return {"source": self.source, "reason": self.reason, "error": self.message, "attempts": self.attempts}
+
+
+class DownloadManager:
+    """
+    Downloads the audio of links into a directory that doubles as a cache: files are named after the video ID (see
+    video_id), so that a video is only downloaded once whatever the form of its links.
+    Transfers are written to a .part file in ranges of range_size bytes, and resumed from where they stopped after a
+    failure, also in a later run. Failed transfers are retried with exponential backoff, and download_many downloads
+    several links at once.
+    The resolver turns a link into the file to transfer, by default youtubeDL.resolve_youtube_stream. Any other
+    resolver, e.g. one that points to a local HTTP server, can stand in for it.
+    """
+
+    def __init__(self, download_dir, resolver=None, max_workers=4, retries=3, retry_delay=1.0,
+                 range_size=8 * 1024 ** 2, timeout=30):
+        """
+        :param download_dir: directory of the downloaded files, created if it does not exist
+        :param resolver: function called with a link, that returns the URL of the file to transfer, its file
+        extension and its size in bytes (None if unknown), or raises DownloadError
+        :param max_workers: number of links downloaded at the same time by download_many
+        :param retries: number of times a failed download is tried again, if it may succeed
+        :param retry_delay: seconds to wait before the first retry, doubled before every further retry
+        :param range_size: number of bytes requested at a time
+        :param timeout: seconds without a response after which a transfer fails
+        """
+        if resolver is None:
+            from game.utils.youtubeDL import resolve_youtube_stream  # pytube is only needed for YouTube links
+            resolver = resolve_youtube_stream
+        self.download_dir = download_dir
+        self.resolver = resolver
+        self.max_workers = max_workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.range_size = range_size
+        self.timeout = timeout
+        self.durations = {}  # seconds spent on every downloaded link, including retries
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        os.makedirs(download_dir, exist_ok=True)
+
+    @staticmethod
+    def name(url):
+        """
+        File name of a link without extension, its video ID for YouTube links
+        :param url: link to a video
+        :return: file name
+        """
+        return video_id(url) or hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def path(self, url):
+        """
+        Path of the downloaded file of a link
+        :param url: link to a video
+        :return: file path, or None if the link has not been downloaded
+        """
+        name = self.name(url)
+        for entry in os.scandir(self.download_dir):
+            if os.path.splitext(entry.name)[0] == name and not entry.name.endswith(".part"):
+                return entry.path
+        return None
+
+    def download(self, url):
+        """
+        Download a link, unless it has been downloaded before
+        :param url: link to a video
+        :return: path of the downloaded file
+        """
+        start = time.perf_counter()
+        with self._lock(self.name(url)):
+            attempt = 1
+            while True:
+                try:
+                    file_path = self.path(url) or self._download(url)
+                    break
+                except DownloadError as error:
+                    error.attempts = attempt
+                    if not error.retryable or attempt > self.retries:
+                        raise
+                    delay = self.retry_delay * 2 ** (attempt - 1)
+                    print(f"Download of {url} failed ({error}), retrying in {delay:.0f} s")
+                    time.sleep(delay)
+                    attempt += 1
+        self.durations[url] = time.perf_counter() - start
+        return file_path
+
+    def download_many(self, urls):
+        """
+        Download several links at once, at most max_workers at a time
+        :param urls: links to videos
+        :return: generator of the link, the path of its file (None if it failed) and the DownloadError (None if it
+        succeeded), in the order the downloads finish
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.download, url): url for url in dict.fromkeys(urls)}
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except DownloadError as error:
+                    yield futures[future], None, error
+
+    def _lock(self, name):
+        # the same video is never transferred by two threads at once
+        with self._locks_lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def _download(self, url):
+        """
+        Resolve a link and transfer its file
+        :return: path of the downloaded file
+        """
+        try:
+            file_url, extension, size = self.resolver(url)
+        except DownloadError:
+            raise
+        except (urllib.error.URLError, http.client.HTTPException, ConnectionError, TimeoutError) as error:
+            raise DownloadError(url, "network", f"{type(error).__name__}: {error}", retryable=True) from error
+        except Exception as error:
+            raise DownloadError(url, "unavailable", f"{type(error).__name__}: {error}") from error
+
+        file_path = os.path.join(self.download_dir, self.name(url) + extension)
+        part_path = file_path + ".part"
+        try:
+            self._transfer(file_url, part_path, size)
+        except urllib.error.HTTPError as error:
+            # rate limits and server errors are temporary
+            retryable = error.code == 429 or error.code >= 500
+            raise DownloadError(url, "http", f"HTTP {error.code} {error.reason}", retryable=retryable) from error
+        except (urllib.error.URLError, http.client.HTTPException, ConnectionError, TimeoutError) as error:
+            raise DownloadError(url, "network", f"{type(error).__name__}: {error}", retryable=True) from error
+        except OSError as error:
+            raise DownloadError(url, "io", f"{type(error).__name__}: {error}") from error
+        os.replace(part_path, file_path)
+        return file_path
+
+    def _transfer(self, file_url, part_path, size=None):
+        """
+        Transfer a file into its .part file range by range, continuing after the bytes it already has
+        :param file_url: URL of the file
+        :param part_path: path of the partial file
+        :param size: size of the file in bytes, None if unknown
+        """
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if size is not None and offset > size:
+            offset = 0  # not the same file, start over
+        while size is None or offset < size:
+            request = urllib.request.Request(file_url, headers={
+                "Range": f"bytes={offset}-{offset + self.range_size - 1}"})
+            try:
+                response = urllib.request.urlopen(request, timeout=self.timeout)
+            except urllib.error.HTTPError as error:
+                if error.code == 416 and offset > 0 and size is None:
+                    return  # the previous range ended at the end of the file
+                raise
+            with response, open(part_path, "r+b" if offset else "wb") as file:
+                if response.status == 206:
+                    # Content-Range: bytes first-last/size
+                    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                    size = int(total) if total.isdigit() else size
+                else:
+                    offset = 0  # the server ignores ranges and sends the whole file
+                file.seek(offset)
+                file.truncate()
+                n_bytes = 0
+                for chunk in iter(lambda: response.read(1024 ** 2), b""):
+                    file.write(chunk)
+                    n_bytes += len(chunk)
+            offset += n_bytes
+            if response.status != 206:
+                size = offset
+            elif n_bytes == 0:
+                raise ConnectionError(f"no data received at byte {offset}")
+        if offset != size:
+            raise ConnectionError(f"received {offset} of {size} bytes")
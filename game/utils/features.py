@@ -0,0 +1,113 @@
+import numpy as np
+import librosa
+
+
+class FeatureStore:
+    """
+    Computes the spectral features of one audio signal on demand and keeps them, so that every transform needed by the
+    onset detection pipeline is computed only once per parameter set.
+    Complex spectrograms are only kept when explicitly requested through stft, magnitudes and the features derived from
+    them are always kept.
+    """
+
+    def __init__(self, y, sr):
+        """
+        :param y: audio signal
+        :param sr: sampling rate
+        """
+        self.y = y
+        self.sr = sr
+        self._features = {}
+
+    def stft(self, n_fft=2048, hop_length=512, center=True):
+        """
+        Complex short time fourier transform of the signal
+        :param n_fft: stft frame length
+        :param hop_length: stft frame hop size
+        :param center: pad the signal so that frames are centered at their timestamps
+        :return: complex spectrogram
+        """
+        key = ("stft", n_fft, hop_length, center)
+        if key not in self._features:
+            self._features[key] = librosa.stft(self.y, n_fft=n_fft, hop_length=hop_length, center=center)
+        return self._features[key]
+
+    def magnitude(self, n_fft=2048, hop_length=512, center=True):
+        """
+        Magnitude of the short time fourier transform of the signal
+        :param n_fft: stft frame length
+        :param hop_length: stft frame hop size
+        :param center: pad the signal so that frames are centered at their timestamps
+        :return: magnitude spectrogram
+        """
+        key = ("magnitude", n_fft, hop_length, center)
+        if key not in self._features:
+            self._features[key] = np.abs(self._complex(n_fft, hop_length, center))
+        return self._features[key]
+
+    def magphase(self, n_fft=2048, hop_length=512, center=True):
+        """
+        Magnitude and phase of the short time fourier transform of the signal, only the magnitude is kept
+        :param n_fft: stft frame length
+        :param hop_length: stft frame hop size
+        :param center: pad the signal so that frames are centered at their timestamps
+        :return: magnitude spectrogram, phase spectrogram
+        """
+        key = ("magnitude", n_fft, hop_length, center)
+        magnitude, phase = librosa.magphase(self._complex(n_fft, hop_length, center))
+        self._features.setdefault(key, magnitude)
+        return self._features[key], phase
+
+    def melspectrogram(self, n_fft=2048, hop_length=512):
+        """
+        Mel power spectrogram of the signal, computed from the cached magnitude spectrogram
+        :param n_fft: stft frame length
+        :param hop_length: stft frame hop size
+        :return: mel spectrogram
+        """
+        key = ("melspectrogram", n_fft, hop_length)
+        if key not in self._features:
+            power = self.magnitude(n_fft, hop_length) ** 2
+            self._features[key] = librosa.feature.melspectrogram(S=power, sr=self.sr, fmax=0.5 * self.sr)
+        return self._features[key]
+
+    def onset_envelope(self, n_fft=2048, hop_length=512):
+        """
+        Onset strength envelope of the signal, same as librosa.onset.onset_strength with default parameters
+        :param n_fft: stft frame length
+        :param hop_length: stft frame hop size
+        :return: onset strength envelope
+        """
+        key = ("onset_envelope", n_fft, hop_length)
+        if key not in self._features:
+            self._features[key] = mel_onset_envelope(self.melspectrogram(n_fft, hop_length), self.sr, n_fft=n_fft,
+                                                     hop_length=hop_length)
+        return self._features[key]
+
+    def clear(self):
+        """
+        Release all computed features
+        """
+        self._features.clear()
+
+    def _complex(self, n_fft, hop_length, center):
+        # reuse a kept complex spectrogram, otherwise compute a temporary one that is not kept
+        key = ("stft", n_fft, hop_length, center)
+        if key in self._features:
+            return self._features[key]
+        return librosa.stft(self.y, n_fft=n_fft, hop_length=hop_length, center=center)
+
+
+def mel_onset_envelope(mel, sr, n_fft=2048, hop_length=512):
+    """
+    Onset strength envelope of a mel power spectrogram, see FeatureStore.onset_envelope
+    The decibels are floored at 80 dB below the loudest bin of the whole spectrogram, so the envelope of a part of a
+    spectrogram differs from that part of the envelope of the whole one
+    :param mel: mel power spectrogram
+    :param sr: sampling rate
+    :param n_fft: stft frame length
+    :param hop_length: stft frame hop size
+    :return: onset strength envelope, one value per frame of the spectrogram
+    """
+    S = librosa.power_to_db(mel)
+    return librosa.onset.onset_strength(S=S, sr=sr, n_fft=n_fft, hop_length=hop_length)
@@ -0,0 +1,250 @@
+import json
+import os
+
+import librosa
+import numpy as np
+import scipy.ndimage
+from game.utils import notedetection
+from game.utils.pcm import read_pcm
+
+# Songs are fingerprinted at this sampling rate, whatever rate they are decoded at, so that every quality tier produces
+# the same fingerprint
+FINGERPRINT_SR = 11025
+FINGERPRINT_N_FFT = 1024
+FINGERPRINT_HOP_LENGTH = 256  # about 23 ms per frame
+FINGERPRINT_VERSION = 2
+# only the start of a song is fingerprinted, which is enough to recognise it and keeps the index small
+FINGERPRINT_DURATION = 60.0
+# largest difference in seconds between the lengths of two copies of a song, once their start offset is accounted for.
+# The start of a song also matches a shorter clip of it, e.g. a preview, whose map would stop where the clip ends.
+DURATION_TOLERANCE = 1.0
+
+
+def fingerprint(x, sr, peak_size=(15, 15), fan_out=5, max_time_delta=63):
+    """
+    Compact fingerprint of a song from the peaks of its spectrogram: every peak is paired with the next few peaks, and
+    each pair is hashed from the frequencies of both peaks and their time difference. The hashes do not depend on
+    where the song starts, so the same song with some silence added or cut at the start, or encoded differently, has
+    mostly the same hashes at shifted times.
+    :param x: decoded audio signal
+    :param sr: sampling rate
+    :param peak_size: neighbourhood (frequency bins, frames) a peak is the largest value of
+    :param fan_out: number of later peaks each peak is paired with
+    :param max_time_delta: largest time difference in frames between paired peaks, at most 63
+    :return: hashes, frame indices of the first peak of every hash
+    """
+    if sr != FINGERPRINT_SR:
+        x = librosa.resample(np.asarray(x, dtype=np.float32), orig_sr=sr, target_sr=FINGERPRINT_SR)
+    S = librosa.amplitude_to_db(np.abs(librosa.stft(x, n_fft=FINGERPRINT_N_FFT, hop_length=FINGERPRINT_HOP_LENGTH)),
+                                ref=np.max)
+    is_peak = (S == scipy.ndimage.maximum_filter(S, size=peak_size)) & (S > -60)
+    peak_bins, peak_frames = np.nonzero(is_peak)
+    order = np.lexsort((peak_bins, peak_frames))
+    peak_bins, peak_frames = peak_bins[order], peak_frames[order]
+
+    hashes = []
+    anchors = []
+    for step in range(1, fan_out + 1):
+        first_bins, first_frames = peak_bins[:-step], peak_frames[:-step]
+        second_bins, second_frames = peak_bins[step:], peak_frames[step:]
+        time_deltas = second_frames - first_frames
+        valid = (time_deltas > 0) & (time_deltas <= max_time_delta)
+        # 9 bits per frequency (bins halved) and 6 bits for the time difference
+        hashes.append(((first_bins[valid] >> 1) << 15) | ((second_bins[valid] >> 1) << 6) | time_deltas[valid])
+        anchors.append(first_frames[valid])
+    return np.concatenate(hashes).astype(np.uint32), np.concatenate(anchors).astype(np.int32)
+
+
+def fingerprint_file(filename, pcm_path=None, duration=FINGERPRINT_DURATION, decoded=None):
+    """
+    Fingerprint the start of an audio file
+    :param filename: file path to the audio
+    :param pcm_path: file keeping the decoded audio (see pcm.py), read instead of decoding the audio if it exists
+    :param duration: length in seconds of the fingerprinted start of the song
+    :param decoded: audio signal and sampling rate of the song if it has just been decoded, e.g. by
+    ingest.write_analysis_pcm, used instead of reading the audio again
+    :return: hashes, frame indices of the first peak of every hash, see fingerprint
+    """
+    if decoded is None and pcm_path is not None:
+        decoded = read_pcm(pcm_path)
+    if decoded is not None:
+        x, sr = decoded
+        x = x[:int(duration * sr)]
+    else:
+        x, sr = librosa.load(filename, sr=FINGERPRINT_SR, duration=duration)
+    return fingerprint(x, sr)
+
+
+def song_duration(filename, pcm_path=None):
+    """
+    Length of a song, read from its decoded audio if it exists
+    :param filename: file path to the audio
+    :param pcm_path: file keeping the decoded audio, see pcm.py
+    :return: length of the song in seconds
+    """
+    decoded = read_pcm(pcm_path) if pcm_path is not None else None
+    if decoded is not None:
+        return len(decoded[0]) / decoded[1]
+    return librosa.get_duration(path=filename)
+
+
+class FingerprintIndex:
+    """
+    On-disk index of the fingerprints of analysed songs, keyed by their audio hash (AnalysisCache.audio_digest), to
+    recognise a song that was analysed before from another source, e.g. a re-upload or a local copy.
+    All hashes are kept sorted in one archive, so that every hash of a song is looked up with a binary search. The
+    length of every song is kept with its hash, as only the start of the songs is fingerprinted.
+    """
+
+    def __init__(self, index_dir):
+        """
+        :param index_dir: directory of the index, created if it does not exist
+        """
+        self.index_dir = index_dir
+        self.archive_path = os.path.join(index_dir, "fingerprints.npz")
+        self.songs_path = os.path.join(index_dir, "fingerprints.json")
+        os.makedirs(index_dir, exist_ok=True)
+        self._read()
+
+    def __contains__(self, audio_digest):
+        return audio_digest in self.song_ids
+
+    def add(self, audio_digest, hashes, frames, duration):
+        """
+        Add the fingerprint of a song to the index, unless it is already there
+        :param audio_digest: content hash of the audio
+        :param hashes: hashes from fingerprint
+        :param frames: frame indices from fingerprint
+        :param duration: length of the song in seconds, see song_duration
+        """
+        self._read()  # the index may have changed on disk since it was read, e.g. songs evicted from the cache
+        if audio_digest in self.song_ids:
+            return
+        song_id = len(self.songs)
+        self.songs.append(audio_digest)
+        self.durations.append(float(duration))
+        self.song_ids[audio_digest] = song_id
+        hashes = np.concatenate([self.hashes, hashes])
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.frames = np.concatenate([self.frames, frames])[order]
+        self.song_indices = np.concatenate([self.song_indices, np.full(len(frames), song_id, dtype=np.int32)])[order]
+        self._write()
+
+    def remove(self, audio_digests):
+        """
+        Remove the fingerprints of songs from the index
+        :param audio_digests: content hashes of the audio of the songs, those that are not in the index are ignored
+        """
+        self._read()
+        removed = [self.song_ids[audio_digest] for audio_digest in audio_digests if audio_digest in self.song_ids]
+        if not removed:
+            return
+        is_kept = np.ones(len(self.songs), dtype=bool)
+        is_kept[removed] = False
+        # the remaining songs are numbered again in the same order
+        song_ids = (np.cumsum(is_kept) - 1).astype(np.int32)
+        kept_hashes = is_kept[self.song_indices]
+        self.hashes, self.frames = self.hashes[kept_hashes], self.frames[kept_hashes]
+        self.song_indices = song_ids[self.song_indices[kept_hashes]]
+        self.songs = [audio_digest for audio_digest, kept in zip(self.songs, is_kept) if kept]
+        self.durations = [duration for duration, kept in zip(self.durations, is_kept) if kept]
+        self.song_ids = {audio_digest: song_id for song_id, audio_digest in enumerate(self.songs)}
+        self._write()
+
+    def match(self, hashes, frames, duration, exclude=None, min_matches=20, min_ratio=0.05, tolerance=1,
+              duration_tolerance=DURATION_TOLERANCE):
+        """
+        Find an indexed song that the fingerprinted audio is a copy of, possibly starting earlier or later
+        :param hashes: hashes from fingerprint
+        :param frames: frame indices from fingerprint
+        :param duration: length in seconds of the fingerprinted song, see song_duration
+        :param exclude: audio hash of a song that is not matched, the fingerprinted audio itself
+        :param min_matches: least number of hashes that have to match at the same offset
+        :param min_ratio: least fraction of the hashes that have to match at the same offset
+        :param tolerance: offsets up to this many frames apart count as the same offset
+        :param duration_tolerance: largest difference in seconds between the length of the fingerprinted song and that
+        of the indexed song shifted by the offset, so that a song is not matched with a shorter or longer version of it
+        that starts the same way
+        :return: audio hash of the indexed song and the time in seconds that the fingerprinted audio starts later than
+        it, or None if there is no match
+        """
+        if len(hashes) == 0 or len(self.hashes) == 0:
+            return None
+        starts = np.searchsorted(self.hashes, hashes, side="left")
+        ends = np.searchsorted(self.hashes, hashes, side="right")
+        counts = ends - starts
+        if counts.sum() == 0:
+            return None
+        # every pair of a query hash and an indexed occurrence of it
+        query = np.repeat(np.arange(len(hashes)), counts)
+        indexed = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        songs = self.song_indices[indexed]
+        offsets = frames[query] - self.frames[indexed]
+        if exclude in self.song_ids:
+            other_songs = songs != self.song_ids[exclude]
+            songs, offsets = songs[other_songs], offsets[other_songs]
+            if len(songs) == 0:
+                return None
+
+        # count the matches at every offset of every song, together with the neighbouring offsets
+        pairs, pair_counts = np.unique(np.stack([songs, offsets]), axis=1, return_counts=True)
+        votes = {(song, offset): count for song, offset, count in zip(*pairs, pair_counts)}
+        best_song, best_offset, best_count = None, 0, 0
+        for (song, offset) in votes:
+            end = self.durations[song] + offset * FINGERPRINT_HOP_LENGTH / FINGERPRINT_SR
+            if abs(end - duration) > duration_tolerance:
+                continue
+            count = sum(votes.get((song, offset + shift), 0) for shift in range(-tolerance, tolerance + 1))
+            if count > best_count:
+                best_song, best_offset, best_count = song, offset, count
+        if best_count < max(min_matches, min_ratio * len(hashes)):
+            return None
+        return self.songs[best_song], best_offset * FINGERPRINT_HOP_LENGTH / FINGERPRINT_SR
+
+    def _read(self):
+        try:
+            with open(self.songs_path, "r") as file:
+                description = json.load(file)
+            with np.load(self.archive_path) as archive:
+                if description.get("version") != FINGERPRINT_VERSION or \
+                        len(archive["hashes"]) != description["n_hashes"] or \
+                        len(description["durations"]) != len(description["songs"]):
+                    raise ValueError("outdated or inconsistent fingerprint index")
+                self.hashes, self.frames = archive["hashes"], archive["frames"]
+                self.song_indices = archive["song_indices"]
+            self.songs, self.durations = description["songs"], description["durations"]
+        except (OSError, KeyError, ValueError):
+            self.hashes = np.zeros(0, dtype=np.uint32)
+            self.frames = np.zeros(0, dtype=np.int32)
+            self.song_indices = np.zeros(0, dtype=np.int32)
+            self.songs = []
+            self.durations = []
+        self.song_ids = {audio_digest: song_id for song_id, audio_digest in enumerate(self.songs)}
+
+    def _write(self):
+        # the archive is written first, the song list tells whether it is complete
+        temp_path = self.archive_path + ".tmp.npz"
+        np.savez(temp_path, hashes=self.hashes, frames=self.frames, song_indices=self.song_indices)
+        os.replace(temp_path, self.archive_path)
+        temp_path = self.songs_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump({"version": FINGERPRINT_VERSION, "n_hashes": len(self.hashes), "songs": self.songs,
+                       "durations": self.durations}, file)
+        os.replace(temp_path, self.songs_path)
+
+
+def shift_music_data(music_data, offset, duration=None):
+    """
+    Move the musical data of a song to a copy of it that starts later (or earlier, for a negative offset)
+    :param music_data: onset times, durations, bars and tempo, and onset labels for dual stream results
+    :param offset: time in seconds that the copy starts later
+    :param duration: length of the copy in seconds, onsets after it are dropped
+    :return: musical data of the copy
+    """
+    onset_times, onset_durations, onset_bars, tempo, *onset_labels = music_data
+    onset_times = onset_times + offset
+    keep = (onset_times >= 0) & (onset_times < duration if duration is not None else True)
+    # bars are counted from the start of the copy
+    shifted = (onset_times[keep], onset_durations[keep], notedetection.onset_bars(onset_times[keep], tempo), tempo)
+    return shifted + tuple(labels[keep] for labels in onset_labels)
@@ -0,0 +1,250 @@
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import time
+
+import ffmpeg
+import librosa
+import numpy as np
+import soundfile
+from game.utils.pcm import write_pcm
+
+# Songs that are downloaded or converted are decoded once to 16 bit PCM at this format, and kept as WAV files, which
+# pygame plays and the analysis reads without decoding a lossy format again
+PLAYBACK_SR = 44100
+PLAYBACK_CHANNELS = 2
+# formats that pygame.mixer.music plays, local files in other formats are converted like downloads
+PLAYABLE_EXTENSIONS = (".wav", ".ogg", ".mp3", ".flac")
+
+
+def decode(filename, sr=PLAYBACK_SR, channels=PLAYBACK_CHANNELS):
+    """
+    Decode an audio file of any format ffmpeg reads, through a pipe rather than an intermediate file
+    :param filename: file path to the audio
+    :param sr: sampling rate to resample to
+    :param channels: number of channels to mix to
+    :return: 16 bit samples, shaped (samples, channels)
+    """
+    try:
+        output, _ = (ffmpeg.input(filename)
+                     .output("pipe:", format="s16le", acodec="pcm_s16le", ac=channels, ar=sr)
+                     .run(capture_stdout=True, capture_stderr=True))
+    except ffmpeg.Error as error:
+        message = error.stderr.decode("utf-8", errors="replace").strip().splitlines()
+        raise RuntimeError(f"could not decode {filename}: {message[-1] if message else 'ffmpeg failed'}") from error
+    return np.frombuffer(output, dtype="<i2").reshape(-1, channels)
+
+
+def write_playback_audio(audio_path, samples, sr=PLAYBACK_SR):
+    """
+    Store decoded samples as a WAV file
+    :param audio_path: path of the WAV file
+    :param samples: 16 bit samples from decode
+    :param sr: sampling rate
+    """
+    temp_path = audio_path + ".tmp.wav"
+    soundfile.write(temp_path, samples, sr, subtype="PCM_16")
+    os.replace(temp_path, audio_path)  # atomic, so a crash never leaves a half written file behind
+
+
+def analysis_signal(samples, sr, analysis_sr):
+    """
+    Analysis input of decoded samples, identical to notedetection.load_audio of the WAV file written by
+    write_playback_audio
+    :param samples: 16 bit samples from decode
+    :param sr: sampling rate of the samples
+    :param analysis_sr: sampling rate of the analysis
+    :return: mono audio signal at the sampling rate analysis_sr
+    """
+    x = librosa.to_mono((samples.astype(np.float32) / np.float32(32768)).T)
+    return librosa.resample(x, orig_sr=sr, target_sr=analysis_sr, res_type="soxr_hq")
+
+
+def write_analysis_pcm(pcm_path, samples, sr, analysis_sr):
+    """
+    Store the analysis input of decoded samples (see pcm.py), so that the analysis does not read the WAV file again
+    :param pcm_path: path of the PCM file
+    :param samples: 16 bit samples from decode
+    :param sr: sampling rate of the samples
+    :param analysis_sr: sampling rate of the analysis
+    :return: the stored signal, see analysis_signal
+    """
+    x = analysis_signal(samples, sr, analysis_sr)
+    write_pcm(pcm_path, x, analysis_sr)
+    return x
+
+
+def ingest_file(filename, audio_path):
+    """
+    Decode an audio file once into a WAV file for playback and analysis
+    :param filename: file path to the audio, in any format ffmpeg reads
+    :param audio_path: path of the WAV file
+    :return: 16 bit samples and their sampling rate
+    """
+    samples = decode(filename)
+    write_playback_audio(audio_path, samples)
+    return samples, PLAYBACK_SR
+
+
+def ingest_download(url, audio_path, downloader=None):
+    """
+    Download a song and decode it once into a WAV file for playback and analysis, the downloaded file is discarded
+    :param url: link to the song
+    :param audio_path: path of the WAV file
+    :param downloader: function downloading the audio of a link as it is, called with the link and a directory to
+    download to, that returns the path of the downloaded file, or None or raises downloads.DownloadError if the
+    download failed (default: youtubeDL.download_youtube_stream)
+    :return: 16 bit samples and their sampling rate
+    """
+    if downloader is None:
+        from game.utils.youtubeDL import download_youtube_stream  # pytube is only needed for YouTube links
+        downloader = download_youtube_stream
+    # downloaded next to the WAV file, so that nothing is left behind in other directories
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(audio_path)) as download_dir:
+        downloaded_path = downloader(url, download_dir)
+        if downloaded_path is None or not os.path.exists(downloaded_path):
+            raise RuntimeError("download failed")
+        return ingest_file(downloaded_path, audio_path)
+
+
+def ingest_local(filename, cache):
+    """
+    Audio file to play and analyse for a local song: the file itself if pygame plays its format, or otherwise a WAV
+    copy in the cache, decoded when the file is new or has changed
+    :param filename: file path to the audio
+    :param cache: AnalysisCache keeping the converted copies
+    :return: path of the audio to play and analyse, and the 16 bit samples and their sampling rate if the file has
+    been decoded now, None otherwise
+    """
+    if not os.path.isfile(filename):
+        raise FileNotFoundError(f"audio file not found: {filename}")
+    if filename.lower().endswith(PLAYABLE_EXTENSIONS):
+        return filename, None
+    status = os.stat(filename)
+    audio_path = cache.audio_path(f"{os.path.abspath(filename)}:{status.st_size}:{status.st_mtime_ns}")
+    if os.path.exists(audio_path):
+        return audio_path, None
+    return audio_path, ingest_file(filename, audio_path)
+
+
+class DecodePipeline:
+    """
+    Decoding of an audio file with ffmpeg whose output is handed out block by block while the rest of the file is still
+    being decoded, so that the blocks can be analysed in the meantime.
+    A reader thread moves the PCM output of ffmpeg into a bounded queue, and iterating over the pipeline takes the
+    blocks out of it. When the analysis is slower than decoding, the queue fills up and ffmpeg waits on its full pipe,
+    so memory stays bounded. When it is faster, the analysis waits for the next block.
+    The time spent on both sides is recorded, see timings.
+    """
+
+    def __init__(self, filename, sr=22050, block_duration=1.0, queue_size=16):
+        """
+        :param filename: file path to the audio, or anything else ffmpeg reads, e.g. a link to a stream
+        :param sr: sampling rate to resample to
+        :param block_duration: length of the blocks in seconds
+        :param queue_size: number of decoded blocks that may wait for the analysis, 0 for no limit
+        """
+        self.filename = filename
+        self.sr = sr
+        self.block_size = max(int(block_duration * sr), 1)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._process = None
+        self._thread = None
+        self._stderr = None
+
+        self.n_samples = 0  # number of samples decoded so far
+        self.start_time = None  # time.perf_counter() when decoding started
+        self.decode_end_time = None  # when the last block was decoded
+        self.end_time = None  # when the last block was taken
+        self.wait_time = 0.0  # time spent waiting for blocks to be decoded
+
+    def __iter__(self):
+        """
+        Start decoding, and take the decoded blocks as they arrive
+        :return: generator of mono audio blocks at the sampling rate sr
+        """
+        self._start()
+        try:
+            while True:
+                start = time.perf_counter()
+                block = self._queue.get()
+                self.wait_time += time.perf_counter() - start
+                if block is None:
+                    break
+                if isinstance(block, Exception):
+                    raise block
+                yield block
+            self.end_time = time.perf_counter()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop decoding, also when the blocks have not all been taken
+        """
+        self._stop.set()
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+        if self._thread is not None:
+            self._thread.join()
+        if self._stderr is not None:
+            self._stderr.close()
+
+    @property
+    def timings(self):
+        """
+        Wall times in seconds of decoding and analysing the blocks, and of both at once, once all blocks are taken.
+        The analysis time is everything but waiting for blocks between the first block being requested and the last
+        being taken.
+        :return: dictionary with the decode, analysis, overlap and total times
+        """
+        total = self.end_time - self.start_time
+        decode = self.decode_end_time - self.start_time
+        analysis = total - self.wait_time
+        return {"decode": decode, "analysis": analysis, "overlap": decode + analysis - total, "total": total}
+
+    def _start(self):
+        self.start_time = time.perf_counter()
+        # the messages of ffmpeg go to a file, as a full stderr pipe would block ffmpeg while only stdout is read
+        self._stderr = tempfile.TemporaryFile()
+        arguments = (ffmpeg.input(self.filename)
+                     .output("pipe:", format="f32le", acodec="pcm_f32le", ac=1, ar=self.sr)
+                     .global_args("-loglevel", "error", "-nostdin")
+                     .compile())
+        self._process = subprocess.Popen(arguments, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                         stderr=self._stderr)
+        self._thread = threading.Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        """
+        Reader thread: move the output of ffmpeg into the queue, ending with None, or an exception if decoding failed
+        """
+        try:
+            while not self._stop.is_set():
+                data = self._process.stdout.read(4 * self.block_size)
+                if not data:
+                    break
+                block = np.frombuffer(data, dtype="<f4")
+                self.n_samples += len(block)
+                self._put(block)
+            if self._process.wait() != 0 and not self._stop.is_set():
+                self._stderr.seek(0)
+                message = self._stderr.read().decode("utf-8", errors="replace").strip().splitlines()
+                raise RuntimeError(f"could not decode {self.filename}: {message[-1] if message else 'ffmpeg failed'}")
+            self.decode_end_time = time.perf_counter()
+            self._put(None)
+        except Exception as error:
+            self._put(error)
+
+    def _put(self, item):
+        # blocks until there is room in the queue, unless the pipeline is closed
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
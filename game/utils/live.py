@@ -0,0 +1,228 @@
+import collections
+import time
+
+import librosa
+import numpy as np
+from game.utils import notedetection
+
+
+class LiveOnsetDetector:
+    """
+    Incremental onset detection on live audio, pushed in small blocks (e.g. 512 samples from an audio callback), that
+    reports every onset a bounded time after it happens.
+
+    Every stft frame is processed as soon as its audio has arrived, in the same way as the analysis of a whole song in
+    notedetection: the onset strength of librosa.onset.onset_strength on the mel spectrogram, onset picking with the
+    thresholds of librosa.onset.onset_detect, and the durations of notedetection.onset_length_detection, where an
+    onset lasts until the Kullback-Leibler divergence between consecutive frames drops below -2. Only the audio of the
+    current frame and the onset strengths within the peak picking window are kept.
+
+    Differences from the analysis of a whole song: there is no vocal separation, so all of the input is analysed like
+    the background branch of notedetection.onset_detection. Onset strengths are normalised by the largest one so far,
+    and decibels are floored relative to the loudest frame so far, rather than of the whole song, so more onsets may be
+    picked in the first seconds. Noise removal, merging and rounding need the whole song or its tempo, and are left to
+    the caller.
+
+    The latency (see the latency attribute) is n_fft / 2 samples for a centered frame, plus the frames after an onset
+    that peak picking looks at, minus the frames the onset strength is shifted by: about 93 ms at 22050 Hz.
+    """
+
+    def __init__(self, sr=22050, n_fft=2048, hop_length=512, fft_length=1024):
+        """
+        :param sr: sampling rate of the pushed audio
+        :param n_fft: stft frame length for the onset strength
+        :param hop_length: stft frame hop size, of both the onset strength and duration detection
+        :param fft_length: stft frame length for duration detection
+        """
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.fft_length = fft_length
+        if fft_length > n_fft // 2 + hop_length:
+            raise ValueError("fft_length must be at most n_fft / 2 + hop_length, so that its frames are buffered")
+        self.window = librosa.filters.get_window("hann", n_fft, fftbins=True)
+        self.duration_window = librosa.filters.get_window("hann", fft_length, fftbins=True)
+        self.mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft, fmax=0.5 * sr)
+
+        # peak picking parameters of librosa.onset.onset_detect, in frames
+        self.pre_max = int(0.03 * sr // hop_length)
+        self.post_max = int(0.00 * sr // hop_length + 1)
+        self.pre_avg = int(0.10 * sr // hop_length)
+        self.post_avg = int(0.10 * sr // hop_length + 1)
+        self.wait = int(0.03 * sr // hop_length)
+        self.delta = 0.07
+        # onset_strength shifts the onset strength of frames k - 1 to k to index k + envelope_shift
+        self.envelope_shift = n_fft // (2 * hop_length)
+        # time from an onset until it is reported, once all the audio up to then has been pushed
+        self.latency = ((self.post_avg - 1 - self.envelope_shift) * hop_length + n_fft // 2) / sr
+
+        self.n_samples = 0  # number of samples pushed so far
+        # audio from the start of the next frame, beginning with the zero padding of the first centered frame
+        self._buffer = np.zeros(n_fft // 2, dtype=np.float32)
+        self._frame = 0  # index of the next centered frame
+        self._previous_db = None
+        self._max_db = -np.inf
+
+        # onset strengths within the peak picking window, starting with the padding of onset_strength
+        self._envelope = collections.deque([0.0] * (1 + self.envelope_shift), maxlen=self.pre_avg + self.post_avg)
+        self._n_envelope = 1 + self.envelope_shift  # number of onset strengths so far
+        self._max_envelope = 0.0
+        self._next_peak = 0  # index of the next onset strength to pick or reject as an onset
+        self._last_onset = -np.inf
+
+        # duration detection, on frames that are not centered
+        self._previous_magnitude = None
+        self._duration_frame = 0  # index of the next duration frame
+        self._recent_ends = collections.deque(maxlen=8)  # recent duration frames that do not continue into the next
+        self._open_onsets = []  # onset times and duration frame indices of onsets whose duration is not known yet
+        self._notes = []  # onset times and durations of onsets whose duration is known
+
+        self.block_latencies = []  # processing time of every push in seconds
+
+    def push(self, block):
+        """
+        Add audio to the analysis and process every frame that is complete
+        :param block: audio signal following the previously pushed audio
+        :return: times in seconds of the onsets detected in this block
+        """
+        start = time.perf_counter()
+        self._buffer = np.concatenate([self._buffer, np.asarray(block, dtype=np.float32)])
+        self.n_samples += len(block)
+        onsets = self._process()
+        self.block_latencies.append(time.perf_counter() - start)
+        return np.array(onsets)
+
+    def pop_notes(self):
+        """
+        Take the onsets whose durations are known, an onset's duration is known once it has ended
+        :return: onset times and durations in seconds
+        """
+        notes, self._notes = self._notes, []
+        if not notes:
+            return np.zeros(0), np.zeros(0)
+        onset_times, onset_durations = zip(*notes)
+        return np.array(onset_times), np.array(onset_durations)
+
+    def finish(self):
+        """
+        End the input: process the last frames as the analysis of a whole song does, and end every onset
+        :return: times in seconds of the onsets detected in the last frames
+        """
+        n_frames = 1 + self.n_samples // self.hop_length  # number of centered frames of the whole input
+        self._buffer = np.concatenate([self._buffer, np.zeros(self.n_fft // 2, dtype=np.float32)])
+        onsets = self._process(n_frames=n_frames)
+        while self._next_peak < n_frames:
+            onsets += self._pick(self._next_peak, n_frames)
+
+        # every onset ends at the last duration frame at the latest
+        last_frame = self._duration_frame - 1
+        for onset_time, first_frame in self._open_onsets:
+            first_frame = min(first_frame, last_frame)
+            self._notes.append((onset_time, (last_frame - first_frame + 1) * self._residual_size / self.sr))
+        self._open_onsets = []
+        return np.array(onsets)
+
+    @property
+    def _residual_size(self):
+        return self.fft_length - self.hop_length
+
+    def _process(self, n_frames=None):
+        """
+        Process every complete frame in the buffer
+        :param n_frames: number of onset strengths of the whole input once it has ended, None while it goes on
+        :return: times of the detected onsets
+        """
+        onsets = []
+        while len(self._buffer) >= self.n_fft:
+            if n_frames is not None and self._frame >= n_frames:
+                break
+            frame = self._buffer[:self.n_fft]
+            self._spectral_frame(frame, n_frames)
+            self._duration_frames()
+            self._buffer = self._buffer[self.hop_length:]
+            self._frame += 1
+            # peaks can be picked once the onset strengths after them are known
+            while self._next_peak + self.post_avg <= self._n_envelope and \
+                    (n_frames is None or self._next_peak < n_frames):
+                onsets += self._pick(self._next_peak, n_frames)
+        return onsets
+
+    def _spectral_frame(self, frame, n_frames=None):
+        """
+        Onset strength of one centered frame, see FeatureStore.onset_envelope
+        :param frame: audio of the frame
+        :param n_frames: number of onset strengths of the whole input once it has ended, later ones are dropped
+        """
+        magnitude = np.abs(np.fft.rfft(frame * self.window))
+        mel = self.mel_basis @ magnitude ** 2
+        db = 10.0 * np.log10(np.maximum(1e-10, mel))
+        self._max_db = max(self._max_db, db.max())
+        db = np.maximum(db, self._max_db - 80.0)
+        if self._previous_db is not None and (n_frames is None or self._n_envelope < n_frames):
+            strength = float(np.mean(np.maximum(0.0, db - self._previous_db)))
+            self._envelope.append(strength)
+            self._n_envelope += 1
+            self._max_envelope = max(self._max_envelope, strength)
+        self._previous_db = db
+
+    def _duration_frames(self):
+        """
+        Process the duration frames (not centered, fft_length long) that are complete, and end the onsets that stop
+        """
+        # duration frame i starts at sample i * hop_length, the buffer at sample frame * hop_length - n_fft / 2
+        buffer_start = self._frame * self.hop_length - self.n_fft // 2
+        while self._duration_frame * self.hop_length + self.fft_length <= buffer_start + len(self._buffer) and \
+                self._duration_frame * self.hop_length + self.fft_length <= self.n_samples:
+            offset = self._duration_frame * self.hop_length - buffer_start
+            magnitude = np.abs(np.fft.rfft(self._buffer[offset:offset + self.fft_length] * self.duration_window))
+            if self._previous_magnitude is not None:
+                divergence = notedetection.frame_divergences(np.stack([self._previous_magnitude, magnitude], axis=1))
+                if divergence[0] < -2:
+                    self._end_onsets(self._duration_frame - 1)
+            self._previous_magnitude = magnitude
+            self._duration_frame += 1
+
+    def _end_onsets(self, end_frame):
+        """
+        End the onsets that started at or before a duration frame that does not continue into the next
+        """
+        self._recent_ends.append(end_frame)
+        still_open = []
+        for onset_time, first_frame in self._open_onsets:
+            if first_frame <= end_frame:
+                self._notes.append((onset_time, (end_frame - first_frame + 1) * self._residual_size / self.sr))
+            else:
+                still_open.append((onset_time, first_frame))
+        self._open_onsets = still_open
+
+    def _pick(self, n, n_frames=None):
+        """
+        Decide whether onset strength n is an onset, as librosa.util.peak_pick does
+        :param n: index of the onset strength
+        :param n_frames: number of onset strengths of the whole input once it has ended, None while it goes on
+        :return: list with the onset time, or empty list
+        """
+        self._next_peak = n + 1
+        end = self._n_envelope if n_frames is None else min(self._n_envelope, n_frames)
+        first = self._n_envelope - len(self._envelope)  # index of the first kept onset strength
+        envelope = np.array(self._envelope)
+        value = envelope[n - first]
+        peak_max = envelope[max(n - self.pre_max, 0) - first:min(n + self.post_max, end) - first].max()
+        average = envelope[max(n - self.pre_avg, 0) - first:min(n + self.post_avg, end) - first].mean()
+        # onset strengths are normalised by the largest one so far
+        if value <= 0 or value != peak_max or value < average + self.delta * self._max_envelope:
+            return []
+        if n <= self._last_onset + self.wait:
+            return []
+        self._last_onset = n
+
+        onset_time = n * self.hop_length / self.sr
+        # duration frame of the onset, as in notedetection.onset_length_detection
+        onset_sample = max(n * self.hop_length, self.fft_length - self._residual_size)
+        first_frame = (onset_sample - self.fft_length) // self._residual_size + 1
+        ended = [end_frame for end_frame in self._recent_ends if end_frame >= first_frame]
+        if ended:
+            self._notes.append((onset_time, (min(ended) - first_frame + 1) * self._residual_size / self.sr))
+        else:
+            self._open_onsets.append((onset_time, first_frame))
+        return [onset_time]
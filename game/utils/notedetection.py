@@ -1,148 +1,218 @@
+import os
 import numpy as np
 import librosa
 import time
-import copy
+from concurrent.futures import ThreadPoolExecutor
 from scipy.special import rel_entr
-
-
-def merge_close_onset(onset_times, onset_durations, tempo, precision=0.125):
+from game.utils.features import FeatureStore
+from game.utils.pcm import read_pcm, write_pcm
+from game.utils.profiling import in_current_stage, profiled, stage
+
+# Bump whenever a change to this module alters the analysis output, so that cached results are recomputed
+ANALYSIS_VERSION = 3
+
+# Songs longer than this (in seconds) are analysed block by block to bound memory usage with the balanced tier, see
+# streaming.py
+STREAMING_MIN_DURATION = 15 * 60
+
+# Analysis settings of the quality tiers, from the cheapest to the most expensive. All tiers analyse float32 audio
+# with the same time resolution (about 23 ms per frame):
+#   sr: sampling rate the audio is decoded at
+#   separation: how vocals are separated from the background, "nn_filter" (nearest neighbour filter over the whole
+#   song) or "windowed" (nearest neighbour filter within a window of window seconds)
+#   n_fft, hop_length: stft sizes for separation and onset envelopes
+#   fft_length, fft_hop_length: stft sizes for duration detection
+# The fast tier is the balanced one at half the sampling rate. A harmonic/percussive split (librosa.decompose.hpss) is
+# no cheaper at that rate (its median filters cost more than the windowed search) and its harmonic part drops
+# percussive onsets, e.g. every note of a click track.
+QUALITY_TIERS = {
+    "fast": {"sr": 11025, "separation": "windowed", "window": 30.0, "n_fft": 1024, "hop_length": 256,
+             "fft_length": 512, "fft_hop_length": 256},
+    "balanced": {"sr": 22050, "separation": "windowed", "window": 30.0, "n_fft": 2048, "hop_length": 512,
+                 "fft_length": 1024, "fft_hop_length": 512},
+    "accurate": {"sr": 22050, "separation": "nn_filter", "window": None, "n_fft": 2048, "hop_length": 512,
+                 "fft_length": 1024, "fft_hop_length": 512},
+}
+
+
+@profiled()
+def merge_close_onset(onset_times, onset_durations, tempo, precision=0.125, beats=None):
     """
     Merge very closely located onsets
-    :param onset_times: start time of onset
+    An onset is merged into the first onset of its group if they are at most the threshold apart, the merged onset lasts
+    until the latest end of the onsets in its group
+    :param onset_times: start time of onset, in ascending order
     :param onset_durations: duration of onset
-    :param tempo: tempo of song
-    :param precision: decision boundary for judging close onsets
+    :param tempo: tempo of song, used to convert beats to seconds
+    :param precision: decision boundary for judging close onsets, in seconds
+    :param beats: decision boundary for judging close onsets in beats, overrides precision if given
     :return: merged onset times and durations
     """
-    spb = 60 / tempo * precision
-    i = 0
-    length = len(onset_times)
-    while i < length - 1:
-        if abs(onset_times[i + 1] - onset_times[i]) <= precision:
-            onset_durations[i] = max(onset_times[i] + onset_durations[i], onset_times[i + 1] + onset_durations[i + 1]) - \
-                                 onset_times[i]
-            onset_times = np.delete(onset_times, i + 1)
-            onset_durations = np.delete(onset_durations, i + 1)
-            length -= 1
-        else:
-            i += 1
-    return onset_times, onset_durations
+    threshold = precision if beats is None else 60 / tempo * beats
+    onset_times = np.asarray(onset_times)
+    onset_durations = np.asarray(onset_durations)
+    if len(onset_times) == 0:
+        return onset_times, onset_durations
+
+    # an onset further than the threshold from its predecessor always starts a new group
+    is_group_start = np.ones(len(onset_times), dtype=bool)
+    is_group_start[1:] = np.abs(np.diff(onset_times)) > threshold
+
+    # a run of close onsets that spans more than the threshold is split into several groups,
+    # these runs are rare, so they are resolved one by one
+    run_starts = np.flatnonzero(is_group_start)
+    run_ends = np.append(run_starts[1:], len(onset_times)) - 1
+    for run in np.flatnonzero(onset_times[run_ends] - onset_times[run_starts] > threshold):
+        group_start = run_starts[run]
+        for i in range(run_starts[run] + 1, run_ends[run] + 1):
+            if abs(onset_times[i] - onset_times[group_start]) > threshold:
+                is_group_start[i] = True
+                group_start = i
+
+    group_starts = np.flatnonzero(is_group_start)
+    group_ends = np.maximum.reduceat(onset_times + onset_durations, group_starts)
+    # onsets that were not merged keep their exact duration
+    is_merged = np.diff(np.append(group_starts, len(onset_times))) > 1
+    merged_durations = np.where(is_merged, group_ends - onset_times[group_starts], onset_durations[group_starts])
+    return onset_times[group_starts], merged_durations
+
+
+def onset_amplitudes(onset_times, x, sr):
+    """
+    Compute the loudness right after each onset
+    :param onset_times: onset start time
+    :param x: audio input
+    :param sr: sampling rate
+    :return: root mean square of the 200 samples starting at each onset (repeating the last sample near the end)
+    """
+    onset_index = librosa.time_to_samples(onset_times, sr=sr)
+    onset_index_range = np.clip(onset_index.reshape(-1, 1) + np.arange(0, 200), 0, len(x) - 1)
+    onset_sample_range = x[onset_index_range]
+    return np.sqrt(np.mean(onset_sample_range ** 2, axis=1))
 
 
-def remove_noisy_onset(onset_times, onset_durations, x, sr):
+@profiled()
+def remove_noisy_onset(onset_times, onset_durations, x, sr, onset_amplitude=None, amplitude_ratio=12):
     """
     Filter out noise in onsets
     :param onset_times: onset start time
     :param onset_durations: onset durations
     :param x: audio input
     :param sr: sampling rate
+    :param onset_amplitude: precomputed onset_amplitudes, x is not used if given
+    :param amplitude_ratio: onsets quieter than the mean onset amplitude divided by this are removed
     :return: filtered onset times and durations
     """
-    onset_index = librosa.time_to_samples(onset_times, sr=sr)
-    onset_index_range = onset_index.reshape(-1, 1) + np.arange(0, 200)
-    onset_sample_range = x[onset_index_range]
-    onset_amplitude = np.sqrt(np.mean(onset_sample_range ** 2, axis=1))
+    if onset_amplitude is None:
+        onset_amplitude = onset_amplitudes(onset_times, x, sr)
 
     mean_amplitude = np.mean(onset_amplitude)
 
-    valid_samples = onset_amplitude > mean_amplitude / 12
+    valid_samples = onset_amplitude > mean_amplitude / amplitude_ratio
     onset_times = onset_times[valid_samples]
     onset_durations = onset_durations[valid_samples]
 
     return onset_times, onset_durations
 
 
-def merge_vocal_background_with_padding(vocal_onset, vocal_duration, background_onset, background_duration, tempo,
-                                        precision=1.0):
+@profiled()
+def merge_vocal_background(vocal_onset, vocal_duration, background_onset, background_duration):
     """
-    Merge vocal and background onsets, add padding onsets as well
+    Merge vocal and background onsets into one stream in time order, vocal onsets coming first at equal times
     :param vocal_onset: vocal onsets
     :param vocal_duration: vocal onset durations
-    :param background_onset:  background onset
+    :param background_onset: background onset
     :param background_duration: background onset durations
-    :param tempo: tempo of song
-    :param precision: precision for padding
-    :return: merged + padded onset times and durations, onset type label
+    :return: merged onset times and durations, onset type label (1 for vocal, 0 for background onsets)
     """
-    spb = 60 / tempo * precision
-    merge_onset = []
-    merge_duration = []
-    merge_label = []
-
-    l1 = vocal_onset.shape[0]
-    l2 = background_onset.shape[0]
-    i = j = k = 0
-
-    while i < l1 and j < l2:
-        if vocal_onset[i] <= background_onset[j]:
-            chosen_onset = vocal_onset[i]
-            chosen_duration = vocal_duration[i]
-            label = 1
-            i += 1
-        else:
-            chosen_onset = background_onset[j]
-            chosen_duration = background_duration[j]
-            label = 0
-            j += 1
-
-        merge_onset.append(chosen_onset)
-        merge_duration.append(chosen_duration)
-        merge_label.append(label)
-
-        k += 1
-        if False and k > 1 and merge_label[-2] == 1 and merge_label[-1] == 1:
-            count = 0
-            blank_start = merge_onset[-2] + merge_duration[-2]
-            while merge_onset[-1] - blank_start - count * spb >= spb:
-                merge_onset.append(blank_start + count * spb)
-                count += 1
-                k += 1
-
-    while i < l1:
-        merge_onset.append(vocal_onset[i])
-        merge_duration.append(vocal_duration[i])
-        merge_label.append(1)
-        i += 1
-
-    while j < l2:
-        merge_onset.append(background_onset[j])
-        merge_duration.append(background_duration[j])
-        merge_label.append(0)
-        j += 1
-
-    return merge_onset, merge_duration, merge_label
-
-
-def vocal_separation(y, sr):
+    onset_times = np.concatenate((vocal_onset, background_onset))
+    onset_durations = np.concatenate((vocal_duration, background_duration))
+    onset_labels = np.concatenate((np.ones(len(vocal_onset), dtype=int), np.zeros(len(background_onset), dtype=int)))
+    # a stable sort keeps the vocal onsets, which are first in the arrays, before background onsets at the same time
+    order = np.argsort(onset_times, kind="stable")
+    return onset_times[order], onset_durations[order], onset_labels[order]
+
+
+@profiled()
+def vocal_separation(y, sr, features=None, window=None, n_fft=2048, hop_length=512, margin_i=5, margin_v=20,
+                     first_frame=0):
     """
     Perform vocal separation on song
     :param y: the audio input
     :param sr: sampling rate
+    :param features: FeatureStore of y, so that its spectrogram can be shared with later stages
+    :param window: only search for similar frames within neighbourhoods of this many seconds (default: whole song),
+    see separation_masks
+    :param n_fft: stft frame length
+    :param hop_length: stft frame hop size
+    :param margin_i: margin of the background mask, see separation_masks
+    :param margin_v: margin of the vocal mask, see separation_masks
+    :param first_frame: index in the song of the first stft frame of y when it is a block of the song, see
+    windowed_nn_filter
     :return: filtered vocal audio, and background audio
 
     ********************************************************************************
     reference: https://librosa.org/doc/main/auto_examples/plot_vocal_separation.html
     ********************************************************************************
     """
+    if features is None:
+        features = FeatureStore(y, sr)
+
     # compute the spectrogram magnitude and phase
-    S_full, phase = librosa.magphase(librosa.stft(y))
+    with stage("stft") as current_stage:
+        S_full, phase = features.magphase(n_fft=n_fft, hop_length=hop_length)
+        current_stage.sizes(S_full=S_full, phase=phase)
+
+    with stage("nn_filter"):
+        mask_v, mask_i = separation_masks(S_full, sr, window=window, hop_length=hop_length, margin_i=margin_i,
+                                          margin_v=margin_v, first_frame=first_frame)
+
+    # multiply mask with the input spectrum to separate the components
+    with stage("istft") as current_stage:
+        S_foreground = mask_v * S_full
+        S_background = mask_i * S_full
+
+        y_foreground = librosa.istft(S_foreground * phase, n_fft=n_fft, hop_length=hop_length)
+        y_background = librosa.istft(S_background * phase, n_fft=n_fft, hop_length=hop_length)
+        current_stage.sizes(y_foreground=y_foreground, y_background=y_background)
+
+    return y_foreground, y_background
+
 
+def separation_masks(S_full, sr, window=None, hop_length=512, margin_i=5, margin_v=20, first_frame=0):
+    """
+    Compute the soft masks separating vocals from the repeating background
+    :param S_full: magnitude spectrogram of the song
+    :param sr: sampling rate
+    :param window: only search for similar frames within neighbourhoods of this many seconds (default: whole song),
+    longer than 4 seconds, as neighbours are at least 2 seconds apart. The exact search compares every frame with every
+    other frame, so its time and memory grow quadratically with the song length, while they grow linearly with a
+    window.
+    :param hop_length: stft frame hop size of the spectrogram
+    :param margin_i: margin of the background mask, larger margins reduce the bleed between the vocals and the
+    background (noisy songs: 2, clean songs: 10)
+    :param margin_v: margin of the vocal mask (noisy songs: 10, clean songs: 28)
+    :param first_frame: index in the song of the first frame of S_full when it is a block of the song, see
+    windowed_nn_filter
+    :return: vocal mask, background mask
+    """
     # use cosine similarity and aggregate similar frames by taking their (per-frequency) median value
     # This suppresses sparse/non-repetetitive deviations from the average spectrum,
     # and works well to discard vocal elements.
-    S_filter = librosa.decompose.nn_filter(S_full,
-                                           aggregate=np.median,
-                                           metric='cosine',
-                                           width=int(librosa.time_to_frames(2.0, sr=sr)))
+    width = int(librosa.time_to_frames(2.0, sr=sr, hop_length=hop_length))
+    if window is None:
+        S_filter = librosa.decompose.nn_filter(S_full,
+                                               aggregate=np.median,
+                                               metric='cosine',
+                                               width=width)
+    else:
+        S_filter = windowed_nn_filter(S_full, width, int(librosa.time_to_frames(window, sr=sr, hop_length=hop_length)),
+                                      first_frame=first_frame)
 
     # take the point-wise minimum with the input spectrum
     S_filter = np.minimum(S_full, S_filter)
 
-    # setup a margin to reduce bleed between the vocals and instrumentation masks.
-    # noisy: 2, 10
-    # clean: 10, 28
-
-    margin_i, margin_v = 5, 20
+    # the margins reduce bleed between the vocals and instrumentation masks
     power = 2
 
     mask_i = librosa.util.softmask(S_filter,
@@ -153,57 +223,251 @@ def vocal_separation(y, sr):
                                    margin_v * S_filter,
                                    power=power)
 
-    # multiply mask with the input spectrum to separate the components
-    S_foreground = mask_v * S_full
-    S_background = mask_i * S_full
+    return mask_v, mask_i
 
-    y_foreground = librosa.istft(S_foreground * phase)
-    y_background = librosa.istft(S_background * phase)
 
-    return y_foreground, y_background
+def windowed_nn_filter(S, width, window_frames, chunk_size=64, first_frame=0):
+    """
+    Nearest neighbour filter that only searches for neighbours within a sliding window, with time and memory linear in
+    the number of frames. Same as librosa.decompose.nn_filter with the cosine metric and median aggregation when the
+    window covers the whole song.
+    Frames are processed in chunks of chunk_size frames, comparing them with every frame of the window around the chunk
+    in a single matrix product instead of building the recurrence matrix of the whole song.
+    :param S: magnitude spectrogram
+    :param width: minimum distance in frames between a frame and its neighbours
+    :param window_frames: number of frames around a frame searched for neighbours, at least 2 * width + 5
+    :param chunk_size: number of frames filtered at a time
+    :param first_frame: index in the song of the first frame of S, when S is a block of the song that ends with the song
+    or is followed by at least half a window and a chunk of frames. Chunks and windows are then placed as for the whole
+    song, so that the frames of the block whose windows lie within S are filtered exactly as in the whole song.
+    :return: filtered spectrogram
+    """
+    # every frame needs k neighbours (see below) among the frames of its window that are at least width frames away,
+    # of which there are window_frames - 2 * width + 1, which is enough from 6 on
+    if window_frames < 2 * width + 5:
+        raise ValueError(f"The window of {window_frames} frames is too short to find neighbours at least {width} "
+                         f"frames away from every frame, it must be at least {2 * width + 5} frames long")
+    number_of_frames = S.shape[1]
+    if number_of_frames <= window_frames:
+        return librosa.decompose.nn_filter(S, aggregate=np.median, metric='cosine', width=width)
+
+    # number of neighbours, chosen by the same rule as librosa.segment.recurrence_matrix for a song of window length
+    k = int(2 * np.ceil(np.sqrt(window_frames - 2 * width + 1)))
+    number_of_candidates = min(window_frames - 1, k + 2 * width)
+
+    # cosine similarity of two frames is the dot product of their normalised spectra
+    norms = np.linalg.norm(S, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        S_normalised = np.nan_to_num(S / norms)
+
+    S_filter = np.empty_like(S)
+    # chunks start at multiples of chunk_size in the song, the first chunk of a block may start before the block
+    for chunk_start in range(-(first_frame % chunk_size), number_of_frames, chunk_size):
+        end = min(chunk_start + chunk_size, number_of_frames)
+        # center the window on the chunk, shifted to stay inside the song
+        low = min(max((chunk_start + end - window_frames) // 2, 0), number_of_frames - window_frames)
+        high = low + window_frames
+        start = max(chunk_start, 0)
+        similarity = S_normalised[:, start:end].T @ S_normalised[:, low:high]
+        frames = np.arange(start, end).reshape(-1, 1)
+        similarity[frames - low == np.arange(window_frames)] = -np.inf
+
+        # like recurrence_matrix, take the nearest frames, drop the ones closer than width and keep k of the rest,
+        # picked in the order in which recurrence_matrix picks them (sorting links that all have the same weight)
+        candidates = low + np.argpartition(-similarity, number_of_candidates - 1, axis=1)[:, :number_of_candidates]
+        candidates[np.abs(candidates - frames) < width] = number_of_frames
+        candidates.sort(axis=1)
+        number_of_links = np.sum(candidates < number_of_frames, axis=1)
+        neighbours = np.empty((end - start, k), dtype=int)
+        for links in np.unique(number_of_links):
+            rows = number_of_links == links
+            neighbours[rows] = candidates[rows][:, np.argsort(np.ones(links))[:k]]
+
+        # median of the neighbours, sorting the short rows is faster than np.median's partitioning
+        neighbour_values = np.sort(S[:, neighbours], axis=2)
+        S_filter[:, start:end] = (neighbour_values[..., (k - 1) // 2] + neighbour_values[..., k // 2]) / 2
+    return S_filter
+
+
+@profiled()
+def estimate_tempo(onset_env, sr, hop_length=512):
+    """
+    Estimate the tempo of a song
+    :param onset_env: onset strength envelope of the song
+    :param sr: sampling rate
+    :param hop_length: hop size of the onset strength envelope
+    :return: tempo rounded to an integer BPM
+    """
+    tempo = librosa.beat.tempo(onset_envelope=onset_env, sr=sr, hop_length=hop_length)
+    return np.around(tempo, 0)
+
+
+def onset_bars(onset_times, tempo, beats_per_bar=8):
+    """
+    Calculate the bar number for each onset
+    :param onset_times: onset start time
+    :param tempo: song tempo
+    :param beats_per_bar: usually it's 4 beats per bar, but having 8 beats per pattern makes a more enjoyable map
+    :return: bar numbers, starting from 1
+    """
+    bar_duration = 60 / tempo * beats_per_bar
+    return onset_times // bar_duration + 1
+
+
+def frame_divergences(y, chunk_size=2048):
+    """
+    Compute the Kullback-Leibler divergence between every pair of consecutive frames of a spectrogram
+    :param y: absolute of stft
+    :param chunk_size: number of frames processed at a time, bounds the temporary memory used
+    :return: divergences, where element i compares frame i with frame i + 1
+    """
+    return _compare_consecutive_frames(y, lambda old, new: np.sum(rel_entr(old, new), axis=0), chunk_size)
+
+
+def frame_mean_square_differences(y, chunk_size=2048):
+    """
+    Compute the mean square difference between every pair of consecutive frames of a spectrogram
+    :param y: absolute of stft
+    :param chunk_size: number of frames processed at a time, bounds the temporary memory used
+    :return: differences, where element i compares frame i with frame i + 1
+    """
+    return _compare_consecutive_frames(y, lambda old, new: np.mean((old - new) ** 2, axis=0), chunk_size)
+
+
+def _compare_consecutive_frames(y, compare, chunk_size):
+    number_of_frames = y.shape[1]
+    differences = np.empty(max(number_of_frames - 1, 0), dtype=y.dtype)
+    for start in range(0, number_of_frames - 1, chunk_size):
+        end = min(start + chunk_size, number_of_frames - 1)
+        differences[start:end] = compare(y[:, start:end], y[:, start + 1:end + 1])
+    return differences
+
+
+def onset_lengths(onset_frame_indices, continues):
+    """
+    Count for how many frames each onset lasts, an onset ends at the first frame that does not continue into the next
+    :param onset_frame_indices: stft frame index of each onset
+    :param continues: for every frame but the last, whether it continues into the next frame
+    :return: onset lengths in frames
+    """
+    # the last frame has no successor, so every onset ends there at the latest
+    ends = np.flatnonzero(np.append(~continues, True))
+    return ends[np.searchsorted(ends, onset_frame_indices)] - onset_frame_indices + 1
 
 
-def load_audio(filename):
+@profiled("decode")
+def load_audio(filename, sr=22050, pcm_path=None):
     '''
     load audio file
     :param filename: file path to the audio
+    :param sr: sampling rate to resample to
+    :param pcm_path: file keeping the decoded audio (see pcm.py), memory-mapped instead of decoding the audio again
+    if it exists, written after decoding otherwise
     :return: audio signal, sampling rate
     '''
-    x, fs = librosa.load(filename)
+    decoded = read_pcm(pcm_path) if pcm_path is not None else None
+    if decoded is not None and decoded[1] == sr:
+        return decoded
+    x, fs = librosa.load(filename, sr=sr)
+    if pcm_path is not None:
+        write_pcm(pcm_path, x, fs)
     return x, fs
 
 
-def onset_roundings(onset_times, onset_durations, tempo, precision=0.125):
+@profiled()
+def onset_roundings(onset_times, onset_durations, tempo, precision=0.125, phase_steps=60, segment_duration=None,
+                    method="grid", phase_shift=None):
     """
     Perform onset roundings with phase shift
+    Onsets are rounded to a grid of the given precision, shifted by the phase that minimizes the alignment error
     :param onset_times: onset start time
     :param onset_durations: onset durations
     :param tempo: song tempo
     :param precision: alignment precision
+    :param phase_steps: number of candidate phase shifts within one grid step
+    :param segment_duration: estimate the phase separately for every segment of this many seconds, so that the grid
+    follows drift over long tracks (default: one phase for the whole song)
+    :param method: "grid" tries phase_steps evenly spaced phase shifts, "circular" estimates the phase from the
+    circular mean of the onset times and refines it locally, which is much cheaper for fine resolutions
+    :param phase_shift: phase shift of the grid in seconds, e.g. one found by best_phase_shift on other onsets of the
+    song (default: estimated from the onsets, separately for every segment if segment_duration is given)
     :return: aligned onset time and duration
     """
     spb = 60 / tempo * precision
-    phase_shifts = np.linspace(0, spb, num=60)  # Generate a range of phase shifts
-
-    best_alignment = None
-    best_error = float('inf')
-
-    for phase_shift in phase_shifts:
-        aligned_onset_times = np.around((onset_times - phase_shift) / spb, decimals=0) * spb + phase_shift
-        alignment_error = np.sum(np.cbrt(np.abs(aligned_onset_times - onset_times)))
-        # cube root is used to decrease the effect of outliers
-
-        if alignment_error < best_error:
-            aligned_onset_durations = np.around(np.array(onset_durations) / spb, decimals=0) * spb
-            valid_mask = aligned_onset_durations > 0
-            best_alignment = (np.array(aligned_onset_times), np.array(aligned_onset_durations))
-            best_error = alignment_error
-    return best_alignment
+    onset_times = np.asarray(onset_times)
+    aligned_onset_durations = np.around(np.array(onset_durations) / spb, decimals=0) * spb
+
+    if segment_duration is None:
+        segments = np.zeros(len(onset_times), dtype=int)
+    else:
+        segments = (onset_times // segment_duration).astype(int)
+
+    aligned_onset_times = np.empty(onset_times.shape)
+    for segment in np.unique(segments):
+        in_segment = segments == segment
+        segment_phase_shift = phase_shift
+        if segment_phase_shift is None:
+            segment_phase_shift = best_phase_shift(onset_times[in_segment], spb, phase_steps, method)
+        aligned_onset_times[in_segment] = np.around((onset_times[in_segment] - segment_phase_shift) / spb,
+                                                    decimals=0) * spb + segment_phase_shift
+    return aligned_onset_times, aligned_onset_durations
+
+
+def best_phase_shift(onset_times, spb, phase_steps=60, method="grid"):
+    """
+    Find the phase shift of a rounding grid that best aligns with the onsets
+    :param onset_times: onset start time
+    :param spb: grid step in seconds
+    :param phase_steps: number of candidate phase shifts within one grid step
+    :param method: "grid" or "circular", see onset_roundings
+    :return: phase shift with the smallest alignment error, the earliest one in case of a tie
+    """
+    if method == "grid":
+        phase_shifts = np.linspace(0, spb, num=phase_steps).reshape(-1)  # Generate a range of phase shifts
+        return phase_shifts[np.argmin(alignment_errors(onset_times, phase_shifts, spb))]
+    if method != "circular":
+        raise ValueError(f"Unknown phase estimation method: {method}")
+
+    # the circular mean of the onset positions within a grid step is close to the best phase shift,
+    # it is refined by searching ever smaller neighbourhoods until the resolution of phase_steps is reached
+    angles = 2 * np.pi * onset_times / spb
+    phase_shift = np.angle(np.mean(np.exp(1j * angles))) / (2 * np.pi) * spb % spb
+    radius = spb / 10
+    while True:
+        phase_shifts = (phase_shift + np.linspace(-radius, radius, num=11).reshape(-1)) % spb
+        phase_shift = phase_shifts[np.argmin(alignment_errors(onset_times, phase_shifts, spb))]
+        if radius <= spb / phase_steps:
+            return phase_shift
+        radius /= 5
+
+
+def alignment_errors(onset_times, phase_shifts, spb, max_chunk_size=2 ** 16):
+    """
+    Compute the alignment error of the onsets for every candidate phase shift of the rounding grid
+    The alignment error is the sum of the cube roots of the distances from each onset to its grid position, the cube
+    root is used to decrease the effect of outliers. Candidates are evaluated together in chunks.
+    :param onset_times: onset start time
+    :param phase_shifts: candidate phase shifts
+    :param spb: grid step in seconds
+    :param max_chunk_size: maximum number of candidate alignments computed at a time, small enough to stay in cache
+    :return: alignment error of every candidate
+    """
+    errors = np.empty(len(phase_shifts))
+    chunk_size = max(max_chunk_size // max(len(onset_times), 1), 1)
+    for start in range(0, len(phase_shifts), chunk_size):
+        candidates = phase_shifts[start:start + chunk_size].reshape(-1, 1)
+        aligned_onset_times = np.around((onset_times - candidates) / spb, decimals=0) * spb + candidates
+        errors[start:start + chunk_size] = np.sum(np.cbrt(np.abs(aligned_onset_times - onset_times)), axis=1)
+    return errors
 
 
+@profiled()
 def onset_paddings(onset_times, onset_durations, tempo, abs_x, precisions=1.0, sr=22050):
     """
     Perform padding between onsets
+    Padding onsets are placed one after the other from the end of an onset, each one padding step long, while more than
+    one step is left before the next onset. A padding onset is only kept if the audio around it is at least half as
+    loud as around the onset it follows.
     :param onset_times: onset start time
     :param onset_durations: onset duration
     :param tempo: song tempo
@@ -214,39 +478,37 @@ def onset_paddings(onset_times, onset_durations, tempo, abs_x, precisions=1.0, s
     """
     spb = 60 / tempo * precisions
     local_range = 100
-    onset_samples = librosa.time_to_samples(onset_times, sr=sr)
-
-    length = len(onset_times)
-    i = 0
-    while i < length - 1:
-        interval_samples = np.arange(-local_range, local_range).reshape(1, -1) + onset_samples[i]
-        pre_amplitude = abs_x[interval_samples].reshape(-1, 2 * local_range)
-        pre_amplitude = np.max(pre_amplitude, axis=1)
-        count = 0
-
-        while onset_times[i + 1] - onset_times[i] - onset_durations[i] - count * spb > spb:
-            new_start_time = onset_times[i] + onset_durations[i] + count * spb
-            new_onset_sample = librosa.time_to_samples(new_start_time, sr=sr)
-
-            interval_samples = np.arange(-local_range, local_range).reshape(1, -1) + new_onset_sample
-            cur_amplitude = abs_x[interval_samples].reshape(-1, 2 * local_range)
-            cur_amplitude = np.max(cur_amplitude, axis=1)
-
-            if cur_amplitude >= pre_amplitude / 2:
-                i += 1
-                length += 1
-                onset_times = np.insert(onset_times, i, new_start_time, axis=0)
-                onset_durations = np.insert(onset_durations, i, spb, axis=0)
-                onset_samples = np.insert(onset_samples, i, new_onset_sample, axis=0)
-                count = 0
-            else:
-                count += 1
-
-        i += 1
-    return onset_times, onset_durations
-
-
-def onset_detection(x, fs, fft_length=1024, fft_hop_length=512, tempo=None):
+    onset_times = np.asarray(onset_times)
+    onset_durations = np.asarray(onset_durations)
+    if len(onset_times) < 2:
+        return onset_times, onset_durations
+
+    # enumerate the candidate slots of all gaps at once, slot k of a gap starts k padding steps after the gap start
+    gap_starts = onset_times[:-1] + onset_durations[:-1]
+    gap_lengths = onset_times[1:] - onset_times[:-1] - onset_durations[:-1]
+    slot_counts = np.maximum(np.floor(gap_lengths / spb), 0).astype(int)
+    gaps = np.repeat(np.arange(len(gap_starts)), slot_counts)
+    slots = np.arange(len(gaps)) - np.repeat(np.cumsum(slot_counts) - slot_counts, slot_counts)
+    fits = gap_lengths[gaps] - slots * spb > spb
+    gaps, slots = gaps[fits], slots[fits]
+    padding_times = gap_starts[gaps] + slots * spb
+
+    # loudness around every onset and padding slot, from one lookup into the windows of the signal
+    windows = np.lib.stride_tricks.sliding_window_view(abs_x, 2 * local_range)
+    window_starts = librosa.time_to_samples(np.concatenate([onset_times[:-1], padding_times]), sr=sr) - local_range
+    amplitudes = np.max(windows[np.clip(window_starts, 0, len(windows) - 1)], axis=1)
+    onset_amplitude, padding_amplitude = amplitudes[:len(gap_starts)], amplitudes[len(gap_starts):]
+    is_loud = padding_amplitude >= onset_amplitude[gaps] / 2
+
+    padded_times = np.concatenate([onset_times, padding_times[is_loud]])
+    padded_durations = np.concatenate([onset_durations, np.full(np.count_nonzero(is_loud), spb)])
+    order = np.argsort(padded_times, kind="stable")
+    return padded_times[order], padded_durations[order]
+
+
+@profiled()
+def onset_detection(x, fs, fft_length=1024, fft_hop_length=512, tempo=None, padding=False, separation="nn_filter",
+                    window=None, n_fft=2048, hop_length=512, workers=None, stage_cache=None, dual_stream=False):
     """
     Main call of onset information retrieval
     :param x: audio input signal
@@ -254,55 +516,193 @@ def onset_detection(x, fs, fft_length=1024, fft_hop_length=512, tempo=None):
     :param fft_length: length for stft frame
     :param fft_hop_length: hop size for stft frame
     :param tempo: song tempo
-    :return: onset time, duration, bars (in which onsets are located), tempo
+    :param padding: fill long gaps between onsets with padding onsets
+    :param separation: "nn_filter" or "windowed", see QUALITY_TIERS
+    :param window: window in seconds of the "windowed" separation
+    :param n_fft: stft frame length for separation and onset envelopes
+    :param hop_length: stft frame hop size for separation and onset envelopes
+    :param workers: number of threads analysing the vocal and background branches at the same time (default: one per
+    branch, at most one per CPU), 1 analyses them one after the other
+    :param stage_cache: analysis_cache.StageCache of the song, keeping the results of the stages that do not depend on
+    the tempo, so that only merging, rounding and bar assignment rerun when the song is analysed again with another
+    tempo
+    :param dual_stream: return the vocal and background onsets merged into one stream, with the label of every onset
+    (see merge_vocal_background), rather than only the vocal onsets
+    :return: onset time, duration, bars (in which onsets are located), tempo, and onset labels if dual_stream
     """
-    x_foreground, x_background = vocal_separation(copy.deepcopy(x), fs)
-    onset_list = []
-    duration_list = []
-    onset_bars_list = []
-
-    # adjust 2
-    onset_env = librosa.onset.onset_strength(y=x, sr=fs)
+    separation_parameters = {"separation": separation, "window": window if separation == "windowed" else None,
+                             "n_fft": n_fft, "hop_length": hop_length}
+    branches, estimated_tempo = raw_onset_detection(x, fs, fft_length=fft_length, fft_hop_length=fft_hop_length,
+                                                    workers=workers, stage_cache=stage_cache,
+                                                    **separation_parameters)
     if tempo is None:
-        tempo = librosa.beat.tempo(onset_envelope=onset_env, sr=fs)
-        tempo = np.around(tempo, 0)
+        tempo = estimated_tempo
 
+    onset_list = []
+    duration_list = []
+    for branch, (onset_times, onset_durations) in zip(("vocals", "background"), branches):
+        with stage(branch):
+            onset_times, onset_durations = merge_close_onset(onset_times, onset_durations, tempo)
+
+            onset_times, onset_durations = onset_roundings(onset_times, onset_durations, tempo)
+            if padding:
+                x_branch = separate_stems(x, fs, **separation_parameters)[0] \
+                    if branch == "vocals" else x
+                onset_times, onset_durations = onset_paddings(onset_times, onset_durations, tempo, np.abs(x_branch),
+                                                              sr=fs)
+        onset_list.append(onset_times)
+        duration_list.append(onset_durations)
 
-    x_background = x
-    for x in [x_foreground, x_background]:
-        y = abs(librosa.stft(x, n_fft=fft_length, hop_length=fft_hop_length, center=False))
-        S = librosa.feature.melspectrogram(y=x, sr=fs, n_fft=fft_length, hop_length=fft_hop_length)
-        onset_env = librosa.onset.onset_strength(y=x, sr=fs)
+    if dual_stream:
+        onset_times, onset_durations, onset_labels = merge_vocal_background(onset_list[0], duration_list[0],
+                                                                            onset_list[1], duration_list[1])
+        return onset_times, onset_durations, onset_bars(onset_times, tempo), tempo, onset_labels
 
-        onset_frames = librosa.onset.onset_detect(onset_envelope=onset_env, sr=fs)
-        # using onset_detect from librosa to detect onsets (using parameters delta=0.04, wait=4)
-        onset_times = librosa.frames_to_time(onset_frames, sr=fs)
-        onset_samples = librosa.frames_to_samples(onset_frames)
-        onset_durations = onset_length_detection(x, y, onset_samples, sr=fs)
+    # only return vocal onset, with the bar number of each onset
+    onset_times, onset_durations = onset_list[0], duration_list[0]
+    return onset_times, onset_durations, onset_bars(onset_times, tempo), tempo
 
-        onset_times, onset_durations = remove_noisy_onset(onset_times, onset_durations, x, sr=fs)
-        onset_times, onset_durations = merge_close_onset(onset_times, onset_durations, tempo)
 
-        onset_times, onset_durations = onset_roundings(onset_times, onset_durations, tempo)
-        # onset_times, onset_durations = onset_paddings(onset_times, onset_durations, tempo, np.abs(x), sr=fs)
+def separate_stems(x, fs, separation="nn_filter", window=None, n_fft=2048, hop_length=512, features=None, margin_i=5,
+                   margin_v=20):
+    """
+    Separate the vocals from the song with the separation of a quality tier
+    :param x: audio input signal
+    :param fs: sampling rate
+    :param separation: "nn_filter" or "windowed", see QUALITY_TIERS
+    :param window: window in seconds of the "windowed" separation
+    :param n_fft: stft frame length
+    :param hop_length: stft frame hop size
+    :param features: FeatureStore of x, so that its spectrogram can be shared with later stages
+    :param margin_i: margin of the background mask of vocal_separation, see separation_masks
+    :param margin_v: margin of the vocal mask of vocal_separation, see separation_masks
+    :return: vocal audio, and background audio
+    """
+    if separation not in ("nn_filter", "windowed"):
+        raise ValueError(f"Unknown separation {separation}, expected nn_filter or windowed")
+    return vocal_separation(x, fs, features=features, n_fft=n_fft, hop_length=hop_length,
+                            window=window if separation == "windowed" else None, margin_i=margin_i, margin_v=margin_v)
 
-        onset_list.append(onset_times)
-        duration_list.append(onset_durations)
 
-    # calculate the bar number for each onset
-    beats_per_bar = 8  # usually it's 4 beats per bar, but having 8 beats per pattern makes a more enjoyable map
-    bar_duration = 60 / tempo * beats_per_bar
-    onset_bars_list = [(i // bar_duration + 1) for i in onset_list]
+def raw_onset_detection(x, fs, fft_length=1024, fft_hop_length=512, separation="nn_filter", window=None, n_fft=2048,
+                        hop_length=512, workers=None, stage_cache=None):
+    """
+    The stages of onset_detection that do not depend on the tempo: separation, onset picking, duration detection and
+    noise removal of the vocal and background branches, and tempo estimation
+    :param x: audio input signal
+    :param fs: sampling rate
+    :param fft_length: length for stft frame
+    :param fft_hop_length: hop size for stft frame
+    :param separation: "nn_filter" or "windowed", see QUALITY_TIERS
+    :param window: window in seconds of the "windowed" separation
+    :param n_fft: stft frame length for separation and onset envelopes
+    :param hop_length: stft frame hop size for separation and onset envelopes
+    :param workers: number of threads analysing the branches at the same time, see onset_detection
+    :param stage_cache: analysis_cache.StageCache of the song, the results are loaded from it if possible
+    :return: onset times and durations of the vocal and of the background branch, estimated tempo
+    """
+    parameters = {"version": ANALYSIS_VERSION, "sr": fs, "fft_length": fft_length, "fft_hop_length": fft_hop_length,
+                  "separation": separation, "window": window, "n_fft": n_fft, "hop_length": hop_length}
+    if stage_cache is not None:
+        onsets = stage_cache.load("onsets", **parameters)
+        if onsets is not None:
+            return (((onsets["vocal_times"], onsets["vocal_durations"]),
+                     (onsets["background_times"], onsets["background_durations"])), onsets["tempo"])
+
+    # every spectral feature of the mix is computed once and shared by separation, tempo estimation and the
+    # background branch, which analyses the mix itself
+    mix_features = FeatureStore(x, fs)
+    x_foreground, _ = separate_stems(x, fs, separation=separation, window=window, n_fft=n_fft, hop_length=hop_length,
+                                     features=mix_features)
 
-    # merge background and vocal onsets (for future developement)
-    # onset_times, onset_durations, onset_labels = merge_vocal_background_with_padding(onset_list[0], duration_list[0], onset_list[1], duration_list[1], tempo)
+    # adjust 2
+    with stage("onset_envelope"):
+        onset_env = mix_features.onset_envelope(n_fft=n_fft, hop_length=hop_length)
+    tempo = estimate_tempo(onset_env, fs, hop_length=hop_length)
 
-    # only return vocal onset
-    onset_times, onset_durations, onset_bars_list = onset_list[0], duration_list[0], onset_bars_list[0]
-    return onset_times, onset_durations, onset_bars_list, tempo
+    x_background = x
+    branches = [("vocals", x_foreground, FeatureStore(x_foreground, fs)), ("background", x_background, mix_features)]
+
+    def analyse(branch):
+        return branch_onset_detection(*branch, fs, fft_length=fft_length, fft_hop_length=fft_hop_length, n_fft=n_fft,
+                                      hop_length=hop_length)
+
+    if workers is None:
+        workers = min(len(branches), os.cpu_count() or 1)
+    if workers == 1:
+        results = [analyse(branch) for branch in branches]
+    else:
+        # the branches are independent and spend most of their time in numpy and FFT code, which releases the GIL
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(in_current_stage(analyse), branches))
+
+    if stage_cache is not None:
+        (vocal_times, vocal_durations), (background_times, background_durations) = results
+        stage_cache.store("onsets", {"vocal_times": vocal_times, "vocal_durations": vocal_durations,
+                                     "background_times": background_times,
+                                     "background_durations": background_durations, "tempo": tempo}, **parameters)
+    return results, tempo
+
+
+def branch_onset_detection(branch, x, features, fs, fft_length=1024, fft_hop_length=512, n_fft=2048, hop_length=512,
+                           divergence_threshold=-2, amplitude_ratio=12):
+    """
+    Onset picking, duration detection and noise removal of one branch (vocals or background) of raw_onset_detection
+    :param branch: name of the branch, for profiling
+    :param x: audio signal of the branch
+    :param features: FeatureStore of x, cleared when finished
+    :param fs: sampling rate
+    :param fft_length: length for stft frame
+    :param fft_hop_length: hop size for stft frame
+    :param n_fft: stft frame length for onset envelopes
+    :param hop_length: stft frame hop size for onset envelopes
+    :param divergence_threshold: end of an onset, see onset_length_detection
+    :param amplitude_ratio: noise threshold, see remove_noisy_onset
+    :return: onset times, durations
+    """
+    with stage(branch):
+        onset_times, onset_samples, y = pick_onsets(features, fs, fft_length=fft_length,
+                                                    fft_hop_length=fft_hop_length, n_fft=n_fft, hop_length=hop_length)
+        onset_durations = onset_length_detection(x, y, onset_samples, fft_length=fft_length,
+                                                 fft_hop_length=fft_hop_length, sr=fs,
+                                                 divergence_threshold=divergence_threshold)
+        features.clear()
+
+        onset_times, onset_durations = remove_noisy_onset(onset_times, onset_durations, x, sr=fs,
+                                                          amplitude_ratio=amplitude_ratio)
+    return onset_times, onset_durations
 
 
-def onset_length_detection(x, y, onset_samples, fft_length=1024, fft_hop_length=512, sr=22050, tolerance=6, use_max_freq_peak=False, use_max_freq_amp=False, use_mean_square=False):
+def pick_onsets(features, fs, fft_length=1024, fft_hop_length=512, n_fft=2048, hop_length=512):
+    """
+    Onset picking of one branch, the first stage of branch_onset_detection
+    :param features: FeatureStore of the audio signal of the branch
+    :param fs: sampling rate
+    :param fft_length: length for stft frame
+    :param fft_hop_length: hop size for stft frame
+    :param n_fft: stft frame length for onset envelopes
+    :param hop_length: stft frame hop size for onset envelopes
+    :return: onset times, onset samples, and the magnitude spectrogram for onset_length_detection
+    """
+    with stage("stft") as current_stage:
+        y = features.magnitude(n_fft=fft_length, hop_length=fft_hop_length, center=False)
+        current_stage.sizes(y=y)
+    with stage("onset_envelope") as current_stage:
+        onset_env = features.onset_envelope(n_fft=n_fft, hop_length=hop_length)
+        current_stage.sizes(onset_env=onset_env)
+
+    with stage("onset_picking") as current_stage:
+        onset_frames = librosa.onset.onset_detect(onset_envelope=onset_env, sr=fs, hop_length=hop_length)
+        current_stage.sizes(onset_frames=onset_frames)
+    # using onset_detect from librosa to detect onsets (using parameters delta=0.04, wait=4)
+    onset_times = librosa.frames_to_time(onset_frames, sr=fs, hop_length=hop_length)
+    onset_samples = librosa.frames_to_samples(onset_frames, hop_length=hop_length)
+    return onset_times, onset_samples, y
+
+
+@profiled()
+def onset_length_detection(x, y, onset_samples, fft_length=1024, fft_hop_length=512, sr=22050, tolerance=6, use_max_freq_peak=False, use_max_freq_amp=False, use_mean_square=False,
+                           divergence_threshold=-2):
     """
     Detect length of each onset
     :param x: input audio signal
@@ -315,87 +715,111 @@ def onset_length_detection(x, y, onset_samples, fft_length=1024, fft_hop_length=
     :param use_max_freq_peak: using frequency peak as comparison metric (default: False)
     :param use_max_freq_amp: using max frequency amplitude  as comparison metric (default: False)
     :param use_mean_square: using mean square as comparision metric (default: False)
+    :param divergence_threshold: an onset ends at the first frame whose distribution difference to the next frame is
+    below this
     :return: onset durations
     """
     residual_size = fft_length - fft_hop_length
-    filtered_onset_samples = onset_samples
-    filtered_onset_samples[onset_samples < fft_length] = fft_length - residual_size
-    onset_frame_indices = (filtered_onset_samples - fft_length) // residual_size + 1
-
-    onset_frame = y[:, onset_frame_indices]
-    peaks = np.argmax(onset_frame, axis=0)
-
-    abs_x = np.abs(x)
-    x_size = abs_x.shape
-    tindex = np.arange(20) + onset_frame_indices[2]
-    tmax = np.argmax(y[:, tindex], axis=0)
-
-    length_sum = np.ones((onset_samples.shape[0]))
-    valid_mask = np.ones((onset_samples.shape[0])).astype(bool)
-
-    old_peaks = np.argmax(onset_frame, axis=0)
-    old_amplitude = np.max(onset_frame, axis=0)
-
-    local_range = 100
-    interval_samples = np.arange(-local_range, local_range).reshape(1, -1) + onset_samples.reshape(-1, 1)
-    interval_samples = np.clip(interval_samples, 0, x_size)
-    standard_amplitude = abs_x[interval_samples].reshape(-1, 2 * local_range)
-    standard_amplitude = np.max(standard_amplitude, axis=1)
-
+    onset_samples = np.where(onset_samples < fft_length, fft_length - residual_size, onset_samples)
     number_of_frames = y.shape[1]
-
-    temp_indices = onset_frame_indices + 1
-    temp_onset_samples = onset_samples + residual_size
-    satisfaction = temp_indices < number_of_frames
-    valid_mask = np.logical_and(valid_mask, satisfaction)
-
-    temp_indices[~satisfaction] = number_of_frames - 1
-    temp_onset_samples[~satisfaction] = 0
-
-    old_frame = onset_frame  # / np.sum(onset_frame)
-    while valid_mask.sum() > 0:
-        new_onset_frame = y[:, temp_indices]
-        new_peaks = np.argmax(new_onset_frame, axis=0)
-        new_amplitude = np.max(new_onset_frame, axis=0)
-
-        diff = sum(rel_entr(old_frame, new_onset_frame))
-
-        satisfaction = np.ones((onset_samples.shape[0]))
-
-        # compute distribution difference
-        satisfaction = np.logical_and(satisfaction, diff >= -2)
-
-        # compute mean square difference (default not in use)
-        if use_mean_square:
-            diff = np.mean((old_frame - new_onset_frame) ** 2, axis=0)
-            satisfaction = np.logical_and(satisfaction, diff < 1.0)
-
-        # check change in max frequency peak (default not in use)
-        if use_max_freq_peak:
-            satisfaction = np.logical_and(satisfaction, np.abs(new_peaks - old_peaks) <= tolerance)
-
-        # use max frequency amplitude (default not in use)
-        if use_max_freq_amp:
-            satisfaction = np.logical_and(satisfaction, new_amplitude >= old_amplitude / 2)
-
-        valid_mask = np.logical_and(valid_mask, satisfaction)
-        length_sum += valid_mask
-
-        old_peaks = new_peaks
-        old_frame = new_onset_frame
-        temp_indices += 1
-        temp_onset_samples += residual_size
-        satisfaction = temp_indices < number_of_frames
-        valid_mask = np.logical_and(valid_mask, satisfaction)
-
-        temp_indices[~satisfaction] = number_of_frames - 1
-        temp_onset_samples[~satisfaction] = 0
+    onset_frame_indices = np.minimum((onset_samples - fft_length) // residual_size + 1, number_of_frames - 1)
+
+    # An onset lasts as long as each frame is similar enough to the next one. These comparisons only involve
+    # consecutive frames, so they are computed once per frame rather than once per onset and frame.
+    # compute distribution difference
+    continues = frame_divergences(y) >= divergence_threshold
+
+    # compute mean square difference (default not in use)
+    if use_mean_square:
+        continues &= frame_mean_square_differences(y) < 1.0
+
+    # check change in max frequency peak (default not in use)
+    if use_max_freq_peak:
+        continues &= np.abs(np.diff(np.argmax(y, axis=0))) <= tolerance
+
+    length_sum = onset_lengths(onset_frame_indices, continues)
+
+    # use max frequency amplitude (default not in use)
+    if use_max_freq_amp:
+        # the amplitude is compared with the one at the onset, so this check is done per onset,
+        # stepping only the onsets that are still active
+        amplitude = np.max(y, axis=0)
+        onset_amplitude = amplitude[onset_frame_indices]
+        ends = onset_frame_indices + length_sum - 1
+        frames = onset_frame_indices.copy()
+        active = np.flatnonzero(frames < ends)
+        while active.size > 0:
+            stops = amplitude[frames[active] + 1] < onset_amplitude[active] / 2
+            ends[active[stops]] = frames[active[stops]]
+            frames[active] += 1
+            active = active[~stops]
+            active = active[frames[active] < ends[active]]
+        length_sum = ends - onset_frame_indices + 1
 
     durations = length_sum * residual_size / sr
 
     return durations
 
 
-def process_audio(filename, tempo=None):
-    x, fs = load_audio(filename)
-    return onset_detection(x, fs, tempo=tempo)
+@profiled()
+def process_audio(filename, tempo=None, streaming=None, quality="accurate", pcm_path=None, workers=None,
+                  stage_cache=None, dual_stream=False):
+    """
+    Extract the musical information of an audio file
+    :param filename: file path to the audio
+    :param tempo: song tempo, estimated if not given
+    :param streaming: analyse the audio block by block, without its spectrograms in memory (see
+    streaming.StreamingOnsetAnalyzer), which is only possible with the balanced tier, whose results it reproduces. By
+    default only songs longer than STREAMING_MIN_DURATION are streamed, and only with the balanced tier.
+    :param quality: "fast", "balanced" or "accurate", see QUALITY_TIERS
+    :param pcm_path: file keeping the audio decoded at the sampling rate of the quality tier, see load_audio. Streamed
+    songs are read from it block by block if it exists, and from the audio file otherwise.
+    :param workers: number of threads analysing the vocal and background branches, see onset_detection
+    :param stage_cache: analysis_cache.StageCache of the song, see onset_detection. Streamed songs do not use it.
+    :param dual_stream: map both the vocal and the background onsets, see onset_detection
+    :return: onset time, duration, bars (in which onsets are located), tempo, and onset labels if dual_stream
+    """
+    settings = dict(QUALITY_TIERS[quality])
+    sr = settings.pop("sr")
+    decoded = read_pcm(pcm_path) if pcm_path is not None else None
+    if decoded is not None and decoded[1] != sr:
+        decoded = None
+    if streaming is None:
+        duration = len(decoded[0]) / decoded[1] if decoded is not None else librosa.get_duration(path=filename)
+        streaming = duration > STREAMING_MIN_DURATION and quality == "balanced"
+        if duration > STREAMING_MIN_DURATION and quality == "accurate":
+            print(f"Analysing a {duration / 60:.0f} minute song in memory, the balanced quality tier analyses long "
+                  f"songs block by block with much less memory")
+    if streaming:
+        if quality != "balanced":
+            raise ValueError(f"Only the balanced quality tier can be analysed block by block, not {quality}")
+        from game.utils.streaming import stream_onset_detection  # imported here as streaming.py imports this module
+        blocks = None
+        if decoded is not None:
+            blocks = (decoded[0][start:start + sr] for start in range(0, len(decoded[0]), sr))
+        return stream_onset_detection(filename, tempo=tempo, sr=sr, window=settings["window"], blocks=blocks,
+                                      dual_stream=dual_stream)
+    x, fs = load_audio(filename, sr=sr, pcm_path=pcm_path)
+    return onset_detection(x, fs, tempo=tempo, workers=workers, stage_cache=stage_cache, dual_stream=dual_stream,
+                           **settings)
+
+
+def analysis_parameters(tempo=None, progressive=None, quality="accurate", dual_stream=False):
+    """
+    Every parameter of process_audio that changes its output, for keying cached analysis results
+    :param tempo: song tempo given to process_audio
+    :param progressive: segment duration of progressive analysis (streaming.progressive_onset_detection), None if
+    the song is analysed as a whole
+    :param quality: quality tier given to process_audio
+    :param dual_stream: dual_stream given to process_audio
+    :return: dictionary of parameters, including the analysis code version
+    """
+    parameters = {"version": ANALYSIS_VERSION, "tempo": tempo, "fft_length": 1024, "fft_hop_length": 512}
+    if progressive is not None:
+        parameters["progressive"] = progressive
+    elif quality != "accurate":
+        # the accurate tier keeps the keys of results cached before tiers existed
+        parameters.update(quality=quality, **QUALITY_TIERS[quality])
+    if dual_stream and progressive is None:
+        parameters["dual_stream"] = True
+    return parameters
@@ -0,0 +1,52 @@
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+# Decoded audio files: a small header followed by the mono samples as raw little endian float32, so that they can be
+# memory-mapped instead of decoded again
+PCM_MAGIC = b"RGPCM\0\0\0"
+PCM_VERSION = 1
+# magic, version, sampling rate, number of samples, padded so that the samples start 32 byte aligned
+PCM_HEADER = struct.Struct("<8sIIQ8x")
+
+
+def write_pcm(file_path, x, sr):
+    """
+    Store a decoded audio signal
+    :param file_path: path of the PCM file
+    :param x: mono audio signal
+    :param sr: sampling rate
+    """
+    samples = np.ascontiguousarray(x, dtype="<f4")
+    # a temporary file of its own, as other processes may be writing the same song at the same time
+    fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(file_path))
+    try:
+        with os.fdopen(fd, "wb") as file:
+            file.write(PCM_HEADER.pack(PCM_MAGIC, PCM_VERSION, sr, len(samples)))
+            samples.tofile(file)
+        os.replace(temp_path, file_path)  # atomic, so a crash never leaves a half written file behind
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def read_pcm(file_path):
+    """
+    Memory-map a stored audio signal, only the parts of it that are accessed are read from disk
+    :param file_path: path of the PCM file
+    :return: read-only audio signal and sampling rate, or None if the file is missing, of another version or truncated
+    """
+    try:
+        with open(file_path, "rb") as file:
+            magic, version, sr, n_samples = PCM_HEADER.unpack(file.read(PCM_HEADER.size))
+        if magic != PCM_MAGIC or version != PCM_VERSION:
+            return None
+        if os.path.getsize(file_path) != PCM_HEADER.size + 4 * n_samples:
+            return None
+    except (OSError, struct.error):
+        return None
+    if n_samples == 0:
+        return np.zeros(0, dtype=np.float32), sr
+    return np.memmap(file_path, dtype="<f4", mode="r", offset=PCM_HEADER.size, shape=(n_samples,)), sr
@@ -0,0 +1,237 @@
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+# profiler that stages are recorded into, None when profiling is disabled
+_active_profiler = None
+
+
+class Profiler:
+    """
+    Records the wall time, CPU time, array sizes and allocation peaks of the stages of the analysis.
+    Stages are marked in the analysis code with the stage context manager or the profiled decorator of this module,
+    and are recorded into the profiler that is active while they run:
+
+        with Profiler(trace_memory=True) as profiler:
+            notedetection.process_audio(filename)
+        profiler.dump("profile.json")
+
+    When no profiler is active, marking a stage costs about as much as an empty function call, so the marks can stay
+    in the code. Allocation peaks are measured with tracemalloc, which slows numpy code down noticeably, so they are
+    only recorded with trace_memory. CPU time and allocation peaks are process wide, so they include the work of other
+    threads running at the same time.
+    """
+
+    def __init__(self, trace_memory=False):
+        """
+        :param trace_memory: record the allocation peak of every stage with tracemalloc
+        """
+        self.trace_memory = trace_memory
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()  # stack of the open stages of each thread
+        self._previous_profiler = None
+        self._started_tracing = False
+
+    def __enter__(self):
+        global _active_profiler
+        self._previous_profiler = _active_profiler
+        _active_profiler = self
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _active_profiler
+        _active_profiler = self._previous_profiler
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def stage(self, name):
+        """
+        :param name: name of the stage, prefixed with the names of the stages it runs in
+        :return: context manager recording the stage
+        """
+        return _Stage(self, name)
+
+    def report(self):
+        """
+        :return: dictionary with the records of all stages in the order they finished, and the total wall time of
+        every stage name
+        """
+        with self._lock:
+            records = list(self.records)
+        totals = {}
+        for record in records:
+            totals[record["stage"]] = totals.get(record["stage"], 0.0) + record["wall_time"]
+        return {"stages": records, "totals": totals}
+
+    def dump(self, filename):
+        """
+        Write the report to a JSON file
+        :param filename: path of the JSON file
+        """
+        with open(filename, "w") as file:
+            json.dump(self.report(), file, indent=2)
+
+    def format_report(self):
+        """
+        :return: the report as a readable table, with stages indented under the stages they run in
+        """
+        lines = [f"{'stage':<44} {'wall (s)':>9} {'cpu (s)':>9} {'peak MB':>8}"]
+        # records finish innermost first, list them in the order they started instead
+        for record in sorted(self.report()["stages"], key=lambda record: record["start"]):
+            depth = record["stage"].count("/")
+            name = "  " * depth + record["stage"].rsplit("/", 1)[-1]
+            peak = f"{record['peak_bytes'] / 1e6:.1f}" if "peak_bytes" in record else "-"
+            lines.append(f"{name:<44} {record['wall_time']:>9.3f} {record['cpu_time']:>9.3f} {peak:>8}")
+        return "\n".join(lines)
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def _add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+
+class _Stage:
+    """
+    Context manager recording one stage into a profiler
+    """
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.arrays = {}
+        self.children_peak = 0
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        self.path = "/".join([stage.name for stage in stack] + [self.name])
+        if self.profiler.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                # the enclosing stage keeps the peak reached so far, as it is reset here
+                stack[-1].children_peak = max(stack[-1].children_peak, peak)
+            tracemalloc.reset_peak()
+            self.memory_before = current
+        stack.append(self)
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        record = {
+            "stage": self.path,
+            "start": self.start_time,
+            "wall_time": time.perf_counter() - self.start,
+            "cpu_time": time.process_time() - self.start_cpu,
+        }
+        stack = self.profiler._stack()
+        stack.pop()
+        if self.profiler.trace_memory:
+            peak = max(tracemalloc.get_traced_memory()[1], self.children_peak)
+            record["peak_bytes"] = peak - self.memory_before
+            if stack:
+                stack[-1].children_peak = max(stack[-1].children_peak, peak)
+        if self.arrays:
+            record["arrays"] = self.arrays
+        if exc_type is not None:
+            record["error"] = exc_type.__name__
+        self.profiler._add(record)
+
+    def sizes(self, **arrays):
+        """
+        Record the shapes and sizes of the arrays a stage produced
+        :param arrays: arrays by name
+        """
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            self.arrays[name] = {"shape": list(array.shape), "dtype": str(array.dtype), "bytes": array.nbytes}
+
+
+class _DisabledStage:
+    """
+    Stage used when profiling is disabled, doing nothing
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def sizes(self, **arrays):
+        pass
+
+
+_DISABLED_STAGE = _DisabledStage()
+
+
+def stage(name):
+    """
+    Mark a stage of the analysis, recorded into the active profiler if there is one:
+
+        with profiling.stage("stft") as current_stage:
+            S = librosa.stft(y)
+            current_stage.sizes(S=S)
+
+    :param name: name of the stage
+    :return: context manager recording the stage
+    """
+    if _active_profiler is None:
+        return _DISABLED_STAGE
+    return _active_profiler.stage(name)
+
+
+def profiled(name=None):
+    """
+    Decorator marking every call of a function as a stage
+    :param name: name of the stage (default: the function name)
+    :return: decorator
+    """
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _active_profiler is None:
+                return function(*args, **kwargs)
+            with _active_profiler.stage(stage_name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def in_current_stage(function):
+    """
+    Wrap a function that is run in another thread (e.g. by a thread pool), so that the stages it marks are recorded
+    under the stages that are open in the calling thread rather than at the top level
+    :param function: function to wrap
+    :return: wrapped function
+    """
+    profiler = _active_profiler
+    if profiler is None:
+        return function
+    parents = list(profiler._stack())
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        stack = profiler._stack()
+        outer = list(stack)
+        stack[:] = parents
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stack[:] = outer
+    return wrapper
@@ -1,24 +1,31 @@
-import os
 from pytube import YouTube
-import time
-import ffmpeg
-import asyncio
+from pytube.exceptions import PytubeError
+from game.utils.downloads import DownloadError, DownloadManager
 
 
-def download_youtube_audio(url, output_path, output_name):
-    # Create the YouTube object
+def resolve_youtube_stream(url):
+    """
+    Find the audio stream of a YouTube video, see downloads.DownloadManager
+    :param url: link to the video
+    :return: URL of the stream, its file extension and its size in bytes
+    """
     try:
         video = YouTube(url)
         stream = video.streams.filter(only_audio=True).first()
-        stream.download(output_path=output_path)
-        output_file_path = os.path.join(output_path, output_name)
-        print("Audio downloaded successfully!")
+    except (KeyError, PytubeError) as error:
+        raise DownloadError(url, "unavailable", f"Unable to fetch video information ({type(error).__name__}: {error}). "
+                                                f"Please check the video URL.") from error
+    if stream is None:
+        raise DownloadError(url, "unavailable", "The video has no audio stream.")
+    print(f"Downloading {video.title}")
+    return stream.url, "." + stream.subtype, stream.filesize
 
-        # Convert the audio to mp3
-        ffmpeg.input(os.path.join(output_path, stream.default_filename)).output(output_file_path).run()
-        os.remove(os.path.join(output_path, stream.default_filename))
-        while not os.path.exists(output_file_path):
-            time.sleep(1)
-        print(f"{video.title} has been successfully downloaded as an MP3 file.")
-    except KeyError:
-        print("Unable to fetch video information. Please check the video URL or your network connection.")
+
+def download_youtube_stream(url, output_path):
+    """
+    Download the audio stream of a YouTube video as it is, it is decoded by ingest.ingest_download
+    :param url: link to the video
+    :param output_path: directory to download to
+    :return: path of the downloaded file
+    """
+    return DownloadManager(output_path, resolver=resolve_youtube_stream).download(url)
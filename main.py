@@ -1,19 +1,33 @@
-from game.game import Game
 from game.utils.cmdargs import args
 
 
 def main():
+    if args.command == "analyze":
+        # headless batch analysis, without pygame windows
+        from game.batch import analyze_library
+        analyze_library(args.sources, workers=args.workers, download_workers=args.downloads, tempo=args.tempo,
+                        quality=args.quality, dual_stream=args.dual_stream,
+                        seed=args.seed if args.seed is not None else 777,
+                        difficulty=args.difficulty if args.difficulty is not None else 5,
+                        approach_rate=args.ar if args.ar is not None else 10)
+        return
+
+    from game.game import Game
+
     # Manage command line arguments
     youtube_link = args.youtube if args.youtube is not None else "https://www.youtube.com/watch?v=-LwBbLa_Vhc"
+    source = args.file if args.file is not None else youtube_link  # local audio file or YouTube link
     seed = args.seed if args.seed is not None else 777
     given_tempo = args.tempo
-    if youtube_link == "https://www.youtube.com/watch?v=-LwBbLa_Vhc":   # for demonstration purposes
+    if source == "https://www.youtube.com/watch?v=-LwBbLa_Vhc":   # for demonstration purposes
         given_tempo = 246
     difficulty = args.difficulty if args.difficulty is not None else 5
     approach_rate = args.ar if args.ar is not None else 10
 
     use_game_background = True
-    settings = youtube_link, seed, given_tempo, difficulty, approach_rate, use_game_background
+    analysis_options = {"progressive": args.progressive, "profile": args.profile,
+                        "profile_memory": args.profile_memory, "quality": args.quality, "dual_stream": args.dual_stream}
+    settings = source, seed, given_tempo, difficulty, approach_rate, use_game_background, analysis_options
 
     game = Game(settings)
     game.run()